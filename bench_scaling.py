@@ -0,0 +1,84 @@
+""" Scaling of inference throughput with the number of decoder instances on one host.
+
+    Each instance is a process running predictions of several channels as fast as possible on a
+    synthetic envelope. The total is given in real time channels (8000/96 prediction steps per second
+    each) and channels per core:
+
+        python bench_scaling.py --instances 1 2 4 8
+        python bench_scaling.py --instances 1 2 4 8 --threads 1 --pin
+
+    Comparing both shows the loss when library thread pools oversubscribe the cores.
+"""
+import argparse, os, time
+import multiprocessing as mp
+import numpy as np
+import resources
+
+steps_per_second = 8000 / 96 # real time prediction rate of one channel
+
+
+def instance(index, args, barrier, results):
+    cpus = {}
+    if args.pin:
+        available = sorted(os.sched_getaffinity(0))
+        cpus["inference"] = {available[index % len(available)]}
+    config = resources.ResourceConfig(args.threads, cpus=cpus)
+    config.apply() # before Torch is imported by predictions
+    config.pin("inference")
+    import torch, predictions
+    config.apply_torch()
+    channels = []
+    for c in range(args.channels):
+        preds = predictions.Predictions(device=torch.device('cpu'))
+        preds.load_model(args.model)
+        channels.append(preds)
+    rng = np.random.default_rng(index)
+    blocks = [(rng.random(args.block_len) > 0.5).astype(np.float32) for b in range(16)]
+    for preds in channels: # warm up and fill look back buffers
+        preds.new_data(np.zeros(preds.look_back, dtype=np.float32))
+    barrier.wait()
+    nb_steps = 0
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < args.duration:
+        for preds in channels:
+            preds.new_data(blocks[nb_steps % len(blocks)])
+            nb_steps += preds.p_preds_t.shape[1]
+    results.put(nb_steps / (time.perf_counter() - t0))
+
+def run(nb_instances, args):
+    ctx = mp.get_context("spawn") # fresh interpreters so that thread settings apply before Torch starts
+    barrier = ctx.Barrier(nb_instances)
+    results = ctx.Queue()
+    processes = [ctx.Process(target=instance, args=(i, args, barrier, results)) for i in range(nb_instances)]
+    for p in processes:
+        p.start()
+    throughputs = [results.get() for p in processes]
+    for p in processes:
+        p.join()
+    return sum(throughputs)
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Inference throughput as decoder instances are added")
+    parser.add_argument("--instances", type=int, nargs="+", default=[1, 2, 4], help="Numbers of instances to run")
+    parser.add_argument("--channels", type=int, default=1, help="Channels per instance")
+    parser.add_argument("--threads", type=int, help="Torch/OpenMP/BLAS threads per instance (default: library defaults)")
+    parser.add_argument("--pin", action="store_true", help="Pin each instance to its own CPU")
+    parser.add_argument("--duration", type=float, default=5.0, help="Measurement time in seconds")
+    parser.add_argument("--block-len", type=int, default=41, help="Envelope samples per block (0.5 s)")
+    parser.add_argument("--model", default="models/default.model", help="Model weights")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    nb_cores = len(os.sched_getaffinity(0))
+    threads = args.threads if args.threads else "default"
+    print(f"{nb_cores} cores, {args.channels} channel(s) per instance, threads {threads}{', pinned' if args.pin else ''}")
+    print(f"{'instances':>9s} {'steps/s':>9s} {'channels':>9s} {'ch/inst':>8s} {'ch/core':>8s}")
+    for nb_instances in args.instances:
+        total = run(nb_instances, args)
+        channels = total / steps_per_second
+        print(f"{nb_instances:9d} {total:9.0f} {channels:9.1f} {channels/nb_instances:8.1f} {channels/nb_cores:8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+""" Word level correction of decoded characters against a dictionary of callsigns, Q-codes and CW abbreviations.
+
+    The dictionary is a DAWG (trie with shared suffixes) so that even a million callsigns fit in memory.
+    It can be compiled once from a word list and saved:
+
+        python corrector.py callsigns.txt callsigns.dawg
+
+    Each decoded character comes with alternative characters scored from the lengths of its Morse elements.
+    A fixed width beam walks the DAWG with these alternatives so the cost per character does not depend
+    on the size of the dictionary.
+"""
+import sys, pickle
+import heapq
+import morse
+
+qcodes = [
+    "QRA", "QRG", "QRK", "QRL", "QRM", "QRN", "QRO", "QRP", "QRQ", "QRS", "QRT", "QRU", "QRV", "QRX", "QRZ",
+    "QSA", "QSB", "QSK", "QSL", "QSO", "QSP", "QST", "QSX", "QSY", "QTC", "QTH", "QTR",
+]
+
+abbreviations = [
+    "CQ", "DE", "K", "KN", "AR", "SK", "BK", "R", "RST", "5NN", "TU", "TNX", "TKS", "FB", "OM", "YL", "XYL",
+    "ES", "HR", "UR", "NAME", "OP", "RIG", "ANT", "PWR", "WX", "W", "HW", "CUL", "73", "88", "GL", "GM", "GA",
+    "GE", "GN", "DR", "PSE", "AGN", "RPT", "INFO", "ABT", "BURO", "VIA", "TEST", "UP", "DN", "NR", "EE", "SRI",
+    "YAGI", "DIPOLE", "VERT", "BEAM", "LOOP", "SUNNY", "CLOUDY", "RAIN", "WARM", "COLD", "HOT", "QRPP",
+]
+
+
+class DawgNode:
+    __slots__ = ("children", "final")
+
+    def __init__(self):
+        self.children = {}
+        self.final = False
+
+    def signature(self):
+        return (self.final, tuple(sorted((c, id(n)) for c, n in self.children.items())))
+
+
+class Dawg:
+    """ Directed acyclic word graph built incrementally from sorted words (Daciuk et al. algorithm):
+        equivalent suffix sub-trees are merged as soon as they are complete.
+    """
+    def __init__(self, words=()):
+        self.root = DawgNode()
+        self.register = {}
+        self.previous = ""
+        self.unchecked = [] # (parent, char, child) of the last inserted word not yet minimized
+        self.nb_words = 0
+        for word in sorted(set(words)):
+            self.add(word)
+        self.finish()
+
+    def add(self, word):
+        if word <= self.previous:
+            raise ValueError(f"Dawg.add: words must be added in sorted order: {word} after {self.previous}")
+        common = 0
+        for a, b in zip(word, self.previous):
+            if a != b:
+                break
+            common += 1
+        self._minimize(common)
+        node = self.unchecked[-1][2] if self.unchecked else self.root
+        for c in word[common:]:
+            child = DawgNode()
+            node.children[c] = child
+            self.unchecked.append((node, c, child))
+            node = child
+        node.final = True
+        self.previous = word
+        self.nb_words += 1
+
+    def finish(self):
+        self._minimize(0)
+        self.register = {}
+
+    def _minimize(self, down_to):
+        while len(self.unchecked) > down_to:
+            parent, c, child = self.unchecked.pop()
+            signature = child.signature()
+            if signature in self.register:
+                parent.children[c] = self.register[signature]
+            else:
+                self.register[signature] = child
+
+    def __contains__(self, word):
+        node = self.root
+        for c in word:
+            node = node.children.get(c)
+            if node is None:
+                return False
+        return node.final
+
+    def save(self, filename):
+        sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+        with open(filename, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(filename):
+        """ Load a compiled DAWG (.dawg) or build it from a text file with one word per line
+        """
+        if filename.endswith(".dawg"):
+            with open(filename, "rb") as f:
+                return pickle.load(f)
+        return Dawg(read_words(filename))
+
+
+def char_candidates(ecounts, dit_len, max_candidates=4, width=0.75):
+    """ Alternative characters with their log likelihood from the element counts of a decoded character.
+        Each element count in dits is scored as absent (0), dit (about 2) or dah (about 4) which are the
+        element lengths seen by MorseDecoderRegen. Returns a list of (character, log likelihood) best first.
+    """
+    centers = ((0.0, ""), (2.125, "."), (4.0, "-")) # 17/8 and 32/8
+    beam = [(0.0, "")]
+    for count in ecounts:
+        x = count / dit_len
+        beam = heapq.nlargest(max_candidates*2, ((lp - ((x - center)/width)**2, s + e) for lp, s in beam for center, e in centers))
+    candidates = []
+    for lp, morsestr in beam:
+        c = morse.revmorsecode.get(morsestr)
+        if c and c not in (x[0] for x in candidates):
+            candidates.append((c, lp))
+        if len(candidates) == max_candidates:
+            break
+    return candidates
+
+
+class WordCorrector:
+    """ Streaming word corrector. Characters are added as they are decoded with their candidates and
+        the word is corrected at the word separator. A dictionary word replaces the decoded word only if
+        its likelihood is within max_penalty of the decoded one.
+    """
+    def __init__(self, dawg, beam_width=16, max_penalty=4.0):
+        self.dawg = dawg
+        self.beam_width = beam_width
+        self.max_penalty = max_penalty
+        self.start_word()
+
+    def start_word(self):
+        self.word = ""
+        self.word_score = 0.0
+        self.beam = [(0.0, "", self.dawg.root)]
+
+    def add_char(self, char, candidates):
+        """ Takes the decoded character and its candidates (list of (character, log likelihood))
+        """
+        self.word += char
+        scores = dict(candidates)
+        self.word_score += scores.get(char, max(scores.values(), default=0.0))
+        extended = []
+        for score, prefix, node in self.beam:
+            for c, lp in candidates:
+                child = node.children.get(c)
+                if child is not None:
+                    extended.append((score + lp, prefix + c, child))
+        self.beam = heapq.nlargest(self.beam_width, extended, key=lambda h: h[0])
+
+    def end_word(self):
+        """ Returns the decoded word and its correction (same if not corrected) and starts a new word
+        """
+        word = self.word
+        corrected = word
+        if word and word not in self.dawg:
+            finals = [(score, prefix) for score, prefix, node in self.beam if node.final]
+            if finals:
+                score, prefix = max(finals)
+                if score >= self.word_score - self.max_penalty:
+                    corrected = prefix
+        self.start_word()
+        return word, corrected
+
+
+def read_words(filename):
+    """ Words of a text file with one word per line
+    """
+    with open(filename) as f:
+        return [w.strip().upper() for w in f if w.strip()]
+
+def default_words():
+    return qcodes + abbreviations
+
+def load_corrector(filename=None):
+    """ Corrector with built in Q-codes and abbreviations plus words of the given list or compiled DAWG
+    """
+    if filename is None:
+        return WordCorrector(Dawg(default_words()))
+    if filename.endswith(".dawg"):
+        return WordCorrector(Dawg.load(filename))
+    return WordCorrector(Dawg(read_words(filename) + default_words()))
+
+
+if __name__ == '__main__':
+    words_file, dawg_file = sys.argv[1:3]
+    dawg = Dawg(read_words(words_file) + default_words())
+    dawg.save(dawg_file)
+    print(f"{dawg.nb_words} words saved to {dawg_file}")
@@ -1,26 +1,107 @@
+import collections
 import morse
 import numpy as np
 
+
+class ElementHistogram:
+    """ Histogram of element lengths with fixed bins of one sample updated in place.
+        The last size values are kept in a ring buffer so that the oldest contribution is removed
+        when a new one is added. Older contributions are also weighted down by decay at each addition.
+        Decay is applied lazily by growing the weight of new contributions so that adding a value is O(1).
+    """
+    def __init__(self, nb_bins=48, size=400, decay=0.998):
+        self.nb_bins = nb_bins
+        self.size = size
+        self.decay = decay
+        self.edges = np.arange(nb_bins+1)
+        self.reset()
+
+    def reset(self):
+        self.raw = np.zeros(self.nb_bins) # counts scaled by self.scale
+        self.ring_bins = np.zeros(self.size, dtype=int)
+        self.ring_weights = np.zeros(self.size)
+        self.pos = 0
+        self.scale = 1.0
+
+    def add(self, value):
+        b = min(max(int(value), 0), self.nb_bins-1)
+        self.raw[self.ring_bins[self.pos]] -= self.ring_weights[self.pos]
+        self.raw[b] += self.scale
+        self.ring_bins[self.pos] = b
+        self.ring_weights[self.pos] = self.scale
+        self.pos = (self.pos + 1) % self.size
+        self.scale /= self.decay
+        if self.scale > 1e9: # renormalize before precision is lost
+            self.raw /= self.scale
+            self.ring_weights /= self.scale
+            self.scale = 1.0
+
+    def counts(self):
+        """ Decayed counts per bin
+        """
+        return np.maximum(self.raw / self.scale, 0)
+
+
+class DitCalibrator:
+    """ Estimates the dit length from the dit and dah accumulations of the element length histogram.
+        Dits are expected at 17/8 and dahs at 32/8 of the dit length.
+    """
+    def __init__(self, histogram, min_weight=20, gain=0.2):
+        self.histogram = histogram
+        self.min_weight = min_weight
+        self.gain = gain
+        self.centers = histogram.edges[:-1] + 0.5
+
+    def estimate(self, decoder):
+        """ Dit length estimated with the thresholds of the decoder or None if not enough elements
+        """
+        counts = self.histogram.counts()
+        dit_len = decoder.dit_len
+        dits = (self.centers >= decoder.dit_l*dit_len) & (self.centers < decoder.dit_h*dit_len)
+        dahs = self.centers >= decoder.dah_l*dit_len
+        w_dit = counts[dits].sum()
+        w_dah = counts[dahs].sum()
+        if w_dit + w_dah < self.min_weight:
+            return None
+        estimate = 0
+        if w_dit > 0:
+            estimate += np.dot(counts[dits], self.centers[dits]) / 2.125
+        if w_dah > 0:
+            estimate += np.dot(counts[dahs], self.centers[dahs]) / 4.0
+        return estimate / (w_dit + w_dah)
+
+    def update(self, decoder):
+        """ Move the dit length of the decoder towards the estimate
+        """
+        estimate = self.estimate(decoder)
+        if estimate:
+            decoder.set_dit_len(decoder.dit_len + self.gain*(estimate - decoder.dit_len))
+
+
 class MorseDecoderRegen:
-    def __init__(self, alphabet=morse.alphabet, dit_len=8, max_ele=5, thr=0.9, his_len=400):
+    def __init__(self, alphabet=morse.alphabet, dit_len=8, max_ele=5, thr=0.9, his_len=400, res_len=None):
         self.nb_alpha = len(alphabet)
         self.alphabet = alphabet
         self.dit_len = dit_len
         self.max_ele = max_ele
         self.thr = thr
         self.res = ""
+        self.res_len = res_len # keep only the last res_len decoded characters if given
         self.char = " "
         self.env_char = []
         self.morsestr = ""
         self.his_len = his_len
-        self.his = np.zeros(his_len)
+        self.his = ElementHistogram(size=his_len)
         self.pprev = 0
         self.wsep = False
         self.csep = False
         self.scounts = [0 for x in range(3)] # separators
         self.ecounts = [0 for x in range(self.max_ele)] # Morse elements
         self.estarts = [0 for x in range(self.max_ele)] # Identified element start
+        self.char_ecounts = list(self.ecounts) # element counts of the last decoded character
         self.nb_char_samples = 0
+        self.nb_samples = 0 # samples since start or reset
+        self.char_index = 0 # sample where keying of the last decoded character (or word) ended
         self.dit_l = 1.375 # 11
         self.dit_h = 2.875 # 23
         self.dah_l = 3.125 # 25
@@ -32,8 +113,25 @@ class MorseDecoderRegen:
     def set_thr(self, thr):
         self.thr = thr
 
+    def reset(self):
+        """ Drop the character being decoded
+        """
+        self.morsestr = ""
+        self.wsep = False
+        self.csep = False
+        self.scounts = [0 for x in range(3)]
+        self.ecounts = [0 for x in range(self.max_ele)]
+        self.estarts = [0 for x in range(self.max_ele)]
+        self.nb_char_samples = 0
+        self.nb_samples = 0
+
+    def add_res(self, char):
+        self.res += char
+        if self.res_len and len(self.res) > 2*self.res_len: # trim now and then
+            self.res = self.res[-self.res_len:]
+
     def reset_hist(self):
-        self.his = np.zeros(self.his_len)
+        self.his.reset()
 
     def new_sample(self, sample):
         """ Takes one temporal sample element which is an array of:
@@ -43,6 +141,7 @@ class MorseDecoderRegen:
                 - ret_env: true if reconstructed envelope is available
         """
         self.nb_char_samples += 1
+        self.nb_samples += 1
         ret_char = False
         ret_env = False
         for i, s in enumerate(sample): # c, w, [pos]
@@ -63,7 +162,8 @@ class MorseDecoderRegen:
             if i >= 2:
                 self.ecounts[i-2] += s
             if i == 0 and self.scounts[0] > 0.8*self.dit_len and not self.csep: # character separator
-                self.his = np.concatenate((self.his[self.max_ele:],self.ecounts))
+                for count in self.ecounts:
+                    self.his.add(count)
                 self.env_char = [0 for x in range(self.nb_char_samples)] # initialize envelope for character period
                 morsestr = ""
                 for ip in range(self.max_ele):
@@ -81,7 +181,9 @@ class MorseDecoderRegen:
                         #print(f'dah {start} for {zl}')
                         morsestr += "-"
                 self.char = morse.revmorsecode.get(morsestr, '_')
-                self.res += self.char
+                self.char_ecounts = list(self.ecounts)
+                self.char_index = self.nb_samples - self.scounts[0]
+                self.add_res(self.char)
                 ret_char = True
                 #print("MorseDecoderRegen.new_sample", self.scounts[0], self.ecounts, morsestr, char, self.nb_char_samples)
                 self.csep = True
@@ -90,8 +192,166 @@ class MorseDecoderRegen:
                 self.nb_char_samples = 0
             if i == 1 and self.scounts[1] > 1.2*self.dit_len and not self.wsep: # word separator
                 self.char = " "
-                self.res += self.char
+                self.char_index = self.nb_samples - self.scounts[1]
+                self.add_res(self.char)
                 ret_char = True
                 #print("MorseDecoderRegen.new_sample", "w")
                 self.wsep = True
         return ret_char, ret_env
+
+
+class CTCGreedyDecoder:
+    """ Streaming best path decoding of character outputs of a CTC model (label 0 is blank, label i is
+        alphabet[i-1]). A character is emitted at the first step where it is the most likely label after
+        blank or another label. Same interface as MorseDecoderRegen for the application. Fixed cost per step.
+    """
+    def __init__(self, alphabet=" "+morse.alphabet, nb_candidates=3, res_len=None):
+        self.alphabet = alphabet
+        self.nb_candidates = nb_candidates
+        self.res_len = res_len
+        self.dit_len = 8 # nominal: the model finds timing by itself
+        self.reset()
+
+    def reset(self):
+        self.prev = 0
+        self.nb_samples = 0
+        self.char = " "
+        self.char_index = 0
+        self.candidates = [] # (character, log probability) of the emitted character at its step
+        self.res = ""
+
+    def set_dit_len(self, dit_len):
+        pass
+
+    def set_thr(self, thr):
+        pass
+
+    def reset_hist(self):
+        pass
+
+    def add_res(self, char):
+        self.res += char
+        if self.res_len and len(self.res) > 2*self.res_len:
+            self.res = self.res[-self.res_len:]
+
+    @staticmethod
+    def signals(logp):
+        """ Outputs shown like the cs and ws signals of the element models: probability of a character
+            other than space and probability of space at each step
+        """
+        p = np.exp(logp)
+        signals = np.zeros((7, p.shape[1]))
+        signals[0] = 1 - p[0] - p[1]
+        signals[1] = p[1]
+        return signals
+
+    def top_candidates(self, logp):
+        labels = np.argsort(logp[1:])[::-1][:self.nb_candidates]
+        return [(self.alphabet[i], float(logp[i+1])) for i in labels]
+
+    def new_sample(self, logp):
+        """ Takes the log probabilities of blank and alphabet at one step. Returns (character emitted, False)
+        """
+        label = int(np.argmax(logp))
+        self.nb_samples += 1
+        emitted = label != 0 and label != self.prev
+        self.prev = label
+        if emitted:
+            self.char = self.alphabet[label-1]
+            self.char_index = self.nb_samples - 1
+            self.candidates = self.top_candidates(logp)
+            self.add_res(self.char)
+        return emitted, False
+
+
+class CTCBeamDecoder(CTCGreedyDecoder):
+    """ Streaming prefix beam search of CTC outputs. Only the max_labels most likely labels over prune log
+        probability are tried so the cost per step is bounded. Characters are emitted when all beams agree
+        on them or at the latest max_delay steps after they appeared in the best beam (beams that disagree
+        are dropped). Committed characters are removed from the beams so they stay short.
+    """
+    def __init__(self, alphabet=" "+morse.alphabet, beam_width=8, prune=-6.0, max_labels=4, max_delay=40, nb_candidates=3, res_len=None):
+        self.beam_width = beam_width
+        self.prune = prune
+        self.max_labels = max_labels
+        self.max_delay = max_delay
+        super().__init__(alphabet, nb_candidates, res_len)
+
+    def reset(self):
+        super().reset()
+        self.beams = {(): (0.0, -np.inf)} # uncommitted labels -> log probabilities of ending in blank, in label
+        self.steps = {(): ()} # uncommitted labels -> step of each label
+        self.last = 0 # last committed label
+        self.pending = collections.deque() # committed (label, step) not yet emitted
+        self.step_logp = {} # outputs at the steps of uncommitted labels
+
+    def new_sample(self, logp):
+        self.nb_samples += 1
+        labels = np.argpartition(logp[1:], -self.max_labels)[-self.max_labels:] + 1
+        labels = labels[logp[labels] > self.prune]
+        beams = collections.defaultdict(lambda: [-np.inf, -np.inf])
+        steps = {}
+        for prefix, (p_blank, p_label) in self.beams.items():
+            p_total = np.logaddexp(p_blank, p_label)
+            beam = beams[prefix]
+            steps[prefix] = self.steps[prefix]
+            beam[0] = np.logaddexp(beam[0], p_total + logp[0])
+            last = prefix[-1] if prefix else self.last
+            for c in labels:
+                extended = prefix + (c,)
+                if extended not in steps:
+                    steps[extended] = self.steps[prefix] + (self.nb_samples,)
+                if c == last: # a repeated label needs a blank in between
+                    beam[1] = np.logaddexp(beam[1], p_label + logp[c])
+                    beams[extended][1] = np.logaddexp(beams[extended][1], p_blank + logp[c])
+                else:
+                    beams[extended][1] = np.logaddexp(beams[extended][1], p_total + logp[c])
+        if len(labels):
+            self.step_logp[self.nb_samples] = logp
+        best = sorted(beams.items(), key=lambda b: np.logaddexp(*b[1]), reverse=True)[:self.beam_width]
+        first = best[0][0]
+        nb_common = min(len(prefix) for prefix, _ in best)
+        for prefix, _ in best:
+            while prefix[:nb_common] != first[:nb_common]:
+                nb_common -= 1
+        nb_old = sum(1 for step in steps[first] if step <= self.nb_samples - self.max_delay)
+        nb_commit = max(nb_common, nb_old)
+        self.beams = {prefix: p for prefix, p in best if prefix[:nb_commit] == first[:nb_commit]}
+        self.steps = {prefix: steps[prefix] for prefix in self.beams}
+        self.commit(first, nb_commit)
+        return self.emit()
+
+    def commit(self, prefix, nb_common):
+        """ Moves the first nb_common labels of prefix (common to the remaining beams) to pending
+        """
+        if nb_common == 0:
+            return
+        for label, step in zip(prefix[:nb_common], self.steps[prefix][:nb_common]):
+            self.pending.append((label, step))
+            self.last = label
+        self.beams = {p[nb_common:]: v for p, v in self.beams.items()}
+        self.steps = {p[nb_common:]: s[nb_common:] for p, s in self.steps.items()}
+        oldest = min((s[0] for s in self.steps.values() if s), default=self.nb_samples)
+        self.step_logp = {s: l for s, l in self.step_logp.items() if s >= oldest or s in (step for _, step in self.pending)}
+
+    def flush(self):
+        """ Commits the best beam e.g. at the end of a recording. Returns the characters not emitted yet.
+        """
+        best = max(self.beams, key=lambda prefix: np.logaddexp(*self.beams[prefix]))
+        self.commit(best, len(best))
+        text = ""
+        while self.pending:
+            self.emit()
+            text += self.char
+        return text
+
+    def emit(self):
+        if not self.pending:
+            return False, False
+        label, step = self.pending.popleft()
+        self.char = self.alphabet[label-1]
+        self.char_index = step - 1
+        logp = self.step_logp.get(step)
+        self.candidates = self.top_candidates(logp) if logp is not None else [(self.char, 0.0)]
+        self.add_res(self.char)
+        return True, False
@@ -0,0 +1,75 @@
+""" Knowledge distillation of the production model (teacher) into smaller single layer LSTM students.
+
+    Students learn the teacher's 7 outputs (cs, ws, e0..e4) on MorseGen data, optionally mixed with the
+    true labels, then CER at several SNRs and per step inference latency are reported for each:
+
+        python distill.py --hidden 16 32 --steps 3000
+
+    Student weights are saved as models/student_l1h<hidden>.model. They load into Predictions with:
+
+        model = MorseBatchedLSTMStack(device, nb_lstm_layers=1, hidden_layer_size=<hidden>, output_size=7, dropout=0)
+"""
+import argparse
+import torch
+from predictions import MorseBatchedLSTMStack
+import training
+
+
+def soft_targets(loader, teacher, alpha):
+    """ Replace labels by alpha*teacher + (1-alpha)*labels. The MSE to this target equals, up to a constant,
+        the alpha weighted sum of the MSE to the teacher and the MSE to the labels.
+    """
+    teacher = training.WindowBatchModel(teacher)
+    for X, y in loader:
+        with torch.no_grad():
+            y_teacher = teacher(X)
+        yield X, alpha*y_teacher + (1-alpha)*y
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Distill the production model into smaller students")
+    parser.add_argument("--teacher", default="models/default.model", help="Teacher weights (2x60 LSTM stack)")
+    parser.add_argument("--hidden", type=int, nargs="+", default=[16, 32], help="Student hidden sizes")
+    parser.add_argument("--steps", type=int, default=3000, help="Optimizer steps per student")
+    parser.add_argument("--batch-size", type=int, default=32, help="Batch size")
+    parser.add_argument("--lr", type=float, default=2e-3, help="Learning rate")
+    parser.add_argument("--alpha", type=float, default=0.8, help="Weight of the teacher targets vs true labels")
+    parser.add_argument("--snr", type=float, nargs="+", default=[-10, -15, -17, -20], help="Evaluation SNRs in dB")
+    parser.add_argument("--threads", type=int, default=1, help="Torch threads (latency is measured with this setting)")
+    return parser.parse_args()
+
+def report(name, model, look_back, snrs):
+    cers = [training.evaluate_cer(model, look_back, snr) for snr in snrs]
+    latency = training.step_latency(model, look_back)
+    return name, sum(p.numel() for p in model.parameters()), latency, cers
+
+def main():
+    args = get_args()
+    torch.set_num_threads(args.threads)
+    device = torch.device('cpu')
+    look_back = training.look_back_len()
+    teacher = MorseBatchedLSTMStack(device, nb_lstm_layers=2, hidden_layer_size=60, output_size=training.max_ele+2, dropout=0.1)
+    teacher.use_minmax = True
+    teacher.load_state_dict(torch.load(args.teacher, map_location=device))
+    teacher.eval()
+    results = [report("teacher l2h60", teacher, look_back, args.snr)]
+    for hidden in args.hidden:
+        student = MorseBatchedLSTMStack(device, nb_lstm_layers=1, hidden_layer_size=hidden, output_size=training.max_ele+2, dropout=0)
+        student.use_minmax = True
+        model = training.WindowBatchModel(student)
+        loader = torch.utils.data.DataLoader(training.MorseKeyingStream(look_back, seed=hidden), batch_size=args.batch_size)
+        optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+        print(f"Training student l1h{hidden}")
+        training.train(model, soft_targets(loader, teacher, args.alpha), optimizer, args.steps)
+        filename = f"models/student_l1h{hidden}.model"
+        torch.save(student.state_dict(), filename)
+        print(f"Saved {filename}")
+        results.append(report(f"student l1h{hidden}", student, look_back, args.snr))
+    print()
+    print(f"{'model':16s} {'params':>7s} {'step (us)':>10s} " + " ".join(f"{f'CER {snr:g}dB':>11s}" for snr in args.snr))
+    for name, nb_params, latency, cers in results:
+        print(f"{name:16s} {nb_params:7d} {latency*1e6:10.1f} " + " ".join(f"{c:11.3f}" for c in cers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,488 @@
+import os, sys
+from math import gcd
+from functools import lru_cache
+import numpy as np
+import scipy.fft as scipy_fft
+import metrics
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'notebooks'))
+from peakdetect import peakdet
+
+fft_workers = -1 # scipy FFT workers of the stages (-1: all cores). See resources.py
+
+
+def nb_samples_per_dit_decim(Fs=8000, code_speed=13, decim=7.69):
+    """ One dit of time at w wpm is 1.2/w.
+        Returns a tuple (raw samples per dit, expected decimation factor)
+        Overlap is nfft - decimation factor
+    """
+    t_dit = 1.2 / code_speed
+    return int(t_dit * Fs), int(t_dit * Fs) / decim
+
+def fft_optim(Fs=8000, code_speed=13, decim=7.69):
+    spd, fft_decim = nb_samples_per_dit_decim(Fs, code_speed, decim)
+    log2_spd = np.log(spd) / np.log(2)
+    nfft = 2**int(log2_spd-1)
+    noverlap = nfft - round(fft_decim)
+    return nfft, noverlap
+
+
+@lru_cache(maxsize=16)
+def cached_window(window, nperseg):
+    from scipy.signal import get_window # scipy.signal takes about 1 s to import: only when a stage is built
+    return get_window(window, nperseg).astype(np.float32)
+
+
+class PolyphaseDecimator:
+    """ Streaming anti-alias resampler from any input rate down to a processing rate.
+        Rational ratio L/M implemented as a polyphase FIR: only the L phases of the filter
+        that produce retained output samples are computed. The filter history and output
+        phase are carried between blocks so the output does not depend on block boundaries.
+        Works on real or complex samples.
+    """
+    def __init__(self, in_rate, out_rate, half_len=10, beta=5.0):
+        self.in_rate = in_rate
+        if out_rate >= in_rate: # nothing to do
+            self.out_rate = in_rate
+            self.up = 1
+            self.down = 1
+            self.phases = None
+            return
+        g = gcd(int(in_rate), int(out_rate))
+        self.up = int(out_rate) // g
+        self.down = int(in_rate) // g
+        self.out_rate = in_rate * self.up / self.down
+        if self.out_rate == int(self.out_rate):
+            self.out_rate = int(self.out_rate)
+        # Same design as scipy.signal.resample_poly: cut off at the lower Nyquist frequency
+        from scipy.signal import firwin
+        max_rate = max(self.up, self.down)
+        ntaps = 2*half_len*max_rate + 1
+        h = firwin(ntaps, 1.0/max_rate, window=('kaiser', beta)) * self.up
+        self.nb_taps_phase = -(-ntaps // self.up) # ceil
+        h = np.concatenate((h, np.zeros(self.nb_taps_phase*self.up - ntaps)))
+        # phases[p][k] applies to input sample i-k for an output on upsampled position i*up + p
+        self.phases = h.reshape(self.nb_taps_phase, self.up).T[:, ::-1].copy() # reversed for windows in increasing time order
+        self.reset()
+
+    def reset(self):
+        if self.phases is None:
+            return
+        self.history = np.zeros(self.nb_taps_phase - 1)
+        self.next_pos = 0 # upsampled position of next output relative to the first sample of the current block
+
+    def process(self, data):
+        """ Takes a block of input samples and returns the block of output samples available so far
+        """
+        if self.phases is None:
+            return data
+        if np.iscomplexobj(data) and not np.iscomplexobj(self.history):
+            self.history = self.history.astype(complex)
+        x = np.concatenate((self.history, data))
+        nb_in = len(data)
+        end_pos = nb_in * self.up # upsampled positions available
+        positions = np.arange(self.next_pos, end_pos, self.down)
+        idx = positions // self.up # input sample index in data
+        phase = positions % self.up
+        windows = np.lib.stride_tricks.sliding_window_view(x, self.nb_taps_phase)[idx] # x[i-K+1..i] for each output
+        out = np.einsum('ij,ij->i', windows, self.phases[phase])
+        self.next_pos = (positions[-1] + self.down - end_pos) if len(positions) else self.next_pos - end_pos
+        self.history = x[len(x)-(self.nb_taps_phase-1):] if self.nb_taps_phase > 1 else x[:0]
+        return out.astype(np.result_type(data.dtype, np.float32), copy=False)
+
+
+class StreamingSTFT:
+    """ Short time Fourier transform of a sample stream computed once and shared by the consumers:
+        averaged spectrum for peak detection and display, band power around each tone for the envelopes.
+        Segments overlap across blocks (the tail is carried) so frames are exactly those of a spectrogram
+        of the whole stream. Same defaults as scipy.signal.spectrogram: Tukey window, mean removed from
+        each segment. Frames are |FFT|^2 and are scaled by the consumers.
+    """
+    def __init__(self, rate, nfft, noverlap, nperseg=None, complex=False, window=('tukey', .25), workers=None):
+        self.rate = rate
+        self.nfft = nfft
+        self.nperseg = nperseg if nperseg else nfft
+        self.hop = self.nperseg - noverlap
+        self.complex = complex
+        self.workers = workers if workers is not None else fft_workers
+        self.window = cached_window(window, self.nperseg)
+        if complex:
+            self.freqs = scipy_fft.fftfreq(nfft, 1.0/rate)
+        else:
+            self.freqs = scipy_fft.rfftfreq(nfft, 1.0/rate)
+        self.density_scale = 1.0 / (rate * np.sum(self.window**2))
+        self.spectrum_scale = 1.0 / np.sum(self.window)**2
+        if not complex: # one sided: fold negative frequencies except DC and Nyquist
+            self.side_scale = np.full(len(self.freqs), 2.0)
+            self.side_scale[0] = 1
+            if nfft % 2 == 0:
+                self.side_scale[-1] = 1
+        else:
+            self.side_scale = np.ones(len(self.freqs))
+        self.reset()
+
+    def reset(self):
+        self.history = np.zeros(0, dtype=np.complex64 if self.complex else np.float32)
+
+    def process(self, data):
+        """ Takes a block of samples. Returns the new frames as an array (frames, bins) in FFT order
+        """
+        x = np.concatenate((self.history, data))
+        nb_frames = (len(x) - self.nperseg) // self.hop + 1 if len(x) >= self.nperseg else 0
+        self.history = x[nb_frames*self.hop:]
+        if nb_frames == 0:
+            return np.zeros((0, len(self.freqs)), dtype=np.float32)
+        segments = np.lib.stride_tricks.sliding_window_view(x, self.nperseg)[::self.hop][:nb_frames]
+        segments = (segments - segments.mean(axis=1, keepdims=True)) * self.window
+        if self.complex:
+            X = scipy_fft.fft(segments, n=self.nfft, axis=1, workers=self.workers)
+        else:
+            X = scipy_fft.rfft(segments, n=self.nfft, axis=1, workers=self.workers)
+        return (X.real**2 + X.imag**2).astype(np.float32, copy=False)
+
+    def spectrum(self, frames):
+        """ Average power spectrum (spectrum scaling) of frames in increasing frequency order.
+            Returns frequencies and values.
+        """
+        s = np.mean(frames, axis=0) * self.spectrum_scale * self.side_scale
+        if self.complex:
+            return scipy_fft.fftshift(self.freqs), scipy_fft.fftshift(s)
+        return self.freqs, s
+
+    def tone_bins(self, tone, wbins):
+        if self.complex:
+            center_bin = int(round(tone/self.rate * self.nfft)) % self.nfft
+            return np.arange(center_bin-wbins, center_bin+wbins+1) % self.nfft
+        center_bin = int(round(tone/(self.rate/2) * (len(self.freqs)-1)))
+        return np.arange(max(center_bin-wbins, 0), min(center_bin+wbins+1, len(self.freqs)))
+
+    def band_powers(self, frames, tones, wbins=1):
+        """ Power spectral density summed over the tone bin and wbins bins on each side for each tone.
+            Returns an array (tones, frames): the envelope of each tone.
+        """
+        envs = np.zeros((len(tones), len(frames)))
+        for i, tone in enumerate(tones):
+            bins = self.tone_bins(tone, wbins)
+            envs[i] = np.sum(frames[:, bins] * self.side_scale[bins], axis=1) * self.density_scale
+        return envs
+
+
+class Squelch:
+    """ Signal presence detector for one channel with hysteresis.
+        SNR is estimated from the power spectrum averaged over blocks as the peak around the tone over
+        the median of the spectrum in a band around the tone (noise floor). The thresholds depend on the
+        spectrum resolution and averaging. Defaults are for 0.5 s blocks of 256 points FFT frames at 8000 S/s
+        where the ratio stays under 1.5 dB on noise only and a 50% keyed tone at -17 dB SNR in 4 kHz
+        gives about 2.3 dB. The squelch opens when SNR reaches open_db and closes after hang consecutive
+        blocks below close_db.
+    """
+    def __init__(self, open_db=1.8, close_db=1.5, hang=4, tone_bw=20.0, noise_bw=400.0, average=0.3):
+        self.open_db = open_db
+        self.close_db = close_db
+        self.hang = hang
+        self.tone_bw = tone_bw # Hz around tone where signal peak is searched
+        self.noise_bw = noise_bw # Hz around tone where noise floor is estimated
+        self.average = average # weight of the new block in the averaged spectrum
+        self.avg_spectrum = None
+        self.is_open = False
+        self.hang_count = 0
+        self.snr_db = None
+        self.nb_blocks = 0
+        self.nb_open_blocks = 0
+
+    def update(self, f, s, tone):
+        """ Takes the power spectrum (frequencies and values) and detected tone frequency of a block.
+            Returns True if the squelch is open for this block.
+        """
+        if self.avg_spectrum is None or len(self.avg_spectrum) != len(s):
+            self.avg_spectrum = s
+        else:
+            self.avg_spectrum = (1-self.average)*self.avg_spectrum + self.average*s
+        s = self.avg_spectrum
+        df = f[1] - f[0]
+        center = int(round((tone - f[0]) / df))
+        tone_bins = max(int(self.tone_bw / df), 1)
+        noise_bins = max(int(self.noise_bw / df), 4*tone_bins)
+        signal_power = np.max(s[max(center-tone_bins, 0):center+tone_bins+1])
+        noise_floor = np.median(s[max(center-noise_bins, 0):center+noise_bins+1])
+        self.snr_db = 10*np.log10(signal_power / noise_floor) if noise_floor > 0 else 0
+        if self.snr_db >= self.open_db:
+            self.is_open = True
+            self.hang_count = self.hang
+        elif self.is_open and self.snr_db < self.close_db:
+            self.hang_count -= 1
+            if self.hang_count <= 0:
+                self.is_open = False
+        self.count(self.is_open)
+        return self.is_open
+
+    def idle(self):
+        """ Block where no tone was detected at all
+        """
+        self.snr_db = None
+        self.is_open = False
+        self.hang_count = 0
+        self.count(False)
+        return False
+
+    def count(self, is_open):
+        self.nb_blocks += 1
+        if is_open:
+            self.nb_open_blocks += 1
+
+    def duty_cycle(self):
+        """ Ratio of blocks passed to inference. 1 - duty cycle is the inference work saved.
+        """
+        return self.nb_open_blocks / self.nb_blocks if self.nb_blocks else 0
+
+
+class ToneFrontEnd:
+    """ Signal processing of one audio stream up to the envelope of its strongest tone, shared by the GUI and
+        multistream: decimation to the processing rate, streaming STFT, tone peak and squelch every 0.5 s and
+        envelope of the tone normalized while a signal is present. process returns a list of events:
+            ("env", envelope block, tone, SNR in dB) while the squelch is open
+            ("reset", None, tone, SNR in dB) when it closes so that predictions and decoder restart from a clean state
+        The last normalized samples, the spectrum and peaks of the last tone detection and the STFT frame index
+        of the last envelope block are kept for display and timing.
+    """
+    def __init__(self, rate=None, iq=False, wpm=17, proc_rate=8000, squelch_open=1.8, squelch_close=1.5, thr=1e-9):
+        self.iq = iq
+        self.proc_rate = proc_rate
+        self.squelch = Squelch(open_db=squelch_open, close_db=squelch_close)
+        self.thr = thr
+        self.thr_count = 0
+        self.img_norm = 1
+        self.tone = 0.0
+        self.t_decimate = metrics.registry.timer("decimate")
+        self.t_stft = metrics.registry.timer("stft")
+        self.t_peakdet = metrics.registry.timer("peakdet")
+        self.t_envelope = metrics.registry.timer("envelope")
+        if rate:
+            self.configure(rate, wpm)
+
+    def configure(self, rate, wpm, iq=None):
+        """ Stages for an input rate and code speed. Squelch, tone and envelope scale carry over.
+        """
+        if iq is not None:
+            self.iq = iq
+        self.rate = rate
+        self.decimator = PolyphaseDecimator(rate, self.proc_rate)
+        self.sample_rate = self.decimator.out_rate
+        self.nsamples = int(self.sample_rate)//2 # samples per 0.5 s at processing rate
+        self.nfft, self.noverlap = fft_optim(Fs=self.sample_rate, code_speed=wpm)
+        nperseg = self.nfft if self.nfft < 256 or self.noverlap >= 256 else 256
+        self.stft = StreamingSTFT(self.sample_rate, self.nfft, self.noverlap, nperseg, complex=self.iq)
+        self.peak_frames = max(self.nsamples // self.stft.hop, 1) # peak detection every 0.5s
+        self.frames = []
+        self.nb_frames = 0
+        self.nb_env_frames = 0 # STFT frames consumed since configure
+        self.first_frame = 0 # of the last envelope block
+        self.samples = None
+        self.peaks = None
+
+    def process(self, data):
+        """ Takes a block of samples at input rate, real or complex (I/Q)
+        """
+        self.samples = None
+        self.peaks = None
+        with self.t_decimate:
+            data = self.decimator.process(data)
+        if len(data) == 0 or np.max(np.abs(data)) == 0:
+            return []
+        self.samples = data = data / np.max(np.abs(data))
+        with self.t_stft:
+            frames = self.stft.process(data)
+        if len(frames) == 0:
+            return []
+        self.frames.append(frames)
+        self.nb_frames += len(frames)
+        if self.nb_frames < self.peak_frames:
+            return []
+        frames = np.concatenate(self.frames)
+        self.frames = []
+        self.nb_frames = 0
+        first_frame = self.nb_env_frames
+        self.nb_env_frames += len(frames)
+        with self.t_stft:
+            f, s = self.stft.spectrum(frames)
+        threshold = max(s)*0.9
+        if threshold > self.thr:
+            self.thr_count = 2
+        elif self.thr_count > 0:
+            self.thr_count -= 1
+        was_open = self.squelch.is_open
+        if self.thr_count > 0:
+            with self.t_peakdet:
+                maxtab, mintab = peakdet(s, threshold, f)
+            # no drop of delta after the maximum (flat averaged spectrum, peak at the edge): take the maximum
+            self.tone = float(maxtab[0,0] if len(maxtab) > 0 else f[np.argmax(s)])
+            self.peaks = (f, s, maxtab)
+            self.squelch.update(f, s, self.tone)
+        else:
+            self.squelch.idle()
+        events = []
+        if was_open and not self.squelch.is_open:
+            events.append(("reset", None, self.tone, self.squelch.snr_db))
+        if self.squelch.is_open:
+            with self.t_envelope:
+                env = self.stft.band_powers(frames, [self.tone], 1)[0]
+            if threshold > self.thr: # update scaling factor if signal present
+                self.img_norm = max(env)/1.5
+            env /= self.img_norm
+            env[env > 1] = 1
+            self.first_frame = first_frame
+            events.append(("env", env.astype(np.float32), self.tone, self.squelch.snr_db))
+        return events
+
+
+class PolyphaseChannelizer:
+    """ Uniform filterbank splitting a wideband complex stream into nb_channels channels of fs/nb_channels
+        bandwidth with one FFT per hop (weighted overlap-add structure). The prototype low pass filter
+        has taps_per_channel*nb_channels taps. With oversample=2 the channel rate is twice the channel
+        spacing so that signals at channel edges are not aliased. Cost per hop and channel grows with
+        taps_per_channel + log(nb_channels).
+        Channel k is centered at k*fs/nb_channels in FFT order (upper half are negative frequencies).
+    """
+    def __init__(self, rate, nb_channels, taps_per_channel=8, oversample=2, beta=8.0):
+        self.rate = rate
+        self.nb_channels = nb_channels
+        self.hop = nb_channels // oversample
+        self.channel_rate = rate / self.hop
+        self.nb_taps = nb_channels * taps_per_channel
+        self.taps_per_channel = taps_per_channel
+        from scipy.signal import firwin
+        self.prototype = firwin(self.nb_taps, 1.0/nb_channels, window=('kaiser', beta)).astype(np.float32)
+        self.freqs = np.fft.fftfreq(nb_channels, 1.0/rate)
+        self.reset()
+
+    def reset(self):
+        self.history = np.zeros(self.nb_taps - 1, dtype=np.complex64)
+        self.next_end = self.hop - 1 # index in next block of the last sample of the next hop
+        self.nb_hops = 0
+
+    def process(self, data):
+        """ Takes a block of complex samples. Returns channel outputs as an array (hops, channels).
+        """
+        x = np.concatenate((self.history, data.astype(np.complex64, copy=False)))
+        offset = len(self.history)
+        ends = np.arange(self.next_end, len(data), self.hop) + offset
+        self.next_end = (ends[-1] - offset + self.hop - len(data)) if len(ends) else self.next_end - len(data)
+        self.history = x[len(x)-len(self.history):]
+        if len(ends) == 0:
+            return np.zeros((0, self.nb_channels), dtype=np.complex64)
+        windows = np.lib.stride_tricks.sliding_window_view(x, self.nb_taps)[ends - self.nb_taps + 1]
+        weighted = windows[:, ::-1] * self.prototype # weighted[n] = h[n] x[t-n]
+        folded = weighted.reshape(len(ends), self.taps_per_channel, self.nb_channels).sum(axis=1)
+        out = scipy_fft.ifft(folded, axis=1, workers=fft_workers) * self.nb_channels
+        # bring channels to baseband: exp(-j 2 pi k t / M) at hop end time t
+        t = (self.nb_hops + np.arange(len(ends))) * self.hop + self.hop - 1
+        k = np.arange(self.nb_channels)
+        out *= np.exp(-2j*np.pi*np.outer(t % self.nb_channels, k) / self.nb_channels)
+        self.nb_hops += len(ends)
+        return out.astype(np.complex64, copy=False)
+
+    def active_channels(self, power, snr_db=10.0):
+        """ Channels which mean power (array (hops, channels)) exceeds the median over channels by snr_db
+            and that are local maxima so that a signal between two overlapping channels is taken once.
+        """
+        mean_power = np.mean(power, axis=0)
+        noise_floor = np.median(mean_power)
+        above = mean_power > noise_floor * 10**(snr_db/10)
+        local_max = (mean_power >= np.roll(mean_power, 1)) & (mean_power >= np.roll(mean_power, -1))
+        return np.nonzero(above & local_max)[0]
+
+
+class EnvelopeDecimator:
+    """ Integrate and dump power of several channels from channel rate down to the envelope rate
+        expected by the model (about 7.69 samples per dit). Output sample j integrates input samples
+        up to round((j+1)*ratio) so fractional ratios do not drift. The partial sum is carried between
+        blocks. Each channel envelope is normalized by a decaying peak value and clipped to 1 like the
+        single tone envelope.
+    """
+    def __init__(self, in_rate, env_rate, nb_channels, decay=0.999):
+        self.ratio = in_rate / env_rate
+        self.nb_channels = nb_channels
+        self.decay = decay
+        self.reset()
+
+    def reset(self):
+        self.acc = np.zeros(self.nb_channels) # partial sum of the current output sample
+        self.nb_in = 0 # input samples consumed
+        self.nb_out = 0 # output samples produced
+        self.peak = np.zeros(self.nb_channels)
+
+    def process(self, power):
+        """ Takes channel powers as an array (samples, channels). Returns envelopes (samples, channels).
+        """
+        total = self.nb_in + len(power)
+        ends = np.round((self.nb_out + 1 + np.arange(int(total/self.ratio) - self.nb_out + 1)) * self.ratio).astype(int)
+        ends = ends[ends <= total]
+        cum = np.concatenate((np.zeros((1, self.nb_channels)), np.cumsum(power, axis=0)))
+        if len(ends) == 0:
+            self.acc = self.acc + cum[-1]
+            self.nb_in = total
+            return np.zeros((0, self.nb_channels))
+        starts = np.concatenate(([np.round(self.nb_out * self.ratio)], ends[:-1])).astype(int)
+        vals = cum[ends - self.nb_in]
+        out = vals - np.concatenate((-self.acc[np.newaxis], vals[:-1]))
+        out /= (ends - starts)[:, np.newaxis]
+        self.acc = cum[-1] - vals[-1]
+        self.nb_in = total
+        self.nb_out += len(ends)
+        self.peak = np.maximum(self.peak * self.decay**len(power), np.max(out, axis=0))
+        env = out / np.maximum(self.peak/1.5, 1e-30)
+        env[env > 1] = 1
+        return env
+
+
+class CausalFilter:
+    """ Causal smoothing along the last axis (steps) of arrays of any leading shape e.g. (outputs, steps) or
+        (streams, outputs, steps). The state returned by process is passed to the next call so that filtering
+        a signal block by block gives the same values as filtering it at once. No state is a start after
+        silence (zero input). Kinds:
+          - mean: moving average of the last length values
+          - exp: exponential moving average with weight 2/(length+1) of the new value
+          - median: median of the last length values
+    """
+    kinds = ("mean", "exp", "median")
+
+    def __init__(self, kind="mean", length=3):
+        if kind not in self.kinds:
+            raise ValueError(f"unknown filter {kind}, expected one of {', '.join(self.kinds)}")
+        self.kind = kind
+        self.length = length
+        self.alpha = 2 / (length + 1)
+
+    def initial_state(self, shape):
+        """ State of a start after silence for inputs of leading shape
+        """
+        return np.zeros(tuple(shape) + ((1,) if self.kind == "exp" else (self.length - 1,)))
+
+    def process(self, x, state=None):
+        """ Returns the filtered values of x and the state after them
+        """
+        x = np.asarray(x)
+        if state is None:
+            state = self.initial_state(x.shape[:-1])
+        if x.shape[-1] == 0:
+            return np.zeros(x.shape), state
+        if self.kind == "exp":
+            from scipy.signal import lfilter
+            return lfilter([self.alpha], [1, self.alpha - 1], x, axis=-1, zi=state) # state: previous output times 1 - alpha
+        padded = np.concatenate((state, x), axis=-1)
+        n = x.shape[-1]
+        if self.kind == "mean": # sum of shifted views: same operations for each value whatever the blocks
+            y = padded[..., :n].copy()
+            for k in range(1, self.length):
+                y += padded[..., k:k+n]
+            y /= self.length
+        else:
+            y = np.median(np.lib.stride_tricks.sliding_window_view(padded, self.length, axis=-1), axis=-1)
+        return y, padded[..., n:]
+
+
+def add_arguments(parser):
+    parser.add_argument("--proc-rate", type=int, default=8000, help="Processing sample rate. Audio input is decimated to this rate (default 8000 S/s)")
+    parser.add_argument("--squelch-open", type=float, default=1.8, help="SNR in dB around the tone at which inference starts (default 1.8)")
+    parser.add_argument("--squelch-close", type=float, default=1.5, help="SNR in dB around the tone below which inference stops (default 1.5)")
+    parser.add_argument("--post-filter", default="mean", choices=CausalFilter.kinds, help="Smoothing of the NN outputs: moving average, exponential or median (default mean)")
+    parser.add_argument("--post-len", type=int, default=3, help="Length in predictions of the NN output smoothing (default 3)")
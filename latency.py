@@ -0,0 +1,94 @@
+""" End to end latency from keyed signal to decoded character.
+
+    Envelope blocks are stamped with the input sample index and wall clock time of their first sample.
+    Decoded characters are traced back to the envelope sample where their keying ended through the
+    prediction and decoder sample counts. The delay of each character is split into:
+        - buffering: from end of keying to the time the envelope block that completed it was queued
+          (audio block, STFT and peak detection block sizes, decoder waiting for the separator)
+        - processing: from queued to emitted (queue wait, Neural Network, decoder)
+"""
+import collections
+import csv
+import numpy as np
+import metrics
+
+latency_buckets = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0)
+
+
+class BlockStamp:
+    """ Time reference of an envelope block: input sample index and wall clock time of its first sample,
+        input samples per envelope sample and wall clock time at which it was queued for predictions
+    """
+    __slots__ = ("index", "step", "time", "queued", "rate")
+
+    def __init__(self, index, step, time, queued, rate):
+        self.index = index
+        self.step = step
+        self.time = time
+        self.queued = queued
+        self.rate = rate
+
+    def sample_index(self, j):
+        return self.index + j*self.step
+
+    def sample_time(self, j):
+        return self.time + j*self.step/self.rate
+
+
+class StampTrack:
+    """ Stamps of the last envelope blocks indexed by envelope sample since last reset
+    """
+    def __init__(self, maxlen=32):
+        self.stamps = collections.deque(maxlen=maxlen) # (first envelope sample, stamp)
+        self.nb_samples = 0
+
+    def reset(self):
+        self.stamps.clear()
+        self.nb_samples = 0
+
+    def add(self, stamp, nb_samples):
+        self.stamps.append((self.nb_samples, stamp))
+        self.nb_samples += nb_samples
+
+    def find(self, index):
+        """ Stamp of the block holding envelope sample index and position in the block
+        """
+        for start, stamp in reversed(self.stamps):
+            if index >= start:
+                return stamp, index - start
+        return None, 0
+
+
+class LatencyReport:
+    """ Latency of decoded characters as metrics histograms and records for the final report
+    """
+    def __init__(self, maxlen=100000):
+        self.records = collections.deque(maxlen=maxlen)
+        registry = metrics.registry
+        help = "Delay from end of keying to emission of decoded characters"
+        self.h_total = registry.histogram("char_latency_seconds", help, latency_buckets, part="total")
+        self.h_buffering = registry.histogram("char_latency_seconds", help, latency_buckets, part="buffering")
+        self.h_processing = registry.histogram("char_latency_seconds", help, latency_buckets, part="processing")
+
+    def add(self, char, sample_index, keyed, queued, emitted):
+        self.records.append((char, sample_index, keyed, queued, emitted))
+        self.h_total.observe(emitted - keyed)
+        self.h_buffering.observe(queued - keyed)
+        self.h_processing.observe(emitted - queued)
+
+    def summary(self):
+        if not self.records:
+            return "No character decoded"
+        keyed, queued, emitted = (np.array([r[k] for r in self.records]) for k in (2, 3, 4))
+        lines = [f"Latency of {len(self.records)} characters (s): " + " ".join(f"{h:>7s}" for h in ("p50", "p90", "p99", "max"))]
+        for name, delays in (("total", emitted - keyed), ("buffering", queued - keyed), ("processing", emitted - queued)):
+            p50, p90, p99 = np.percentile(delays, (50, 90, 99))
+            lines.append(f"{name:>31s}: {p50:7.3f} {p90:7.3f} {p99:7.3f} {delays.max():7.3f}")
+        return "\n".join(lines)
+
+    def save_csv(self, filename):
+        with open(filename, "w", newline="") as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(["char", "sample_index", "keyed", "queued", "emitted", "delay"])
+            for char, sample_index, keyed, queued, emitted in self.records:
+                writer.writerow([char, f"{sample_index:.0f}", f"{keyed:.6f}", f"{queued:.6f}", f"{emitted:.6f}", f"{emitted - keyed:.6f}"])
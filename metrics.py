@@ -0,0 +1,197 @@
+""" Processing metrics: counters, gauges and histograms of stage timings.
+
+    Metrics are created in a registry and can be exposed in the Prometheus text format on a local HTTP endpoint:
+
+        python morseangel.py --metrics-port 9108
+        curl http://127.0.0.1:9108/metrics
+"""
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import tracing
+
+default_buckets = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class Counter:
+    kind = "counter"
+    suffix = "_total" # of the metric family and its sample, as Prometheus names counters
+
+    def __init__(self, labels=()):
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def samples(self, name):
+        return [(name + format_labels(self.labels), self.value)]
+
+
+class Gauge:
+    kind = "gauge"
+    suffix = ""
+
+    def __init__(self, labels=()):
+        self.labels = labels
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name):
+        return [(name + format_labels(self.labels), self.value)]
+
+
+class Histogram:
+    """ Cumulative bucket counts, sum and count like Prometheus histograms.
+        The last observation and an exponential average are kept for display.
+    """
+    kind = "histogram"
+    suffix = ""
+
+    def __init__(self, labels=(), buckets=default_buckets, average=0.1):
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counts = [0 for b in range(len(self.buckets)+1)] # last is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.last = 0.0
+        self.mean = 0.0
+        self.average = average
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+            self.last = value
+            self.mean = value if self.count == 1 else self.mean + self.average*(value - self.mean)
+
+    def samples(self, name):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        samples = []
+        cumulated = 0
+        for bound, c in zip(self.buckets + (float("inf"),), counts):
+            cumulated += c
+            le = "+Inf" if bound == float("inf") else f"{bound:g}"
+            samples.append((name + "_bucket" + format_labels(self.labels + (("le", le),)), cumulated))
+        samples.append((name + "_sum" + format_labels(self.labels), total))
+        samples.append((name + "_count" + format_labels(self.labels), count))
+        return samples
+
+
+class Timer:
+    """ Context manager observing the elapsed time in a histogram. The span is also traced
+        under name when tracing is enabled.
+    """
+    __slots__ = ("histogram", "name", "start")
+
+    def __init__(self, histogram, name=None):
+        self.histogram = histogram
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.histogram.observe(end - self.start)
+        if tracing.tracer.enabled:
+            tracing.tracer.complete(self.name, self.start, end)
+
+
+class Registry:
+    def __init__(self, prefix="morseangel_"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.metrics = {} # name -> (help, {labels: metric})
+
+    def get(self, cls, name, help, labels, **kwargs):
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            _, family = self.metrics.setdefault(self.prefix + name, (help, {}))
+            if labels not in family:
+                family[labels] = cls(labels, **kwargs)
+            return family[labels]
+
+    def counter(self, name, help="", **labels):
+        return self.get(Counter, name, help, labels)
+
+    def gauge(self, name, help="", **labels):
+        return self.get(Gauge, name, help, labels)
+
+    def histogram(self, name, help="", buckets=default_buckets, **labels):
+        return self.get(Histogram, name, help, labels, buckets=buckets)
+
+    def stage(self, stage):
+        """ Timing histogram of a processing stage
+        """
+        return self.histogram("stage_seconds", "Processing time per call of each stage", stage=stage)
+
+    def timer(self, stage):
+        return Timer(self.stage(stage), stage)
+
+    def expose(self):
+        """ Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            families = [(name, help, list(family.values())) for name, (help, family) in sorted(self.metrics.items())]
+        for name, help, metrics in families:
+            name += metrics[0].suffix
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {metrics[0].kind}")
+            for metric in metrics:
+                for sample, value in metric.samples(name):
+                    lines.append(f"{sample} {value:g}" if isinstance(value, float) else f"{sample} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class MetricsServer:
+    """ Serves the registry on http://host:port/metrics from a daemon thread
+    """
+    def __init__(self, port, host="127.0.0.1", registry=registry):
+        metrics_registry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics_registry.expose().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        print(f"MetricsServer: serving on http://{self.server.server_address[0]}:{self.server.server_address[1]}/metrics")
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,177 @@
+""" Model weights shared by decoder processes.
+
+    The state dict of a model is exported once to a flat file: a JSON header with the name, dtype, shape and
+    offset of each tensor followed by the tensors aligned on 64 bytes. A process attaches the file with a copy
+    on write memory map: tensors are views of the page cache shared by all processes, nothing is unpickled or
+    copied. For pools of workers ModelHost goes further: the host process imports Torch and attaches the
+    weights once and workers are forked from it so that they share the runtime pages as well.
+
+        python modelhost.py export models/default.model     # writes models/default.flat
+        python modelhost.py bench --workers 4               # startup time and memory of each worker
+"""
+import argparse
+import collections
+import json
+import multiprocessing as mp
+import os, struct, time
+import numpy as np
+
+magic = b"MAWF"
+version = 1
+alignment = 64
+host = None # ModelHost of this process and of the workers forked from it
+
+
+def flat_name(model_file):
+    return os.path.splitext(model_file)[0] + ".flat"
+
+def export(state_dict, filename):
+    """ Writes a state dict (or the model file it is loaded from) to a flat weights file
+    """
+    import torch
+    if isinstance(state_dict, str):
+        state_dict = torch.load(state_dict, map_location=torch.device('cpu'))
+    arrays = [(name, tensor.detach().cpu().contiguous().numpy()) for name, tensor in state_dict.items()]
+    entries = []
+    offset = 0
+    for name, array in arrays:
+        offset = -(-offset // alignment) * alignment
+        entries.append({"name": name, "dtype": array.dtype.str, "shape": list(array.shape), "offset": offset})
+        offset += array.nbytes
+    header = json.dumps(entries).encode()
+    data_start = -(-(len(magic) + 8 + len(header)) // alignment) * alignment
+    tmp = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(magic + struct.pack("<II", version, len(header)) + header)
+        for entry, (name, array) in zip(entries, arrays):
+            f.seek(data_start + entry["offset"])
+            f.write(array.tobytes())
+    os.replace(tmp, filename) # readers never see a partial file
+
+def ensure_flat(model_file):
+    """ Flat weights file of a model file, exported if missing or older than the model file
+    """
+    if model_file.endswith(".flat"):
+        return model_file
+    filename = flat_name(model_file)
+    if not os.path.exists(filename) or os.path.getmtime(filename) < os.path.getmtime(model_file):
+        export(model_file, filename)
+        print(f"modelhost: exported {model_file} to {filename}")
+    return filename
+
+def attach(filename):
+    """ State dict of tensors mapped copy on write from a flat weights file
+    """
+    import torch
+    with open(filename, "rb") as f:
+        head = f.read(len(magic) + 8)
+        if head[:len(magic)] != magic:
+            raise ValueError(f"{filename} is not a flat weights file")
+        file_version, header_len = struct.unpack("<II", head[len(magic):])
+        if file_version != version:
+            raise ValueError(f"{filename}: unsupported version {file_version}")
+        entries = json.loads(f.read(header_len))
+    data_start = -(-(len(magic) + 8 + header_len) // alignment) * alignment
+    state_dict = collections.OrderedDict()
+    for entry in entries:
+        dtype = np.dtype(entry["dtype"])
+        shape = tuple(entry["shape"])
+        if int(np.prod(shape)) == 0:
+            state_dict[entry["name"]] = torch.from_numpy(np.zeros(shape, dtype=dtype))
+            continue
+        array = np.memmap(filename, dtype=dtype, mode="c", offset=data_start + entry["offset"], shape=shape)
+        state_dict[entry["name"]] = torch.from_numpy(array)
+    return state_dict
+
+def load_state(model, state_dict):
+    """ Model parameters become the given tensors instead of copies
+    """
+    model.load_state_dict(state_dict, assign=True)
+    model.eval()
+
+
+class ModelHost:
+    """ Host of the Torch runtime and attached weights for pools of worker processes forked from it.
+        Workers access the weights as modelhost.host.state_dict.
+    """
+    def __init__(self, model_file):
+        global host
+        import torch # imported before forking: pages are shared by the workers
+        self.flat_file = ensure_flat(model_file)
+        self.state_dict = attach(self.flat_file)
+        host = self
+
+    def pool(self, processes, initializer=None, initargs=()):
+        return mp.get_context("fork").Pool(processes, initializer, initargs)
+
+    def process(self, target, args=()):
+        return mp.get_context("fork").Process(target=target, args=args)
+
+    def predictions(self, **kwargs):
+        import predictions
+        preds = predictions.Predictions(**kwargs)
+        load_state(preds.model, self.state_dict)
+        return preds
+
+
+def memory():
+    """ Resident and private (unique to the process) memory in bytes (Linux)
+    """
+    values = {}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                    values[parts[0][:-1]] = int(parts[1]) * 1024
+    except OSError:
+        return 0, 0
+    return values.get("Rss", 0), values.get("Private_Clean", 0) + values.get("Private_Dirty", 0)
+
+def bench_worker(mode, model_file, t_start, results):
+    import torch
+    if mode == "host":
+        preds = host.predictions(device=torch.device('cpu'))
+    else:
+        import predictions
+        preds = predictions.Predictions(device=torch.device('cpu'))
+        preds.load_model(model_file if mode == "load" else flat_name(model_file))
+    preds.new_data(np.zeros(preds.look_back + 41, dtype=np.float32))
+    results.put((time.time() - t_start,) + memory())
+
+def bench(args):
+    ensure_flat(args.model)
+    print(f"{'mode':>6s} {'startup s':>10s} {'RSS MB':>8s} {'private MB':>11s}")
+    for mode in ("load", "attach", "host"):
+        if mode == "host":
+            model_host = ModelHost(args.model)
+            ctx = mp.get_context("fork")
+        else:
+            ctx = mp.get_context("spawn") # fresh interpreter like separate decoder processes
+        results = ctx.Queue()
+        stats = []
+        for w in range(args.workers): # one at a time: the startup of a worker is not slowed by the others
+            p = ctx.Process(target=bench_worker, args=(mode, args.model, time.time(), results))
+            p.start()
+            stats.append(results.get())
+            p.join()
+        startup, rss, private = np.mean(stats, axis=0)
+        print(f"{mode:>6s} {startup:10.3f} {rss/2**20:8.1f} {private/2**20:11.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Flat weights files shared by decoder processes")
+    parser.add_argument("command", choices=("export", "bench"), help="export: write the flat file of a model, bench: compare worker startup and memory")
+    parser.add_argument("model", nargs="?", default="models/default.model", help="Model weights (default models/default.model)")
+    parser.add_argument("--output", help="Flat weights file (default: model file with .flat extension)")
+    parser.add_argument("--workers", type=int, default=3, help="Workers started per mode by bench (default 3)")
+    args = parser.parse_args()
+    if args.command == "export":
+        filename = args.output if args.output else flat_name(args.model)
+        export(args.model, filename)
+        print(f"Exported {args.model} to {filename} ({os.path.getsize(filename)} bytes)")
+    else:
+        bench(args)
+
+
+if __name__ == '__main__':
+    main()
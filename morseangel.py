@@ -1,17 +1,36 @@
-import os, sys
+import os, sys, time
+startup_time = time.perf_counter()
+import argparse
 import queue
 from PyQt5 import QtCore, QtWidgets, QtGui, QtMultimedia
 from PyQt5.QtGui import QPalette, QColor, QTextCursor
 from PyQt5.QtCore import Qt, QObject, QThread, pyqtSignal
-import matplotlib.pyplot as plt
-import matplotlib.lines as mlines
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg, NavigationToolbar2QT
-from matplotlib.figure import Figure
 import numpy as np
-from scipy.signal import periodogram, spectrogram
-import audiodialog, controls, predictions, predworker
-sys.path.append('./notebooks')
-from peakdetect import peakdet
+import audiodialog, controls, predworker, dsp, sources, netaudio, metrics, tracing, latency, recorder, resources, spots, textserver, transcripts
+
+
+class StartupProfile:
+    """ Time of startup steps from the start of the script. When enabled steps are printed as they are
+        reached and the main thread is profiled until the window shows.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.profile = None
+        if enabled:
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def mark(self, step):
+        if self.enabled:
+            print(f"Startup: {step} at {time.perf_counter() - startup_time:.3f} s")
+
+    def stop_profile(self, nb_lines=20):
+        if self.profile:
+            import pstats
+            self.profile.disable()
+            pstats.Stats(self.profile).sort_stats("cumulative").print_stats(nb_lines)
+            self.profile = None
 
 
 def get_audioin_devices():
@@ -21,32 +40,6 @@ def print_devices(devices):
     for device in devices:
         print(device.deviceName(), device.supportedSampleRates())
 
-def specimg(Fs, signal, tone, nfft, noverlap, wbins, complex=False):
-    """ Create spectral image around tone frequency
-    """
-    nperseg = nfft if nfft < 256 or noverlap >= 256 else 256
-    f, t, Sxx = spectrogram(signal, Fs, nfft=nfft, noverlap=noverlap, nperseg=nperseg, scaling='density')
-    fbin = (tone/(Fs/2))* (len(f)-1)
-    if complex:
-        fbin /= 2
-    center_bin = int(round(fbin))
-    return f[center_bin-wbins:center_bin+wbins+1], t, Sxx[center_bin-wbins:center_bin+wbins+1,:]
-
-def nb_samples_per_dit_decim(Fs=8000, code_speed=13, decim=7.69):
-    """ One dit of time at w wpm is 1.2/w.
-        Returns a tuple (raw samples per dit, expected decimation factor)
-        Overlap is nfft - decimation factor
-    """
-    t_dit = 1.2 / code_speed
-    return int(t_dit * Fs), int(t_dit * Fs) / decim
-
-def fft_optim(Fs=8000, code_speed=13, decim=7.69):
-    spd, fft_decim = nb_samples_per_dit_decim(Fs, code_speed, decim)
-    log2_spd = np.log(spd) / np.log(2)
-    nfft = 2**int(log2_spd-1)
-    noverlap = nfft - round(fft_decim)
-    return nfft, noverlap
-
 def make_palette():
     """ Make theme like SDRangel's
     """
@@ -71,162 +64,12 @@ def make_palette():
     return palette
 
 
-class MplTimeCanvas(FigureCanvasQTAgg):
-
-    def __init__(self, parent=None, width=5, height=4, dpi=100):
-        self.fig = Figure(figsize=(width, height), dpi=dpi)
-        self.axes = self.fig.add_subplot(111)
-        self.axes.grid(which='both', color="gray", alpha=0.8)
-        self.axes.set_xlabel(u'samples')
-        self.fig.tight_layout(pad=1)
-        self.time_line = None
-        self.zline0 = None
-        self.zline1 = None
-        super(MplTimeCanvas, self).__init__(self.fig)
-
-    def set_mp(self, nsamples):
-        self.time_vect = np.arange(nsamples)
-        self.axes.set_ylim(-1, 1)
-        self.axes.set_xlim(0, nsamples)
-        if self.time_line:
-            while (len(self.axes.lines) > 0):
-                self.axes.lines.pop(0)
-        self.zline0 = None
-        self.zline1 = None
-        self.time_line, = self.axes.plot(self.time_vect, np.ones_like(self.time_vect)/2, color="yellow", alpha=0.8)
-        self.draw()
-
-    def new_data(self, data, zoom_span=0):
-        plotdata = self.time_line.get_data()[1]
-        nb_samples = len(data)
-        plotdata = np.roll(plotdata, -nb_samples, axis=0)
-        plotdata[-nb_samples:] = data
-        ymin = min(plotdata)
-        ymax = max(plotdata)
-        self.axes.set_ylim(ymin*1.2, ymax*1.2)
-        self.time_line.set_data(self.time_vect, plotdata)
-        if zoom_span:
-            if self.zline0:
-                self.zline0.remove()
-            if self.zline1:
-                self.zline1.remove()
-            x0 = len(plotdata) - nb_samples
-            x1 = x0 + zoom_span
-            l0 = mlines.Line2D([x0,x0], [ymin,ymax], color="red")
-            l1 = mlines.Line2D([x1,x1], [ymin,ymax], color="red")
-            self.zline0 = self.axes.add_line(l0)
-            self.zline1 = self.axes.add_line(l1)
-        self.draw()
-
-
-class MplPredCanvas(FigureCanvasQTAgg):
-
-    def __init__(self, parent=None, width=5, height=4, dpi=100):
-        self.fig = Figure(figsize=(width, height), dpi=dpi)
-        self.axes = self.fig.add_subplot(111)
-        self.axes.grid(which='both', color="gray", alpha=0.8)
-        self.axes.set_ylim(0, 3)
-        self.fig.tight_layout(pad=1)
-        self.colors = ["yellow", "lime", "lightsalmon", "lime", "lightsalmon", "cornflowerblue", "yellow", "fuchsia"]
-        super(MplPredCanvas, self).__init__(self.fig)
-
-    def set_mp(self, nsamples, max_ele=5):
-        self.nsamples = nsamples
-        self.max_ele = max_ele
-        self.lines = np.zeros((max_ele+3, nsamples))
-        self.labels = ["in", "cs", "ws"]
-        for i in range(max_ele):
-            self.labels.append(f"e{i}")
-        self.axes.set_xlim(0, nsamples)
-
-    def new_data(self, in_data, pred_data):
-        self.lines[0] = np.roll(self.lines[0], -len(in_data), axis=0)
-        self.lines[0][-len(in_data):] = in_data
-        xmax = len(pred_data[0])
-        for i in range(1, self.max_ele+3):
-            self.lines[i] = np.roll(self.lines[i], -xmax, axis=0)
-            self.lines[i][-xmax:] = pred_data[i-1]
-        while (len(self.axes.lines) > 0):
-            self.axes.lines.pop(0)
-        for i in range(self.max_ele+3):
-            if i == 0:
-                y = 0
-            elif i < 3:
-                y = 1
-            else:
-                y = 2
-            self.axes.plot(self.lines[i]*0.9 + y, label=self.labels[i], color=self.colors[i], alpha=0.8)
-        self.axes.legend(bbox_to_anchor=(-0.1, 1.1), loc='upper left')
-        self.draw()
-
-
-class MplPeakCanvas(FigureCanvasQTAgg):
-
-    def __init__(self, parent=None, width=5, height=4, dpi=100):
-        self.fig = Figure(figsize=(width, height), dpi=dpi)
-        self.axes = self.fig.add_subplot(111)
-        self.axes.grid(which='both', color="gray")
-        self.axes.set_xlabel(u'F (Hz)')
-        self.axes.set_ylabel(u'Amplitude (log)')
-        self.axes.set_yscale('log')
-        self.fig.tight_layout(pad=1)
-        self.spec_line = None
-        super(MplPeakCanvas, self).__init__(self.fig)
-
-    def set_mp(self, audio_rate):
-        if self.spec_line:
-            self.axes.lines.pop(0)
-        self.spec_line = None
-        self.axes.set_xlim(0, audio_rate/2)
-
-    def new_data(self, f, s, maxtab, tone):
-        if not self.spec_line:
-            self.spec_line, = self.axes.plot(f[0:int(len(f)/2-1)], abs(s[0:int(len(s)/2-1)]),'g-', color="lime", alpha=0.8)
-        else:
-            self.spec_line.set_data(f[0:int(len(f)/2-1)], abs(s[0:int(len(s)/2-1)]))
-        pmax = max(s)
-        self.axes.set_ylim(1e-5, pmax)
-        self.axes.set_xlabel(f'F (Hz) \u2191 {tone:9.5f} ({10*np.log10(pmax):5.2f} dB)')
-        #self.fig.suptitle(f"Signal peak {10*np.log10(pmax):5.2f} dB found at {tone:9.5f} Hz")
-        self.draw()
-
-
-class MplHistCanvas(FigureCanvasQTAgg):
-
-    def __init__(self, parent=None, width=5, height=4, dpi=150):
-        self.fig = Figure(figsize=(width, height), dpi=dpi)
-        self.axes = self.fig.add_subplot(111)
-        self.axes.grid(which='both', color="gray")
-        self.ylim = 50
-        self.xlim = 40
-        self.axes.set_ylim(0, self.ylim)
-        self.axes.set_xlim(0, self.xlim)
-        lditl = mlines.Line2D([11,11], [0,self.ylim], color="red", linestyle="--")
-        ldits = mlines.Line2D([17,17], [0,self.ylim], color="red")
-        ldith = mlines.Line2D([23,23], [0,self.ylim], color="red", linestyle="--")
-        ldahl = mlines.Line2D([25,25], [0,self.ylim], color="yellow", linestyle="--")
-        ldahs = mlines.Line2D([32,32], [0,self.ylim], color="yellow")
-        self.axes.add_line(lditl)
-        self.axes.add_line(ldits)
-        self.axes.add_line(ldith)
-        self.axes.add_line(ldahl)
-        self.axes.add_line(ldahs)
-        self.fig.tight_layout(pad=1)
-        self.hbars = None
-        super(MplHistCanvas, self).__init__(self.fig)
-
-    def new_data(self, his):
-        max_his = int(max(his)) + 1
-        if self.hbars:
-            t = [b.remove() for b in self.hbars]
-        self.hcounts, self.hbins, self.hbars = self.hist = self.axes.hist(his, bins=max_his, color="lightskyblue")
-        self.draw()
-
-
 class MainWindow(QtWidgets.QMainWindow):
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, options, startup=None, *args, **kwargs):
         super(MainWindow, self).__init__(*args, **kwargs)
+        self.options = options
+        self.startup = startup if startup else StartupProfile()
         self.audio_devices = get_audioin_devices()
         self.audio_device = QtMultimedia.QAudioDeviceInfo.defaultInputDevice()
         self.audio_rates = self.audio_device.supportedSampleRates()
@@ -234,31 +77,90 @@ class MainWindow(QtWidgets.QMainWindow):
         self.audio_input = None
         self.audio_buffer = None
         self.audio_bytes = None
-        self.nfft_peak = 1024*16
-        self.peak_signal = np.zeros((self.nfft_peak*2))
-        self.peak_signal_index = 0
+        self.iq = options.iq or options.iq_file is not None # complex I/Q input
+        self.sample_source = None
+        if options.udp_audio:
+            self.sample_source = netaudio.UDPAudioSource(options.udp_audio, options.udp_host, options.udp_rate, options.udp_channels,
+                options.udp_format, options.iq, options.jitter)
+            self.audio_rate = options.udp_rate
+            self.iq = self.sample_source.iq
+        if options.iq_file:
+            self.sample_source = sources.IQFileSource(options.iq_file, options.iq_rate, options.iq_format)
+            self.audio_rate = options.iq_rate
+        if options.replay:
+            self.sample_source = recorder.ReplaySource(options.replay, options.replay_fast)
+            self.set_replay_format(self.sample_source.format)
+        self.recorder = recorder.SessionRecorder(options.record) if options.record else None
+        self.nb_input_samples = 0 # input samples since start
+        self.input_time = time.time() # wall clock time of the last input sample
         self.wpm = 17
-        self.nfft = 256
-        self.noverlap = 183
-        self.nperseg = 256
-        self.thr = 1e-9
-        self.thr_count = 0
-        self.img_norm = 1
-        self.pred_len = 0
-        self.predictions = predictions.Predictions()
+        # decimation to the processing rate, tone (frequency of the decoded signal), squelch and envelope. Set up for the input by set_processing
+        self.front_end = dsp.ToneFrontEnd(iq=self.iq, proc_rate=options.proc_rate, squelch_open=options.squelch_open, squelch_close=options.squelch_close)
+        self.text_server = textserver.from_args(options)
+        self.transcripts = transcripts.from_args(options)
+        self.spot_extractor = spots.from_args(options, self.report_spot)
+        self.predictions = None # loaded in background
+        self.model_ready = False
         self.script_dir = os.path.dirname(os.path.realpath(__file__))
-        self.predictions.load_model(os.path.join(self.script_dir, "models", "default.model"))
         self.dataq = queue.Queue()
-        self.predworker = predworker.PredictionsWorker(self.predictions, self.dataq)
+        self.predworker = predworker.PredictionsWorker(None, self.dataq, None, options.auto_dit)
         self.predthread = QThread(self)
+        self.init_metrics()
+        self.startModelLoader()
         self.initUI()
         self.startPredWorker()
 
+    def startModelLoader(self):
+        model_file = self.options.model if self.options.model else os.path.join(self.script_dir, "models", "default.model")
+        self.loader = predworker.ModelLoader(model_file, self.options.dict, self.options.correct)
+        self.loaderthread = QThread(self)
+        self.loader.moveToThread(self.loaderthread)
+        self.loaderthread.started.connect(self.loader.run)
+        self.loader.ready.connect(self.model_loaded)
+        self.loader.failed.connect(self.model_failed)
+        self.loaderthread.start()
+
+    def model_loaded(self, preds, word_corrector, timings):
+        self.loaderthread.quit()
+        self.predictions = preds
+        self.predictions.set_post_filter(self.options.post_filter, self.options.post_len)
+        self.predworker.set_models(preds, word_corrector)
+        self.model_ready = True
+        self.nnLabel.setText(f"NN {preds.device} ready")
+        for step, seconds in timings:
+            self.startup.mark(f"{step} ({seconds:.3f} s in loader)")
+        self.startup.mark("model ready")
+
+    def model_failed(self, message):
+        self.loaderthread.quit()
+        self.nnLabel.setText("NN failed")
+        print(f"Model loading failed: {message}")
+
+    def init_metrics(self):
+        registry = metrics.registry
+        self.m_interval = registry.histogram("input_block_interval_seconds", "Time between input blocks")
+        self.m_dropped = registry.counter("dropped_samples", "Input samples dropped because more than one block was pending")
+        self.m_rtf = registry.gauge("real_time_factor", "Processing time over duration of input blocks (averaged)")
+        self.m_dataq = registry.gauge("dataq_depth", "Envelope blocks waiting for the predictions worker")
+        self.t_process = registry.timer("process")
+        self.t_render = registry.timer("render")
+        self.last_block_time = None
+        self.metrics_server = None
+        if self.options.metrics_port:
+            self.metrics_server = metrics.MetricsServer(self.options.metrics_port)
+            self.metrics_server.start()
+
+    def show_metrics(self):
+        nn_time = metrics.registry.stage("predictions").mean
+        char_latency = self.predworker.latency.h_total.mean
+        self.metricsLabel.setText(f'RTF {self.m_rtf.value:.2f} Q {self.m_dataq.value} NN {nn_time*1000:.1f} ms drop {self.m_dropped.value} lat {char_latency:.2f} s')
+
     def startPredWorker(self):
         self.predworker.moveToThread(self.predthread)
         self.predthread.started.connect(self.predworker.run)
         self.predworker.dataReady.connect(self.pred_data)
         self.predworker.newChar.connect(self.new_char)
+        self.predworker.wordCorrected.connect(self.correct_word)
         self.predthread.start()
 
     def stopPredWorker(self):
@@ -268,21 +170,71 @@ class MainWindow(QtWidgets.QMainWindow):
         print("stopPredWorker: done")
 
     def quitApplication(self):
+        if self.sample_source:
+            self.sample_source.stop()
+        if self.recorder:
+            self.recorder.close()
         self.stopPredWorker()
+        self.loaderthread.quit()
+        self.loaderthread.wait()
+        if self.metrics_server:
+            self.metrics_server.stop()
+        if self.text_server:
+            self.text_server.stop()
+        if self.transcripts:
+            self.transcripts.close()
+        tracing.tracer.stop()
+        print(self.predworker.latency.summary())
+        if self.options.latency_report:
+            self.predworker.latency.save_csv(self.options.latency_report)
+        squelch = self.front_end.squelch
+        print(f"Inference duty cycle {squelch.duty_cycle()*100:.1f}% ({squelch.nb_open_blocks}/{squelch.nb_blocks} blocks)")
         print("About to quit")
         QtWidgets.qApp.quit()
 
     def pred_data(self):
-        self.sc_pred.new_data(self.predictions.cbuffer, self.predictions.p_preds_t)
-        self.sc_hist.new_data(self.predworker.decoder.his)
-
-    def new_char(self, char):
+        with self.t_render:
+            self.predworker.ready_hop.receive()
+            decoder = self.predworker.decoder
+            if hasattr(decoder, "his"):
+                self.sc_pred.new_data(self.predictions.cbuffer, self.predictions.p_preds_t)
+                self.sc_hist.new_data(decoder.his.counts(), decoder.his.edges, decoder.dit_len)
+            else: # character outputs of a CTC model
+                self.sc_pred.new_data(self.predictions.cbuffer, decoder.signals(self.predictions.p_preds_t))
+
+    def new_char(self, char, keyed, delay):
+        with tracing.tracer.span("new_char"):
+            self.predworker.char_hop.receive()
+            cursor = QTextCursor(self.textbox.document())
+            cursor.movePosition(QTextCursor.End)
+            cursor.insertText(char)
+        if self.text_server:
+            self.text_server.publish_char(char, keyed, delay, self.options.dial_freq + self.front_end.tone)
+        if self.transcripts:
+            self.transcripts.add_char("audio", char, keyed, self.options.dial_freq + self.front_end.tone)
+        if self.spot_extractor:
+            wpm = self.wpm * 8 / self.predworker.decoder.dit_len
+            self.spot_extractor.add_char(0, char, self.options.dial_freq + self.front_end.tone, wpm, self.front_end.squelch.snr_db, keyed)
+
+    def report_spot(self, spot):
+        print(spot)
+        self.statusLabel.setText(f"Spot {spot.call} {spot.freq/1000:.1f} kHz")
+        if self.text_server:
+            self.text_server.publish(spot.as_dict(), str(spot))
+
+    def correct_word(self, word, corrected):
+        """ Replace the word just decoded at the end of text by its correction
+        """
         cursor = QTextCursor(self.textbox.document())
         cursor.movePosition(QTextCursor.End)
-        cursor.insertText(char)
+        cursor.movePosition(QTextCursor.Left, QTextCursor.KeepAnchor, len(word))
+        if cursor.selectedText() == word:
+            cursor.insertText(corrected)
 
     def initUI(self):
-        plt.style.use('dark_background')
+        import matplotlib.style, plots # matplotlib is imported with the plots, not with the application
+        matplotlib.style.use('dark_background')
+        self.startup.mark("plots imported")
         self.setWindowIcon(QtGui.QIcon(os.path.join(self.script_dir, 'doc', 'img', 'MorseAngel_icon.png')))
         exitAct = QtWidgets.QAction('&Exit', self)
         exitAct.setShortcut('Ctrl+Q')
@@ -294,10 +246,17 @@ class MainWindow(QtWidgets.QMainWindow):
         self.statusLabel = QtWidgets.QLabel(self)
         self.fftLabel = QtWidgets.QLabel(self)
         self.nnLabel = QtWidgets.QLabel(self)
-        self.nnLabel.setText(f"NN {self.predictions.device}")
+        self.nnLabel.setText("NN loading")
         self.statusBar().addWidget(self.statusLabel)
         self.statusBar().addWidget(self.fftLabel)
         self.statusBar().addWidget(self.nnLabel)
+        self.squelchLabel = QtWidgets.QLabel(self)
+        self.statusBar().addWidget(self.squelchLabel)
+        self.metricsLabel = QtWidgets.QLabel(self)
+        self.statusBar().addWidget(self.metricsLabel)
+        self.metrics_timer = QtCore.QTimer(self)
+        self.metrics_timer.timeout.connect(self.show_metrics)
+        self.metrics_timer.start(1000)
         self.statusLabel.setText('Ready')
 
         menubar = self.menuBar()
@@ -309,8 +268,8 @@ class MainWindow(QtWidgets.QMainWindow):
         vbox = QtWidgets.QVBoxLayout()
         # line 1
         hbo1 = QtWidgets.QHBoxLayout()
-        self.sc_time = MplTimeCanvas(self, width=5, height=2, dpi=100)
-        self.sc_peak = MplPeakCanvas(self, width=4.5, height=2, dpi=100)
+        self.sc_time = plots.MplTimeCanvas(self, width=5, height=2, dpi=100)
+        self.sc_peak = plots.MplPeakCanvas(self, width=4.5, height=2, dpi=100)
         self.controls = controls.ControlWidget()
         self.controls.wpmSignal.connect(self.wpmChange)
         self.controls.thrSignal.connect(self.thrChange)
@@ -321,8 +280,8 @@ class MainWindow(QtWidgets.QMainWindow):
         hbo1_widget.setLayout(hbo1)
         # line 2
         hbo2 = QtWidgets.QHBoxLayout()
-        self.sc_tenv = MplTimeCanvas(self, width=5, height=2, dpi=100)
-        self.sc_zenv = MplTimeCanvas(self, width=5, height=2, dpi=100)
+        self.sc_tenv = plots.MplTimeCanvas(self, width=5, height=2, dpi=100)
+        self.sc_zenv = plots.MplTimeCanvas(self, width=5, height=2, dpi=100)
         hbo2.addWidget(self.sc_tenv, 2)
         hbo2.addWidget(self.sc_zenv, 1)
         hbo2_widget = QtWidgets.QWidget()
@@ -332,14 +291,14 @@ class MainWindow(QtWidgets.QMainWindow):
         self.textbox = QtWidgets.QTextEdit(self)
         font = QtGui.QFont("Monospace")
         self.textbox.setFont(font)
-        self.sc_hist = MplHistCanvas(self, width=5, height=2, dpi=100)
+        self.sc_hist = plots.MplHistCanvas(self, width=5, height=2, dpi=100)
         hbo3.addWidget(self.textbox, 2)
         hbo3.addWidget(self.sc_hist, 1)
         hbo3_widget = QtWidgets.QWidget()
         hbo3_widget.setLayout(hbo3)
         # line 4
         hbo4 = QtWidgets.QHBoxLayout()
-        self.sc_pred = MplPredCanvas(self, width=5, height=2.5, dpi=100)
+        self.sc_pred = plots.MplPredCanvas(self, width=5, height=2.5, dpi=100)
         hbo4.addWidget(self.sc_pred)
         hbo4_widget = QtWidgets.QWidget()
         hbo4_widget.setLayout(hbo4)
@@ -356,11 +315,17 @@ class MainWindow(QtWidgets.QMainWindow):
         self.setWindowTitle('MorseAngel')
         self.show()
 
-        self.initTEnv()
+        self.startup.mark("window shown")
         self.initZEnv()
+        if self.sample_source:
+            self.start_sample_source()
+        else:
+            self.set_audio_device()
+        self.startup.mark("audio started")
+        self.startup.stop_profile()
 
     def initTEnv(self):
-        tenv_size = (self.audio_rate//(self.nfft-self.noverlap)) * 4
+        tenv_size = (int(self.front_end.sample_rate)//(self.front_end.nfft-self.front_end.noverlap)) * 4
         self.sc_tenv.set_mp(tenv_size)
         #print(f"Init tenv {tenv_size}")
 
@@ -385,86 +350,163 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def wpmChange(self, wpm):
         self.wpm = wpm
-        self.nfft, self.noverlap = fft_optim(Fs=self.audio_rate, code_speed=self.wpm)
-        self.fftLabel.setText(f'FFT {self.nfft} OVL {self.noverlap}')
         self.set_audio_device()
 
     def thrChange(self, thr):
-        self.thr = thr*0.9
+        self.front_end.thr = thr*0.9
+
+    def set_processing(self):
+        """ Set up processing for the current input rate. Input is decimated to the processing rate that only
+            needs to cover the CW audio bandwidth whatever the sound card rate, and one STFT feeds peak detection,
+            spectrum display and envelope extraction.
+        """
+        self.front_end.configure(self.audio_rate, self.wpm, self.iq)
+        self.stft_origin = self.nb_input_samples # input sample index of the first STFT sample
+        front_end = self.front_end
+        self.fftLabel.setText(f'FFT {front_end.nfft} OVL {front_end.noverlap} @ {front_end.sample_rate} S/s')
+        self.sc_pred.set_mp(front_end.peak_frames*3)
+        self.sc_time.set_mp(front_end.nsamples)
+        self.sc_peak.set_mp(front_end.sample_rate, self.iq)
+        self.initTEnv()
+        self.predworker.reset_hist()
+
+    def start_sample_source(self):
+        """ Samples from other sources than the sound card are polled from the GUI thread
+        """
+        self.statusLabel.setText(f'{self.sample_source.__class__.__name__} {self.audio_rate} S/s')
+        self.set_processing()
+        self.sample_source.start()
+        self.source_timer = QtCore.QTimer(self)
+        self.source_timer.timeout.connect(self.sourceRead)
+        fast = getattr(self.sample_source, "fast", False)
+        self.source_timer.start(0 if fast else 50) # as fast as possible: whenever the GUI is idle
+        self.source_start = time.perf_counter()
+        self.nb_source_samples = 0
+
+    def set_replay_format(self, format):
+        """ Device format of a replayed session
+        """
+        self.audio_rate = format["rate"]
+        self.audio_bytes = format["bytes_per_frame"]
+        self.audio_nsamples = self.audio_rate//2
+        self.iq = format["iq"]
+
+    def sourceRead(self):
+        for block in self.sample_source.get_blocks():
+            if isinstance(block, dict): # device format change recorded in a replayed session
+                print(f"sourceRead: format change {block}")
+                self.set_replay_format(block)
+                self.set_processing()
+            elif self.sample_source.raw:
+                self.audio_block(block)
+                self.nb_source_samples += len(block)//self.audio_bytes
+            else:
+                self.process_samples(block)
+                self.nb_source_samples += len(block)
+        if self.sample_source.finished():
+            self.source_timer.stop()
+            elapsed = time.perf_counter() - self.source_start
+            duration = self.nb_source_samples / self.audio_rate
+            print(f"sourceRead: {duration:.1f} s of input processed in {elapsed:.1f} s ({duration/elapsed:.1f}x real time)")
 
     def set_audio_device(self):
+        if self.sample_source:
+            self.set_processing()
+            return
         format = QtMultimedia.QAudioFormat()
         format.setSampleRate(self.audio_rate)
-        format.setChannelCount(1)
+        format.setChannelCount(2 if self.iq else 1) # I/Q on left/right channels
         format.setByteOrder(QtMultimedia.QAudioFormat.LittleEndian)
         format.setSampleType(QtMultimedia.QAudioFormat.Float)
         if (self.audio_device.isFormatSupported(format) is not True):
             format = self.audio_device.nearestFormat(format)
         self.audio_rate = format.sampleRate()
         self.audio_bytes = format.bytesPerFrame()
+        if self.recorder:
+            self.recorder.set_format(self.audio_rate, format.channelCount(), self.audio_bytes, iq=self.iq)
         if self.audio_input:
             self.audio_input.stop()
         else:
             print("Init Audio")
         self.audio_input = QtMultimedia.QAudioInput(self.audio_device, format)
         self.audio_nsamples = self.audio_rate//2
-        self.nfft, self.noverlap = fft_optim(Fs=self.audio_rate, code_speed=self.wpm)
-        self.fftLabel.setText(f'FFT {self.nfft} OVL {self.noverlap}')
-        #print(f"FFT {self.nfft} with overlap {self.noverlap}")
-        self.sc_time.set_mp(self.audio_nsamples)
-        self.sc_peak.set_mp(self.audio_rate)
+        self.set_processing()
         self.audio_input.setBufferSize(self.audio_nsamples)
-        self.initTEnv()
         self.audio_buffer = self.audio_input.start()
         self.audio_buffer.readyRead.connect(self.audioRead)
-        self.predworker.reset_hist()
+
+    def show_squelch(self):
+        squelch = self.front_end.squelch
+        snr = f"{squelch.snr_db:5.1f} dB" if squelch.snr_db is not None else "   -- dB"
+        state = "open" if squelch.is_open else "closed"
+        self.squelchLabel.setText(f'SQL {state} SNR {snr} NN duty {squelch.duty_cycle()*100:3.0f}%')
 
     def audioRead(self):
         buffer_bytes = self.audio_buffer.readAll()
         if buffer_bytes:
-            buffer_bytes = buffer_bytes[:self.audio_nsamples*self.audio_bytes] # truncate
-            data = np.frombuffer(buffer_bytes, dtype=np.single)
-            if max(data) > 0:
-                #print(type(data), data.shape)
-                data /= max(max(data), -min(data))
-                # data /= (max(data)/2.0)
-                # data[data > 1] = 1
-                # data[data < -1] = -1
-                self.sc_time.new_data(data)
-                nb_samples = len(buffer_bytes) // self.audio_bytes
-                self.peak_signal[self.peak_signal_index:self.peak_signal_index+nb_samples] = data
-                self.peak_signal_index += nb_samples
-                if self.peak_signal_index > self.nfft_peak:
-                    f, s = periodogram(self.peak_signal, self.audio_rate, 'blackman', self.nfft_peak, 'linear', False, scaling='spectrum')
-                    threshold = max(s)*0.9
-                    if threshold > self.thr:
-                        self.thr_count = 2
-                    else:
-                        if self.thr_count > 0:
-                            self.thr_count -= 1
-                    if self.thr_count > 0:
-                        maxtab, mintab = peakdet(abs(s[0:int(len(s)/2-1)]), threshold, f[0:int(len(f)/2-1)])
-                        tone = maxtab[0,0]
-                        #print(f'tone: {tone} thr: {(10.0 * np.log10(threshold)):.2f} dB')
-                        self.sc_peak.new_data(f, s, maxtab, tone)
-                        nside_bins = 1
-                        f, t, img = specimg(self.audio_rate, self.peak_signal[:self.nfft_peak], tone, self.nfft, self.noverlap, nside_bins)
-                        #print(t.shape, f)
-                        if len(f) != 0:
-                            img_line = np.sum(img, axis=0)
-                            if threshold > self.thr: # update scaling factor if signal present
-                                self.img_norm = max(img_line)/1.5
-                            img_line /= self.img_norm
-                            img_line[img_line > 1] = 1
-                            if len(img_line) != self.pred_len:
-                                self.pred_len = len(img_line)
-                                self.sc_pred.set_mp(self.pred_len*3)
-                            self.dataq.put(img_line)
-                            #self.test_line(img_line, 0.75)
-                            self.sc_tenv.new_data(img_line, 50)
-                            self.sc_zenv.new_data(img_line[:50])
-                    self.peak_signal = np.roll(self.peak_signal, self.nfft_peak, axis=0)
-                    self.peak_signal_index -= self.nfft_peak
+            if self.recorder:
+                self.recorder.write(bytes(buffer_bytes))
+            self.audio_block(buffer_bytes)
+
+    def audio_block(self, buffer_bytes):
+        """ Takes bytes as read from the sound card or replayed from a recorded session
+        """
+        if len(buffer_bytes) > self.audio_nsamples*self.audio_bytes:
+            self.m_dropped.inc(len(buffer_bytes)//self.audio_bytes - self.audio_nsamples)
+        buffer_bytes = buffer_bytes[:self.audio_nsamples*self.audio_bytes] # truncate
+        data = np.frombuffer(buffer_bytes, dtype=np.single)
+        if self.iq:
+            data = sources.iq_from_interleaved(data)
+        self.process_samples(data)
+
+    def process_samples(self, data):
+        """ Takes a block of samples at input rate, real or complex (I/Q)
+        """
+        now = time.perf_counter()
+        if self.last_block_time is not None:
+            self.m_interval.observe(now - self.last_block_time)
+        self.last_block_time = now
+        self.nb_input_samples += len(data)
+        self.input_time = time.time()
+        with self.t_process:
+            self.process_block(data)
+        rtf = self.t_process.histogram.last * self.audio_rate / max(len(data), 1)
+        self.m_rtf.set(self.m_rtf.value + 0.1*(rtf - self.m_rtf.value))
+        self.m_dataq.set(self.dataq.qsize())
+
+    def process_block(self, data):
+        events = self.front_end.process(data)
+        front_end = self.front_end
+        with self.t_render:
+            if front_end.samples is not None:
+                self.sc_time.new_data(front_end.samples.real)
+            if front_end.peaks is not None:
+                f, s, maxtab = front_end.peaks
+                self.sc_peak.new_data(f, s, maxtab, front_end.tone)
+        self.show_squelch()
+        if not self.model_ready:
+            return
+        for kind, img_line, tone, snr_db in events:
+            self.predworker.dataq_hop.send()
+            if kind == "reset":
+                self.dataq.put(None) # signal gone: restart predictions and decoder from a clean state
+                if self.transcripts:
+                    self.transcripts.end_channel("audio")
+                continue
+            self.dataq.put((img_line, self.envelope_stamp(front_end.first_frame)))
+            #self.test_line(img_line, 0.75)
+            with self.t_render:
+                self.sc_tenv.new_data(img_line, 50)
+                self.sc_zenv.new_data(img_line[:50])
+
+    def envelope_stamp(self, first_frame):
+        """ Input sample index and wall clock time of the center of the first STFT frame of an envelope block
+        """
+        stft = self.front_end.stft
+        ratio = self.audio_rate / self.front_end.sample_rate
+        index = self.stft_origin + (first_frame*stft.hop + stft.nperseg/2)*ratio
+        sample_time = self.input_time - (self.nb_input_samples - index)/self.audio_rate
+        return latency.BlockStamp(index, stft.hop*ratio, sample_time, time.time(), self.audio_rate)
 
     @staticmethod
     def test_line(img_line, thr):
@@ -479,10 +521,49 @@ class MainWindow(QtWidgets.QMainWindow):
         print(dict(sorted(hist.items(), key=lambda item: item[1], reverse=True)))
 
 
+def get_args():
+    parser = argparse.ArgumentParser(description="Morse decoder with deep neural network")
+    parser.add_argument("--iq", action="store_true", help="Sound card input is complex I/Q baseband on left (I) and right (Q) channels")
+    parser.add_argument("--iq-file", help="Read complex I/Q baseband from this file of interleaved I, Q samples or stdin with -")
+    parser.add_argument("--iq-format", default="float32", choices=list(sources.iq_dtypes.keys()), help="Sample format of I/Q file (default float32)")
+    parser.add_argument("--iq-rate", type=int, default=48000, help="Sample rate of I/Q file (default 48000)")
+    parser.add_argument("--udp-audio", type=int, help="Receive audio by UDP on this port instead of the sound card (SDRangel UDP audio output)")
+    parser.add_argument("--udp-host", default="0.0.0.0", help="Address to receive UDP audio on (default all)")
+    parser.add_argument("--udp-format", default="rtp", choices=netaudio.formats, help="UDP audio datagrams: RTP L16, raw int16 or raw float32 (default rtp)")
+    parser.add_argument("--udp-rate", type=int, default=48000, help="Sample rate of UDP audio (default 48000)")
+    parser.add_argument("--udp-channels", type=int, default=1, choices=(1, 2), help="UDP audio channels. Stereo is mixed to mono or I/Q with --iq (default 1)")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Jitter buffer depth in seconds for RTP audio (default 0.1)")
+    parser.add_argument("--metrics-port", type=int, help="Serve processing metrics in Prometheus text format on this local port")
+    parser.add_argument("--record", help="Record audio blocks as read from the sound card with their timing to this file")
+    parser.add_argument("--replay", help="Replay a recorded session instead of the sound card")
+    parser.add_argument("--replay-fast", action="store_true", help="Replay as fast as possible instead of the original timing")
+    parser.add_argument("--latency-report", help="Save keying time and delay of each decoded character to this CSV file on exit")
+    dsp.add_arguments(parser)
+    resources.add_arguments(parser)
+    textserver.add_arguments(parser)
+    transcripts.add_arguments(parser)
+    spots.add_arguments(parser)
+    parser.add_argument("--dial-freq", type=float, default=0.0, help="Dial frequency in Hz added to the audio tone for the frequency of decoded text and spots (default 0)")
+    parser.add_argument("--profile-startup", action="store_true", help="Print the time of startup steps and profile the main thread until the window shows")
+    parser.add_argument("--trace", help="Record processing spans to this Chrome trace-event JSON file (chrome://tracing, ui.perfetto.dev)")
+    parser.add_argument("--model", help="Model weights: LSTM stack or MorseTCN trained with train_tcn.py (default models/default.model)")
+    parser.add_argument("--auto-dit", action="store_true", help="Adjust the decoder dit length to the dit and dah peaks of the element length histogram")
+    parser.add_argument("--correct", action="store_true", help="Correct decoded words against built in Q-codes and abbreviations")
+    parser.add_argument("--dict", help="Correct decoded words against this list (one word per line) or compiled .dawg of callsigns. Implies --correct")
+    args, _ = parser.parse_known_args() # leave Qt options
+    return args
+
 def main():
+    options = get_args()
+    startup = StartupProfile(options.profile_startup)
+    startup.mark("imports")
+    resources.configure(options)
+    resources.pin("dsp")
+    if options.trace:
+        tracing.tracer.start(options.trace)
     app = QtWidgets.QApplication(sys.argv)
     app.setPalette(make_palette())
-    w = MainWindow()
+    w = MainWindow(options, startup)
     sys.exit(app.exec_())
 
 
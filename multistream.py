@@ -0,0 +1,370 @@
+""" Headless decoding of many audio streams in one process.
+
+    Each stream is read by an asyncio task from a URL:
+        udp://[host]:port       UDP audio like SDRangel's UDP audio output (see netaudio.py)
+        pipe:///path/to/fifo    named pipe written by another program that may restart
+        file:///path/to/file    file of samples read at the pace of the sample rate unless realtime=0
+    with options in the query: format (rtp, s16le or f32le; default rtp for udp else s16le), rate (48000),
+    channels (1), iq (1: stereo is I/Q), wpm (17), jitter (0.1 s) and dial (Hz added to the tone for spots).
+
+    The signal processing of each stream (decimation, spectrum, tone, squelch and envelope like the GUI) runs
+    on a thread pool shared by all streams. Envelopes waiting for inference are gathered from all streams and
+    run through the model as one batch per step (predictions.BatchedPredictions) in an inference thread, so
+    that one process serves many receivers:
+
+        python multistream.py rx1=udp://:9998 "rx2=udp://:9999?format=s16le&rate=8000" "rx3=file:///data/rx3.raw?realtime=0"
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import os, sys, time
+import urllib.parse
+import numpy as np
+import decoder, dsp, metrics, netaudio, resources, spots, textserver, transcripts
+
+
+class Stream:
+    def __init__(self, name, url, proc_rate=8000, squelch_open=1.8, squelch_close=1.5, block_time=0.1):
+        self.name = name
+        self.url = urllib.parse.urlsplit(url)
+        if self.url.scheme not in ("udp", "pipe", "file"):
+            raise ValueError(f"Stream {name}: unknown scheme in {url}")
+        query = dict(urllib.parse.parse_qsl(self.url.query))
+        self.sample_format = query.get("format", "rtp" if self.url.scheme == "udp" else "s16le")
+        if self.sample_format not in netaudio.formats:
+            raise ValueError(f"Stream {name}: unknown format {self.sample_format}")
+        self.rate = int(query.get("rate", 48000))
+        self.channels = int(query.get("channels", 1))
+        self.iq = query.get("iq", "0") == "1" and self.channels == 2
+        self.wpm = float(query.get("wpm", 17))
+        self.jitter = float(query.get("jitter", 0.1))
+        self.dial = float(query.get("dial", 0.0))
+        self.realtime = query.get("realtime", "1") == "1"
+        self.block_len = max(int(self.rate*block_time), 1)
+        self.front_end = dsp.ToneFrontEnd(self.rate, self.iq, self.wpm, proc_rate, squelch_open, squelch_close)
+        self.decoder = decoder.MorseDecoderRegen(res_len=1000)
+        self.udp = None
+        if self.url.scheme == "udp":
+            self.udp = netaudio.UDPAudioSource(self.url.port, self.url.hostname or "0.0.0.0", self.rate, self.channels,
+                self.sample_format, self.iq, self.jitter, name=name)
+        self.blocks = asyncio.Queue(16)
+        self.chunks = []
+        self.nb_chunk = 0
+        self.remainder = b"" # partial frame of pipe and file reads
+        self.text = ""
+        self.t_dsp = metrics.registry.timer("stream_dsp") # one timer per stream: they run concurrently
+        self.m_dropped = metrics.registry.counter("stream_dropped_blocks", "Blocks dropped when processing does not keep up", stream=name)
+
+    def process(self, samples):
+        with self.t_dsp:
+            return self.front_end.process(samples)
+
+    def push(self, blocks, flush=False):
+        """ Gathers blocks of samples released by the UDP receiver into processing blocks
+        """
+        for block in blocks:
+            self.chunks.append(block)
+            self.nb_chunk += len(block)
+        if self.nb_chunk >= self.block_len or (flush and self.nb_chunk):
+            try:
+                self.blocks.put_nowait(np.concatenate(self.chunks))
+            except asyncio.QueueFull:
+                self.m_dropped.inc()
+            self.chunks = []
+            self.nb_chunk = 0
+
+    def decode(self, p_preds_t, tones, snrs):
+        """ Characters decoded from the predictions with the frequency and SNR of the envelope at their step
+        """
+        chars = []
+        for i in range(p_preds_t.shape[1]):
+            char, _ = self.decoder.new_sample(p_preds_t[:,i])
+            if char:
+                chars.append((self.decoder.char, self.dial + tones[i], snrs[i]))
+        return chars
+
+    def reset(self):
+        self.decoder = decoder.MorseDecoderRegen(res_len=1000)
+        self.text = ""
+
+
+class DatagramReceiver(asyncio.DatagramProtocol):
+    def __init__(self, stream):
+        self.stream = stream
+        self.last = time.perf_counter()
+
+    def datagram_received(self, data, addr):
+        self.last = time.perf_counter()
+        self.stream.push(self.stream.udp.receive(data, self.last))
+
+
+class MultiStreamRuntime:
+    """ Reads, processes and decodes streams with a shared thread pool for signal processing and one
+        inference thread running the steps of all streams as batches. Envelopes of live streams come every 0.5 s
+        at different times: inference waits batch_wait seconds after the first one so that others join the batch.
+    """
+    def __init__(self, streams, predictions, workers=None, text_server=None, transcripts=None, spot_extractor=None, batch_wait=0.1):
+        self.streams = {stream.name: stream for stream in streams}
+        self.predictions = predictions
+        self.batch_wait = batch_wait
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, "dsp", initializer=resources.pin, initargs=("dsp",))
+        self.inference_executor = concurrent.futures.ThreadPoolExecutor(1, "inference", initializer=resources.pin, initargs=("inference",))
+        self.text_server = text_server
+        self.transcripts = transcripts
+        self.spot_extractor = spot_extractor
+        self.pending = {} # stream name -> (envelope block, tone, SNR) and None for a reset, in order
+        self.ended = set()
+        self.t_inference = metrics.registry.timer("batched_inference")
+        self.m_batch = metrics.registry.histogram("inference_batch_streams", "Streams per batched inference", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+        metrics.registry.gauge("streams", "Decoded streams").set(len(self.streams))
+
+    async def run(self):
+        self.data_ready = asyncio.Event()
+        tasks = [asyncio.ensure_future(self.process_stream(stream)) for stream in self.streams.values()]
+        readers = [asyncio.ensure_future(self.read(stream)) for stream in self.streams.values()]
+        for stream, reader, task in zip(self.streams.values(), readers, tasks):
+            reader.add_done_callback(functools.partial(self.supervise, stream, False))
+            task.add_done_callback(functools.partial(self.supervise, stream, True))
+        try:
+            await self.inference_loop()
+            for stream in self.streams.values():
+                if stream.text.strip():
+                    print(f"{stream.name}: {stream.text.strip()}")
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for stream in self.streams.values(): # room for the end of input of readers waiting on a full queue
+                while not stream.blocks.empty():
+                    stream.blocks.get_nowait()
+            for task in readers:
+                task.cancel()
+            await asyncio.gather(*readers, return_exceptions=True)
+            self.executor.shutdown()
+            self.inference_executor.shutdown()
+
+    def supervise(self, stream, processing, task):
+        """ Reports the error that ended the reader or the processing task of a stream. A failed reader has
+            ended the input of its stream, a failed processing task ends the stream.
+        """
+        if task.cancelled() or task.exception() is None:
+            return
+        print(f"{stream.name}: {'processing' if processing else 'reading'} failed: {task.exception()!r}")
+        if processing:
+            self.ended.add(stream.name)
+            self.data_ready.set()
+
+    async def read(self, stream):
+        try:
+            if stream.url.scheme == "udp":
+                await self.read_udp(stream)
+            elif stream.url.scheme == "pipe":
+                await self.read_pipe(stream)
+            else:
+                await self.read_file(stream)
+        finally:
+            await stream.blocks.put(None) # end of input, also when the source could not be read
+
+    async def read_udp(self, stream):
+        loop = asyncio.get_running_loop()
+        transport, receiver = await loop.create_datagram_endpoint(lambda: DatagramReceiver(stream),
+            local_addr=(stream.udp.host, stream.udp.port))
+        print(f"{stream.name}: listening on {stream.udp.host}:{stream.udp.port} {stream.sample_format} {stream.rate} S/s")
+        try:
+            while True:
+                await asyncio.sleep(stream.jitter)
+                if time.perf_counter() - receiver.last > stream.jitter: # sender paused or stopped: release what is buffered
+                    stream.push(stream.udp.flush(), flush=True)
+        finally:
+            transport.close()
+
+    def frames(self, stream, data):
+        frame_bytes = (4 if stream.sample_format == "f32le" else 2) * stream.channels
+        data = stream.remainder + data
+        end = len(data)//frame_bytes*frame_bytes
+        stream.remainder = data[end:]
+        return netaudio.decode_frames(data[:end], stream.sample_format, stream.channels, stream.iq)
+
+    async def read_pipe(self, stream):
+        loop = asyncio.get_running_loop()
+        # opened for writing too so that there is no end of file when the writer restarts
+        fd = os.open(stream.url.path, os.O_RDWR | os.O_NONBLOCK)
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, 'rb', buffering=0))
+        print(f"{stream.name}: reading pipe {stream.url.path} {stream.sample_format} {stream.rate} S/s")
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                stream.push([self.frames(stream, data)])
+        finally:
+            transport.close()
+
+    async def read_file(self, stream):
+        loop = asyncio.get_running_loop()
+        with open(stream.url.path, 'rb') as f:
+            print(f"{stream.name}: reading file {stream.url.path} {stream.sample_format} {stream.rate} S/s")
+            frame_bytes = (4 if stream.sample_format == "f32le" else 2) * stream.channels
+            t0 = time.perf_counter()
+            nb_samples = 0
+            while True:
+                data = await loop.run_in_executor(None, f.read, stream.block_len*frame_bytes)
+                if not data:
+                    break
+                samples = self.frames(stream, data)
+                await stream.blocks.put(samples) # waits for processing when not real time
+                nb_samples += len(samples)
+                if stream.realtime:
+                    delay = t0 + nb_samples/stream.rate - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+
+    async def process_stream(self, stream):
+        """ Signal processing of the blocks of a stream in order on the shared pool
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            samples = await stream.blocks.get()
+            if samples is None:
+                break
+            events = await loop.run_in_executor(self.executor, stream.process, samples)
+            items = self.pending.setdefault(stream.name, [])
+            for kind, env, tone, snr_db in events:
+                items.append((env, tone, snr_db) if kind == "env" else None)
+            if events:
+                self.data_ready.set()
+        self.ended.add(stream.name)
+        self.data_ready.set()
+
+    def next_batch(self):
+        """ Envelopes of each stream up to its next reset with the tone and SNR of each envelope sample,
+            and the streams to reset after them
+        """
+        blocks = {}
+        tags = {}
+        resets = []
+        for name, items in list(self.pending.items()):
+            envs = []
+            while items and items[0] is not None:
+                envs.append(items.pop(0))
+            if envs:
+                envs, tones, snrs = zip(*envs)
+                lengths = [len(env) for env in envs]
+                blocks[name] = np.concatenate(envs)
+                tags[name] = (np.repeat(tones, lengths), np.repeat(snrs, lengths))
+            if items: # reset after these envelopes
+                items.pop(0)
+                resets.append(name)
+            if not items:
+                del self.pending[name]
+        return blocks, tags, resets
+
+    def infer(self, blocks):
+        with self.t_inference:
+            return self.predictions.new_data(blocks)
+
+    async def inference_loop(self):
+        loop = asyncio.get_running_loop()
+        while len(self.ended) < len(self.streams) or self.pending:
+            await self.data_ready.wait()
+            if self.batch_wait > 0 and len(self.ended) < len(self.streams):
+                await asyncio.sleep(self.batch_wait)
+            self.data_ready.clear()
+            while self.pending:
+                blocks, tags, resets = self.next_batch()
+                if blocks:
+                    self.m_batch.observe(len(blocks))
+                    outputs = await loop.run_in_executor(self.inference_executor, self.infer, blocks)
+                    # the steps of a stream are its latest envelope samples (fewer while its look back fills)
+                    decoded = await asyncio.gather(*(loop.run_in_executor(self.executor, self.streams[name].decode, p_preds_t,
+                        tags[name][0][-p_preds_t.shape[1]:], tags[name][1][-p_preds_t.shape[1]:]) for name, p_preds_t in outputs.items()))
+                    for name, chars in zip(outputs.keys(), decoded):
+                        self.publish(self.streams[name], chars)
+                for name in resets:
+                    self.predictions.reset(name)
+                    self.streams[name].reset()
+                    if self.transcripts:
+                        self.transcripts.end_channel(name)
+                    if self.spot_extractor:
+                        self.spot_extractor.drop_channel(name)
+
+    def publish(self, stream, chars):
+        """ Characters with the frequency and SNR of the envelope they were decoded from: processing runs
+            ahead of inference and the front end may already be on another tone
+        """
+        for char, freq, snr_db in chars:
+            stream.text += char
+            if self.text_server:
+                self.text_server.publish_char(char, freq=freq)
+            if self.transcripts:
+                self.transcripts.add_char(stream.name, char, freq=freq)
+            if self.spot_extractor:
+                wpm = stream.wpm * 8 / stream.decoder.dit_len
+                self.spot_extractor.add_char(stream.name, char, freq, wpm, snr_db)
+        if " " in stream.text: # print whole words
+            words, stream.text = stream.text.rsplit(" ", 1)
+            if words.strip():
+                print(f"{stream.name}: {words.strip()}")
+
+
+def parse_stream(spec, index):
+    """ name=url or url named after its index
+    """
+    name, sep, url = spec.partition("=")
+    if not sep or "://" in name:
+        return f"s{index}", spec
+    return name, url
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Decode many audio streams in one process")
+    parser.add_argument("streams", nargs="+", help="Streams as [name=]url with url udp://[host]:port, pipe:///path or file:///path and options ?format=&rate=&channels=&iq=&wpm=&jitter=&dial=&realtime=")
+    parser.add_argument("--workers", type=int, help="Signal processing threads shared by the streams (default: number of cores)")
+    parser.add_argument("--model", default="models/default.model", help="Model weights")
+    parser.add_argument("--block-time", type=float, default=0.1, help="Processing block duration in seconds (default 0.1)")
+    parser.add_argument("--batch-wait", type=float, default=0.1, help="Time in seconds to gather envelopes of other streams before inference (default 0.1)")
+    parser.add_argument("--metrics-port", type=int, help="Serve processing metrics in Prometheus text format on this local port")
+    dsp.add_arguments(parser)
+    resources.add_arguments(parser)
+    textserver.add_arguments(parser)
+    transcripts.add_arguments(parser)
+    spots.add_arguments(parser)
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    resources.configure(args)
+    import torch, predictions # after the thread configuration
+    resources.config.apply_torch()
+    streams = []
+    for index, spec in enumerate(args.streams):
+        name, url = parse_stream(spec, index)
+        streams.append(Stream(name, url, args.proc_rate, args.squelch_open, args.squelch_close, args.block_time))
+    preds = predictions.BatchedPredictions(device=torch.device('cpu'))
+    preds.load_model(args.model)
+    preds.set_post_filter(args.post_filter, args.post_len)
+    if args.metrics_port:
+        metrics.MetricsServer(args.metrics_port).start()
+    text_server = textserver.from_args(args)
+    store = transcripts.from_args(args)
+    def report_spot(spot):
+        print(spot)
+        if text_server:
+            text_server.publish(spot.as_dict(), str(spot))
+    spot_extractor = spots.from_args(args, report_spot)
+    runtime = MultiStreamRuntime(streams, preds, args.workers, text_server, store, spot_extractor, args.batch_wait)
+    t0 = time.perf_counter()
+    try:
+        asyncio.run(runtime.run())
+    except KeyboardInterrupt:
+        pass
+    print(f"{len(streams)} streams decoded in {time.perf_counter() - t0:.1f} s, mean batch {runtime.m_batch.sum/max(runtime.m_batch.count, 1):.1f} streams")
+    if text_server:
+        text_server.stop()
+    if store:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
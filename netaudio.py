@@ -0,0 +1,408 @@
+""" Audio input from the network.
+
+    Datagrams are received in their own thread as from SDRangel's UDP audio output (AudioNetSink):
+        - rtp: RTP packets with L16 payload (16 bit big endian samples, RFC 3551)
+        - s16le: raw 16 bit little endian samples
+        - f32le: raw 32 bit float little endian samples
+    Mono or stereo frames. Stereo is mixed down to mono or taken as I/Q on left (I) and right (Q).
+
+    RTP packets go through a jitter buffer that puts them back in sequence order. A missing packet is
+    waited for until the buffer holds the jitter depth beyond it; it is then counted as lost and replaced
+    by silence so that the decoder timing is kept. Late and duplicate packets are counted and dropped.
+    Raw datagrams have no sequence number and are delivered in arrival order.
+
+        python morseangel.py --udp-audio 9998 --udp-format rtp
+        python netaudio.py --port 9998 --format rtp --text "CQ CQ DE F4EXB K" --loss 0.01 --reorder 0.02
+"""
+import argparse
+import random
+import socket
+import struct
+import time
+import numpy as np
+import metrics
+import morse
+import sources
+
+formats = ("rtp", "s16le", "f32le")
+rtp_header = struct.Struct("!BBHII")
+
+
+def parse_rtp(datagram):
+    """ (sequence number, timestamp, payload) of a RTP version 2 packet or None
+    """
+    if len(datagram) < rtp_header.size:
+        return None
+    b0, b1, seq, timestamp, ssrc = rtp_header.unpack_from(datagram)
+    if b0 >> 6 != 2:
+        return None
+    offset = rtp_header.size + 4*(b0 & 0x0F) # CSRC list
+    if b0 & 0x10: # header extension
+        if len(datagram) < offset + 4:
+            return None
+        offset += 4 + 4*struct.unpack_from("!H", datagram, offset+2)[0]
+    end = len(datagram)
+    if b0 & 0x20: # padding: count in the last byte
+        end -= datagram[-1]
+    if end < offset:
+        return None
+    return seq, timestamp, datagram[offset:end]
+
+def make_rtp(seq, timestamp, payload, ssrc=0x4D414E47, payload_type=96, marker=False):
+    return rtp_header.pack(0x80, (0x80 if marker else 0) | payload_type, seq & 0xFFFF, timestamp & 0xFFFFFFFF, ssrc) + payload
+
+def decode_samples(payload, sample_format):
+    """ Samples as float32 in [-1, 1)
+    """
+    if sample_format == "f32le":
+        return np.frombuffer(payload[:len(payload)//4*4], dtype="<f4").astype(np.float32)
+    dtype = ">i2" if sample_format == "rtp" else "<i2"
+    return np.frombuffer(payload[:len(payload)//2*2], dtype=dtype).astype(np.float32) / 32768.0
+
+def decode_frames(payload, sample_format, channels=1, iq=False):
+    """ Mono samples or complex I/Q samples from the left (I) and right (Q) channels with iq
+    """
+    samples = decode_samples(payload, sample_format)
+    if channels == 2:
+        samples = samples[:len(samples)//2*2]
+        if iq:
+            return sources.iq_from_interleaved(samples)
+        return samples.reshape(-1, 2).mean(axis=1)
+    return samples
+
+def encode_samples(samples, sample_format):
+    if sample_format == "f32le":
+        return samples.astype("<f4").tobytes()
+    dtype = ">i2" if sample_format == "rtp" else "<i2"
+    return np.clip(np.round(samples*32768.0), -32768, 32767).astype(dtype).tobytes()
+
+
+class SequenceTracker:
+    """ Extends 16 bit RTP sequence numbers to a counter that does not wrap (RFC 3550 A.1)
+    """
+    def __init__(self):
+        self.highest = None
+
+    def extend(self, seq):
+        if self.highest is None:
+            self.highest = seq
+            return seq
+        delta = (seq - self.highest) & 0xFFFF
+        if delta >= 0x8000: # before the highest
+            delta -= 0x10000
+        extended = self.highest + delta
+        self.highest = max(self.highest, extended)
+        return extended
+
+
+class JitterBuffer:
+    """ Packets indexed by extended sequence number released in order.
+        A gap is declared lost when depth packets after it have arrived or on flush.
+        A gap larger than max_gap is a sender restart: the buffer resynchronizes without filling it.
+    """
+    def __init__(self, depth=4, max_gap=100):
+        self.depth = depth
+        self.max_gap = max_gap
+        self.packets = {}
+        self.next = None # next sequence number to release
+        self.highest = None
+        self.frames = 0 # frames of the last released packet to fill lost ones
+        self.received = 0
+        self.lost = 0
+        self.late = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.resyncs = 0
+
+    def push(self, seq, samples):
+        self.received += 1
+        if self.next is None:
+            self.next = seq
+        if seq < self.next:
+            if self.next - seq > self.max_gap:
+                self.restart(seq)
+            else:
+                self.late += 1
+                return
+        elif seq - self.next > self.max_gap:
+            self.restart(seq)
+        if seq in self.packets:
+            self.duplicates += 1
+            return
+        if self.highest is not None and seq < self.highest:
+            self.reordered += 1
+        self.highest = seq if self.highest is None else max(self.highest, seq)
+        self.packets[seq] = samples
+
+    def restart(self, seq):
+        self.resyncs += 1
+        self.packets.clear()
+        self.next = seq
+        self.highest = None
+
+    def pop(self, flush=False):
+        """ Blocks of samples that can be released in order, silence in place of lost packets
+        """
+        blocks = []
+        while self.packets:
+            samples = self.packets.pop(self.next, None)
+            if samples is None:
+                if not flush and self.highest - self.next < self.depth:
+                    break
+                self.lost += 1
+                samples = np.zeros(self.frames, dtype=np.float32) if self.frames else None
+            else:
+                self.frames = len(samples)
+            if samples is not None:
+                blocks.append(samples)
+            self.next += 1
+        return blocks
+
+    def pending(self):
+        return len(self.packets)
+
+
+class UDPAudioSource(sources.SampleSource):
+    """ Audio samples received by UDP. Delivers real samples or complex I/Q samples from stereo with iq.
+        jitter is the jitter buffer depth in seconds (RTP only). A name labels the metrics of the source.
+    """
+    def __init__(self, port, host="0.0.0.0", rate=48000, channels=1, sample_format="rtp", iq=False, jitter=0.1, block_time=0.1, name=None):
+        super().__init__(rate, block_time)
+        self.host = host
+        self.port = port
+        self.channels = channels
+        self.sample_format = sample_format
+        self.iq = iq and channels == 2
+        self.jitter = jitter
+        self.buffer = None # created with the first packet from its size
+        self.tracker = SequenceTracker()
+        self.transit = None
+        labels = {"stream": name} if name else {}
+        self.m_packets = metrics.registry.counter("net_packets", "Audio datagrams received", **labels)
+        self.m_lost = metrics.registry.counter("net_lost_packets", "RTP packets lost and replaced by silence", **labels)
+        self.m_late = metrics.registry.counter("net_late_packets", "RTP packets arrived after their play out", **labels)
+        self.m_jitter = metrics.registry.gauge("net_jitter_seconds", "RTP interarrival jitter (RFC 3550)", **labels)
+        self.lost = self.late = 0
+
+    def frames(self, payload):
+        return decode_frames(payload, self.sample_format, self.channels, self.iq)
+
+    def update_jitter(self, timestamp, arrival):
+        """ Interarrival jitter estimate in seconds from RTP timestamps in sample units
+        """
+        transit = arrival - timestamp/self.rate
+        if self.transit is not None:
+            d = abs(transit - self.transit)
+            if d < 1.0: # not a timestamp jump
+                self.m_jitter.set(self.m_jitter.value + (d - self.m_jitter.value)/16)
+        self.transit = transit
+
+    def receive(self, datagram, arrival):
+        """ Blocks of samples released by a datagram
+        """
+        self.m_packets.inc()
+        if self.sample_format != "rtp":
+            return [self.frames(datagram)]
+        packet = parse_rtp(datagram)
+        if packet is None:
+            return []
+        seq, timestamp, payload = packet
+        samples = self.frames(payload)
+        self.update_jitter(timestamp, arrival)
+        if self.buffer is None:
+            depth = max(int(round(self.jitter*self.rate/max(len(samples), 1))), 1)
+            self.buffer = JitterBuffer(depth)
+            print(f"UDPAudioSource: {len(samples)} frames per packet, jitter buffer of {depth} packets")
+        self.buffer.push(self.tracker.extend(seq), samples)
+        return self.update_stats(self.buffer.pop())
+
+    def flush(self):
+        return self.update_stats(self.buffer.pop(flush=True)) if self.buffer else []
+
+    def update_stats(self, blocks):
+        self.m_lost.inc(self.buffer.lost - self.lost)
+        self.m_late.inc(self.buffer.late - self.late)
+        self.lost, self.late = self.buffer.lost, self.buffer.late
+        return blocks
+
+    def run(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        sock.bind((self.host, self.port))
+        sock.settimeout(max(self.jitter, 0.05))
+        print(f"UDPAudioSource: listening on {self.host}:{self.port} {self.sample_format} {self.channels} channel(s) {self.rate} S/s")
+        pending = []
+        nb_pending = 0
+        try:
+            while self.running:
+                idle = False
+                try:
+                    datagram = sock.recv(65536)
+                    blocks = self.receive(datagram, time.perf_counter())
+                except socket.timeout: # sender paused or stopped: release what is buffered
+                    blocks = self.flush()
+                    idle = True
+                for block in blocks:
+                    pending.append(block)
+                    nb_pending += len(block)
+                if nb_pending >= self.block_len or (idle and nb_pending):
+                    self.put(np.concatenate(pending))
+                    pending = []
+                    nb_pending = 0
+        finally:
+            sock.close()
+        print(f"UDPAudioSource: {self.describe()}")
+
+    def describe(self):
+        if self.buffer is None:
+            return f"{self.m_packets.value} packets"
+        b = self.buffer
+        return f"{b.received} packets {b.lost} lost {b.late} late {b.duplicates} duplicates {b.reordered} reordered {b.resyncs} resyncs jitter {self.m_jitter.value*1000:.1f} ms"
+
+
+def keyed_tone(text, wpm=20, freq=700.0, rate=48000, snr_db=None, ramp=0.005, seed=0):
+    """ Audio of text in Morse code: a tone keyed with PARIS timing and raised cosine edges,
+        with white noise at snr_db in the 2500 Hz bandwidth if given
+    """
+    dit = int(rate*1.2/wpm)
+    keying = []
+    for w, word in enumerate(text.upper().split()):
+        if w:
+            keying.append(np.zeros(4*dit)) # 7 dits with the 3 after the last character
+        for char in word:
+            code = morse.morsecode.get(char)
+            if code is None:
+                continue
+            for element in code:
+                keying.append(np.ones(dit if element == "." else 3*dit))
+                keying.append(np.zeros(dit))
+            keying.append(np.zeros(2*dit))
+    keying.append(np.zeros(7*dit))
+    keying = np.concatenate(keying)
+    n_ramp = max(int(rate*ramp), 1)
+    edge = 0.5 - 0.5*np.cos(np.pi*np.arange(n_ramp)/n_ramp)
+    keying = np.convolve(keying, edge/edge.sum(), mode="same")
+    signal = 0.5*keying*np.sin(2*np.pi*freq*np.arange(len(keying))/rate)
+    if snr_db is not None:
+        noise_power = 0.125 / 10**(snr_db/10) * (rate/2) / 2500 # tone power 0.125
+        signal = signal + np.random.default_rng(seed).normal(0, np.sqrt(noise_power), len(signal))
+    return np.clip(signal, -1.0, 1.0).astype(np.float32)
+
+
+class UDPAudioSender:
+    """ Sends audio like SDRangel's UDP audio output to test the receiving side locally.
+        loss and reorder are probabilities to drop or swap a packet with the next one.
+    """
+    def __init__(self, host="127.0.0.1", port=9998, rate=48000, channels=1, sample_format="rtp", packet_time=0.01, loss=0.0, reorder=0.0, seed=0):
+        self.address = (host, port)
+        self.rate = rate
+        self.channels = channels
+        self.sample_format = sample_format
+        self.packet_frames = max(int(rate*packet_time), 1)
+        self.loss = loss
+        self.reorder = reorder
+        self.random = random.Random(seed)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.seq = self.random.randrange(0x10000)
+        self.timestamp = self.random.randrange(0x100000000)
+        self.nb_sent = 0
+        self.nb_dropped = 0
+
+    def packets(self, samples):
+        if self.channels == 2 and samples.ndim == 1:
+            samples = np.repeat(samples, 2) if not np.iscomplexobj(samples) else samples.astype(np.complex64).view(np.float32)
+        step = self.packet_frames*self.channels
+        for start in range(0, len(samples), step):
+            payload = encode_samples(samples[start:start+step], self.sample_format)
+            if self.sample_format == "rtp":
+                payload = make_rtp(self.seq, self.timestamp, payload)
+                self.seq += 1
+                self.timestamp += self.packet_frames
+            yield payload
+
+    def send(self, samples, realtime=True):
+        t0 = time.perf_counter()
+        held = None
+        for index, packet in enumerate(self.packets(samples)):
+            if realtime:
+                delay = t0 + index*self.packet_frames/self.rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            if self.random.random() < self.loss:
+                self.nb_dropped += 1
+                continue
+            if held is None and self.random.random() < self.reorder:
+                held = packet # sent after the next one
+                continue
+            self.sock.sendto(packet, self.address)
+            self.nb_sent += 1
+            if held is not None:
+                self.sock.sendto(held, self.address)
+                self.nb_sent += 1
+                held = None
+        if held is not None:
+            self.sock.sendto(held, self.address)
+            self.nb_sent += 1
+
+    def close(self):
+        self.sock.close()
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Send test audio by UDP like SDRangel's UDP audio output or receive and print statistics")
+    parser.add_argument("--host", default="127.0.0.1", help="Destination address or listen address with --listen (default 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=9998, help="UDP port (default 9998)")
+    parser.add_argument("--format", default="rtp", choices=formats, help="Datagram format (default rtp)")
+    parser.add_argument("--rate", type=int, default=48000, help="Sample rate (default 48000)")
+    parser.add_argument("--channels", type=int, default=1, choices=(1, 2), help="Mono or stereo (default 1)")
+    parser.add_argument("--text", default="CQ CQ DE F4EXB F4EXB K", help="Text sent in Morse code")
+    parser.add_argument("--wav", help="Send this wav file instead of text")
+    parser.add_argument("--wpm", type=float, default=20, help="Morse code speed (default 20)")
+    parser.add_argument("--freq", type=float, default=700.0, help="Tone frequency in Hz (default 700)")
+    parser.add_argument("--snr", type=float, help="SNR in dB in 2500 Hz (default no noise)")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of times to send (default 1)")
+    parser.add_argument("--packet-time", type=float, default=0.01, help="Audio per packet in seconds (default 0.01)")
+    parser.add_argument("--loss", type=float, default=0.0, help="Probability to drop a packet")
+    parser.add_argument("--reorder", type=float, default=0.0, help="Probability to swap a packet with the next one")
+    parser.add_argument("--fast", action="store_true", help="Send as fast as possible instead of real time")
+    parser.add_argument("--listen", action="store_true", help="Receive and print statistics every second")
+    return parser.parse_args()
+
+def listen(args):
+    source = UDPAudioSource(args.port, args.host, args.rate, args.channels, args.format)
+    source.start()
+    nb_samples = 0
+    try:
+        while source.thread.is_alive():
+            time.sleep(1)
+            nb_samples += sum(len(block) for block in source.get_blocks())
+            print(f"{nb_samples/source.rate:8.1f} s {source.describe()}")
+    except KeyboardInterrupt:
+        source.stop()
+
+def main():
+    args = get_args()
+    if args.listen:
+        listen(args)
+        return
+    if args.wav:
+        from scipy.io import wavfile
+        rate, samples = wavfile.read(args.wav)
+        if samples.dtype == np.int16:
+            samples = samples.astype(np.float32) / 32768.0
+        if samples.ndim == 2:
+            args.channels = samples.shape[1]
+            samples = samples.reshape(-1)
+        args.rate = rate
+    else:
+        samples = keyed_tone(args.text, args.wpm, args.freq, args.rate, args.snr)
+    sender = UDPAudioSender(args.host, args.port, args.rate, args.channels, args.format, args.packet_time, args.loss, args.reorder)
+    print(f"Sending {len(samples)/args.channels/args.rate:.1f} s of audio to {args.host}:{args.port} {args.format}")
+    for r in range(args.repeat):
+        sender.send(samples, not args.fast)
+    print(f"Sent {sender.nb_sent} packets, dropped {sender.nb_dropped}")
+    sender.close()
+
+
+if __name__ == '__main__':
+    main()
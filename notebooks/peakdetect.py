@@ -1,5 +1,5 @@
 import sys
-from numpy import NaN, Inf, arange, isscalar, asarray, array
+from numpy import nan as NaN, inf as Inf, arange, isscalar, asarray, array
 
 def peakdet(v, delta, x = None):
     """
@@ -0,0 +1,164 @@
+""" Matplotlib plots of the main window: signal and envelopes, spectrum peak, element lengths and predictions.
+    Imported when the window is built so that matplotlib is not on the import path of the application start.
+"""
+import matplotlib.lines as mlines
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
+from matplotlib.figure import Figure
+import numpy as np
+
+
+class MplTimeCanvas(FigureCanvasQTAgg):
+
+    def __init__(self, parent=None, width=5, height=4, dpi=100):
+        self.fig = Figure(figsize=(width, height), dpi=dpi)
+        self.axes = self.fig.add_subplot(111)
+        self.axes.grid(which='both', color="gray", alpha=0.8)
+        self.axes.set_xlabel(u'samples')
+        self.fig.tight_layout(pad=1)
+        self.time_line = None
+        self.zline0 = None
+        self.zline1 = None
+        super(MplTimeCanvas, self).__init__(self.fig)
+
+    def set_mp(self, nsamples):
+        self.time_vect = np.arange(nsamples)
+        self.axes.set_ylim(-1, 1)
+        self.axes.set_xlim(0, nsamples)
+        if self.time_line:
+            while (len(self.axes.lines) > 0):
+                self.axes.lines.pop(0)
+        self.zline0 = None
+        self.zline1 = None
+        self.time_line, = self.axes.plot(self.time_vect, np.ones_like(self.time_vect)/2, color="yellow", alpha=0.8)
+        self.draw()
+
+    def new_data(self, data, zoom_span=0):
+        plotdata = self.time_line.get_data()[1]
+        nb_samples = len(data)
+        plotdata = np.roll(plotdata, -nb_samples, axis=0)
+        plotdata[-nb_samples:] = data
+        ymin = min(plotdata)
+        ymax = max(plotdata)
+        self.axes.set_ylim(ymin*1.2, ymax*1.2)
+        self.time_line.set_data(self.time_vect, plotdata)
+        if zoom_span:
+            if self.zline0:
+                self.zline0.remove()
+            if self.zline1:
+                self.zline1.remove()
+            x0 = len(plotdata) - nb_samples
+            x1 = x0 + zoom_span
+            l0 = mlines.Line2D([x0,x0], [ymin,ymax], color="red")
+            l1 = mlines.Line2D([x1,x1], [ymin,ymax], color="red")
+            self.zline0 = self.axes.add_line(l0)
+            self.zline1 = self.axes.add_line(l1)
+        self.draw()
+
+
+class MplPredCanvas(FigureCanvasQTAgg):
+
+    def __init__(self, parent=None, width=5, height=4, dpi=100):
+        self.fig = Figure(figsize=(width, height), dpi=dpi)
+        self.axes = self.fig.add_subplot(111)
+        self.axes.grid(which='both', color="gray", alpha=0.8)
+        self.axes.set_ylim(0, 3)
+        self.fig.tight_layout(pad=1)
+        self.colors = ["yellow", "lime", "lightsalmon", "lime", "lightsalmon", "cornflowerblue", "yellow", "fuchsia"]
+        super(MplPredCanvas, self).__init__(self.fig)
+
+    def set_mp(self, nsamples, max_ele=5):
+        self.nsamples = nsamples
+        self.max_ele = max_ele
+        self.lines = np.zeros((max_ele+3, nsamples))
+        self.labels = ["in", "cs", "ws"]
+        for i in range(max_ele):
+            self.labels.append(f"e{i}")
+        self.axes.set_xlim(0, nsamples)
+
+    def new_data(self, in_data, pred_data):
+        self.lines[0] = np.roll(self.lines[0], -len(in_data), axis=0)
+        self.lines[0][-len(in_data):] = in_data
+        xmax = len(pred_data[0])
+        for i in range(1, self.max_ele+3):
+            self.lines[i] = np.roll(self.lines[i], -xmax, axis=0)
+            self.lines[i][-xmax:] = pred_data[i-1]
+        while (len(self.axes.lines) > 0):
+            self.axes.lines.pop(0)
+        for i in range(self.max_ele+3):
+            if i == 0:
+                y = 0
+            elif i < 3:
+                y = 1
+            else:
+                y = 2
+            self.axes.plot(self.lines[i]*0.9 + y, label=self.labels[i], color=self.colors[i], alpha=0.8)
+        self.axes.legend(bbox_to_anchor=(-0.1, 1.1), loc='upper left')
+        self.draw()
+
+
+class MplPeakCanvas(FigureCanvasQTAgg):
+
+    def __init__(self, parent=None, width=5, height=4, dpi=100):
+        self.fig = Figure(figsize=(width, height), dpi=dpi)
+        self.axes = self.fig.add_subplot(111)
+        self.axes.grid(which='both', color="gray")
+        self.axes.set_xlabel(u'F (Hz)')
+        self.axes.set_ylabel(u'Amplitude (log)')
+        self.axes.set_yscale('log')
+        self.fig.tight_layout(pad=1)
+        self.spec_line = None
+        super(MplPeakCanvas, self).__init__(self.fig)
+
+    def set_mp(self, audio_rate, two_sided=False):
+        if self.spec_line:
+            self.axes.lines.pop(0)
+        self.spec_line = None
+        self.axes.set_xlim(-audio_rate/2 if two_sided else 0, audio_rate/2)
+
+    def new_data(self, f, s, maxtab, tone):
+        """ f, s: displayed part of the spectrum in increasing frequency order
+        """
+        if not self.spec_line:
+            self.spec_line, = self.axes.plot(f, s,'g-', color="lime", alpha=0.8)
+        else:
+            self.spec_line.set_data(f, s)
+        pmax = max(s)
+        self.axes.set_ylim(1e-5, pmax)
+        self.axes.set_xlabel(f'F (Hz) \u2191 {tone:9.5f} ({10*np.log10(pmax):5.2f} dB)')
+        #self.fig.suptitle(f"Signal peak {10*np.log10(pmax):5.2f} dB found at {tone:9.5f} Hz")
+        self.draw()
+
+
+class MplHistCanvas(FigureCanvasQTAgg):
+
+    def __init__(self, parent=None, width=5, height=4, dpi=150):
+        self.fig = Figure(figsize=(width, height), dpi=dpi)
+        self.axes = self.fig.add_subplot(111)
+        self.axes.grid(which='both', color="gray")
+        self.ylim = 50
+        self.xlim = 40
+        self.axes.set_ylim(0, self.ylim)
+        self.axes.set_xlim(0, self.xlim)
+        self.lines = []
+        for x, color, style in ((11, "red", "--"), (17, "red", "-"), (23, "red", "--"), (25, "yellow", "--"), (32, "yellow", "-")):
+            line = mlines.Line2D([x,x], [0,self.ylim], color=color, linestyle=style)
+            self.axes.add_line(line)
+            self.lines.append((x/8, line)) # position in dits
+        self.fig.tight_layout(pad=1)
+        self.hbars = None
+        self.dit_len = 8
+        super(MplHistCanvas, self).__init__(self.fig)
+
+    def new_data(self, counts, edges, dit_len=8):
+        """ Bars are created once and only their heights are updated
+        """
+        if self.hbars is None:
+            self.hbars = self.axes.bar(edges[:-1], counts, width=np.diff(edges), align="edge", color="lightskyblue")
+        else:
+            for bar, count in zip(self.hbars, counts):
+                bar.set_height(count)
+        if dit_len != self.dit_len: # follow automatic calibration
+            self.dit_len = dit_len
+            for pos, line in self.lines:
+                line.set_xdata([pos*dit_len, pos*dit_len])
+        self.draw()
@@ -1,7 +1,35 @@
 import torch
 import torch.nn as nn
 import numpy as np
+import dsp
+import morse
 
+ctc_alphabet = " " + morse.alphabet # CTC labels 1.. (0 is blank), space is the word separator
+
+
+class MorseLSTM(nn.Module):
+    """
+    Single LSTM layer
+    """
+    def __init__(self, device, input_size=1, hidden_layer_size=8, output_size=6):
+        super().__init__()
+        self.device = device # This is the only way to get things work properly with device
+        self.hidden_layer_size = hidden_layer_size
+        self.lstm = nn.LSTM(input_size=input_size, hidden_size=hidden_layer_size)
+        self.linear = nn.Linear(hidden_layer_size, output_size)
+        self.hidden_cell = (torch.zeros(1, 1, self.hidden_layer_size).to(self.device),
+                            torch.zeros(1, 1, self.hidden_layer_size).to(self.device))
+
+    def forward(self, input_seq):
+        lstm_out, self.hidden_cell = self.lstm(input_seq.view(len(input_seq), 1, -1), self.hidden_cell)
+        predictions = self.linear(lstm_out.view(len(input_seq), -1))
+        return predictions[-1]
+
+    def zero_hidden_cell(self):
+        self.hidden_cell = (
+            torch.zeros(1, 1, self.hidden_layer_size).to(self.device),
+            torch.zeros(1, 1, self.hidden_layer_size).to(self.device)
+        )
 
 class MorseBatchedLSTMStack(nn.Module):
     """
@@ -40,22 +68,28 @@ class MorseBatchedLSTMStack(nn.Module):
 
     def zero_hidden_cell(self):
         self.hidden_cell = (
-            torch.zeros(self.nb_lstm_layers, 1, self.hidden_layer_size).to(device),
-            torch.zeros(self.nb_lstm_layers, 1, self.hidden_layer_size).to(device)
+            torch.zeros(self.nb_lstm_layers, 1, self.hidden_layer_size).to(self.device),
+            torch.zeros(self.nb_lstm_layers, 1, self.hidden_layer_size).to(self.device)
         )
 
 class Predictions:
-    def __init__(self):
+    def __init__(self, model=None, look_back=208, device=None):
+        """ model: alternative model instance with the same 7 outputs (cs, ws, e0..e4) e.g. from training.
+            When not given the production 2x60 LSTM stack is created and weights have to be loaded with load_model.
+        """
         self.tbuffer = None
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        if device is None:
+            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.device = device
         print(f"Torch using {self.device}")
         self.max_ele = 5 # Number of Morse elements considered
-        self.look_back = 208 # Constant coming from model training
-        self.model = MorseBatchedLSTMStack(self.device, nb_lstm_layers=2, hidden_layer_size=60, output_size=self.max_ele+2, dropout=0.1).to(self.device)
-        self.model.use_minmax = True
-        self.lp_len = 3
-        self.lp_win = np.ones(self.lp_len) / self.lp_len
-        self.lp = True # post process predictions through moving average low pass filtering
+        self.look_back = look_back # Constant coming from model training
+        if model is None:
+            model = MorseBatchedLSTMStack(self.device, nb_lstm_layers=2, hidden_layer_size=60, output_size=self.max_ele+2, dropout=0.1)
+            model.use_minmax = True
+        self.model = model.to(self.device)
+        self.lp = True # post process predictions through low pass filtering
+        self.set_post_filter("mean", 3)
 
     @staticmethod
     def pytorch_rolling_window(x, window_size, step_size=1):
@@ -63,9 +97,44 @@ class Predictions:
         return x.unfold(0,window_size,step_size)
 
     def load_model(self, filename):
-        self.model.load_state_dict(torch.load(filename, map_location=self.device))
+        """ Model file saved by torch or flat weights file shared with other processes (see modelhost.py)
+        """
+        if filename.endswith(".flat"):
+            import modelhost
+            if self.device.type == 'cpu':
+                modelhost.load_state(self.model, modelhost.attach(filename))
+                return
+            self.model.load_state_dict(modelhost.attach(filename)) # copied to the device, not shared
+        else:
+            self.model.load_state_dict(torch.load(filename, map_location=self.device))
         self.model.eval()
 
+    def envelope_index(self, k):
+        """ Index of the latest envelope sample seen by the k-th prediction since start or reset
+        """
+        return k + self.look_back - 1
+
+    def reset(self):
+        """ Forget past samples and model state e.g. when the signal has been lost
+        """
+        self.tbuffer = None
+        self.post_state = None
+        self.model.zero_hidden_cell()
+
+    def set_post_filter(self, kind, length):
+        """ Low pass filter of the outputs: kind in dsp.CausalFilter.kinds over length predictions
+        """
+        self.post = dsp.CausalFilter(kind, length)
+        self.post_state = None
+
+    def post_filter(self, p_preds_t):
+        """ Low pass filter of all outputs at once continuing from the predictions of the previous block
+        """
+        if not self.lp:
+            return p_preds_t
+        p_preds_t, self.post_state = self.post.process(p_preds_t, self.post_state)
+        return p_preds_t
+
     def new_data(self, data):
         """ Takes the latest portion of the signal envelope as a numpy array,
             make predictions using the model and interpret results to produce decoded text.
@@ -86,11 +155,211 @@ class Predictions:
                     p_preds = torch.cat([p_preds, y_pred.reshape(1, self.max_ele+2)])
             p_preds = p_preds[1:] # drop first garbage sample
             p_preds_t = torch.transpose(p_preds, 0, 1).cpu()
-            if self.lp:
-                p_preds_t = np.apply_along_axis(lambda m: np.convolve(m, self.lp_win, mode='full'), axis=1, arr=p_preds_t)
-                self.p_preds_t = p_preds_t[:,:-self.lp_len+1]
-            else:
-                self.p_preds_t = p_preds_t
+            self.p_preds_t = self.post_filter(p_preds_t)
         else:
             self.p_preds_t = None
             self.cbuffer = None
+
+
+class BatchedPredictions(Predictions):
+    """ Predictions of several streams with one LSTM stack model. Each stream has its own look back buffer
+        and hidden state. The windows of all streams at the same step are run through the model as one batch
+        so that the cost of a step is shared by the streams. Outputs are the same as one Predictions per stream.
+    """
+    def __init__(self, model=None, look_back=208, device=None):
+        super().__init__(model, look_back, device)
+        self.streams = {} # key -> [look back buffer, hidden state, cell state, post filter state]
+
+    def reset(self, key=None):
+        if key is None:
+            self.streams.clear()
+        else:
+            self.streams.pop(key, None)
+
+    def initial_state(self):
+        shape = (self.model.nb_lstm_layers, 1, self.model.hidden_layer_size)
+        return [np.zeros(0, dtype=np.float32), torch.zeros(shape, device=self.device), torch.zeros(shape, device=self.device),
+                self.post.initial_state((self.max_ele+2,))]
+
+    def new_data(self, blocks):
+        """ Takes a dict of stream key to the latest portion of its envelope.
+            Returns a dict of stream key to predictions (outputs, steps) for streams with new predictions.
+        """
+        windows = {}
+        for key, data in blocks.items():
+            state = self.streams.get(key)
+            if state is None:
+                state = self.streams[key] = self.initial_state()
+            buffer = np.concatenate((state[0], np.asarray(data, dtype=np.float32)))
+            if len(buffer) >= self.look_back:
+                windows[key] = np.lib.stride_tricks.sliding_window_view(buffer, self.look_back)
+                buffer = buffer[len(windows[key]):] # last look_back - 1 samples
+            state[0] = buffer
+        outputs = {key: [] for key in windows}
+        nb_steps = max((len(w) for w in windows.values()), default=0)
+        for step in range(nb_steps):
+            keys = [key for key, w in windows.items() if step < len(w)]
+            x = torch.from_numpy(np.stack([windows[key][step] for key in keys], axis=1)).to(self.device) # (look_back, streams)
+            h = torch.cat([self.streams[key][1] for key in keys], dim=1)
+            c = torch.cat([self.streams[key][2] for key in keys], dim=1)
+            with torch.no_grad():
+                lstm_out, (h, c) = self.model.lstm(x.unsqueeze(2), (h, c))
+                y = self.model.linear(lstm_out[-1])
+                if self.model.use_minmax:
+                    y -= y.min(1, keepdim=True)[0]
+                    y /= y.max(1, keepdim=True)[0]
+            y = y.cpu().numpy()
+            for i, key in enumerate(keys):
+                self.streams[key][1] = h[:, i:i+1]
+                self.streams[key][2] = c[:, i:i+1]
+                outputs[key].append(y[i])
+        return self.post_filter_streams({key: np.stack(y, axis=1) for key, y in outputs.items()})
+
+    def post_filter_streams(self, outputs):
+        """ Low pass filter of the predictions of each stream from its own filter state. Streams with the
+            same number of steps are filtered together.
+        """
+        if not self.lp:
+            return outputs
+        groups = {}
+        for key, y in outputs.items():
+            groups.setdefault(y.shape[1], []).append(key)
+        for keys in groups.values():
+            y, state = self.post.process(np.stack([outputs[key] for key in keys]), np.stack([self.streams[key][3] for key in keys]))
+            for i, key in enumerate(keys):
+                outputs[key] = y[i]
+                self.streams[key][3] = state[i]
+        return outputs
+
+
+class MorseTCN(nn.Module):
+    """
+    Causal dilated temporal convolution network with the same outputs as the LSTM models (cs, ws, e0..e4).
+    Residual layers of a causal convolution with dilation doubling at each layer followed by ReLU.
+    Each output depends on the last receptive_field samples only and all outputs of a sequence are
+    computed in parallel.
+    """
+    def __init__(self, device, channels=32, kernel_size=3, nb_layers=7, output_size=7):
+        super().__init__()
+        self.device = device
+        self.channels = channels
+        self.kernel_size = kernel_size
+        self.dilations = [2**i for i in range(nb_layers)]
+        self.input = nn.Conv1d(1, channels, 1)
+        self.convs = nn.ModuleList([nn.Conv1d(channels, channels, kernel_size, dilation=d) for d in self.dilations])
+        self.output = nn.Conv1d(channels, output_size, 1)
+        self.receptive_field = 1 + (kernel_size-1)*sum(self.dilations)
+        self.use_minmax = False
+
+    @classmethod
+    def from_state_dict(cls, device, state_dict):
+        """ Model with the sizes of saved weights
+        """
+        channels, _, kernel_size = state_dict['convs.0.weight'].shape
+        nb_layers = len([k for k in state_dict if k.startswith('convs.') and k.endswith('.weight')])
+        model = cls(device, channels, kernel_size, nb_layers, state_dict['output.weight'].shape[0])
+        model.use_minmax = True
+        return model
+
+    def stream(self, x, tails=None):
+        """ Outputs (batch, outputs, steps) of input x (batch, 1, steps) following the input given in the
+            previous call whose layer inputs tails were returned. No tails is a start after silence.
+        """
+        h = self.input(x)
+        new_tails = []
+        for i, conv in enumerate(self.convs):
+            tail_len = (self.kernel_size-1)*conv.dilation[0]
+            tail = tails[i] if tails is not None else torch.zeros(h.shape[0], self.channels, tail_len, device=h.device)
+            padded = torch.cat((tail, h), dim=2)
+            new_tails.append(padded[:, :, padded.shape[2]-tail_len:])
+            h = h + torch.relu(conv(padded))
+        y = self.output(h)
+        if self.use_minmax:
+            y = y - y.min(1, keepdim=True)[0]
+            y = y / y.max(1, keepdim=True)[0]
+        return y, new_tails
+
+    def forward(self, input_seq):
+        """ Outputs at the last step of look back windows (look_back) or (batch, look_back)
+        """
+        y, _ = self.stream(input_seq.reshape(-1, 1, input_seq.shape[-1]))
+        y = y[:, :, -1]
+        return y[0] if input_seq.dim() == 1 else y
+
+    def zero_hidden_cell(self):
+        pass
+
+
+class MorseCTC(MorseTCN):
+    """
+    MorseTCN trunk with a character output: log probabilities of CTC blank (label 0) and of each character
+    of the alphabet (label i is alphabet[i-1]) at each step, trained with CTC loss on keyed text. Characters
+    come out of the model directly (see decoder.CTCGreedyDecoder) instead of the 7 element signals and the
+    timing thresholds of MorseDecoderRegen. The alphabet is saved with the weights.
+    """
+    def __init__(self, device, channels=48, kernel_size=3, nb_layers=7, alphabet=ctc_alphabet):
+        super().__init__(device, channels, kernel_size, nb_layers, len(alphabet)+1)
+        self.alphabet = alphabet
+        self.register_buffer('alphabet_codes', torch.tensor([ord(c) for c in alphabet]))
+
+    @classmethod
+    def from_state_dict(cls, device, state_dict):
+        channels, _, kernel_size = state_dict['convs.0.weight'].shape
+        nb_layers = len([k for k in state_dict if k.startswith('convs.') and k.endswith('.weight')])
+        alphabet = ''.join(chr(c) for c in state_dict['alphabet_codes'].tolist())
+        return cls(device, channels, kernel_size, nb_layers, alphabet)
+
+    def stream(self, x, tails=None):
+        y, new_tails = super().stream(x, tails)
+        return torch.log_softmax(y, dim=1), new_tails
+
+
+class TCNPredictions(Predictions):
+    """ Predictions of a MorseTCN computed a block at a time: each layer keeps the tail of its input
+        needed by the next block so that all steps of a block are computed at once. Outputs are the same as
+        Predictions of the model with look_back the receptive field, without running a window per step.
+    """
+    def __init__(self, model, device=None):
+        super().__init__(model, model.receptive_field, device)
+        self.reset()
+
+    def reset(self):
+        super().reset()
+        self.tails = None
+        self.nb_samples = 0
+
+    def new_data(self, data):
+        x = torch.FloatTensor(np.asarray(data, dtype=np.float32)).to(self.device)
+        with torch.no_grad():
+            y, self.tails = self.model.stream(x.view(1, 1, -1), self.tails)
+        skip = min(max(self.look_back - 1 - self.nb_samples, 0), len(x)) # until a full receptive field is seen
+        self.nb_samples += len(x)
+        if skip == len(x):
+            self.p_preds_t = None
+            self.cbuffer = None
+            return
+        self.cbuffer = x[skip:].cpu()
+        self.p_preds_t = self.post_filter(y[0, :, skip:].cpu().numpy())
+
+
+def load_predictions(filename, device=None):
+    """ Predictions of the LSTM stack, of a MorseTCN or of a MorseCTC depending on the weights in the file
+    """
+    if device is None:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if filename.endswith(".flat"):
+        import modelhost
+        state_dict = modelhost.attach(filename)
+    else:
+        state_dict = torch.load(filename, map_location=device)
+    if 'convs.0.weight' in state_dict:
+        model_class = MorseCTC if 'alphabet_codes' in state_dict else MorseTCN
+        model = model_class.from_state_dict(device, state_dict)
+        model.load_state_dict(state_dict)
+        model.eval()
+        preds = TCNPredictions(model, device)
+        preds.lp = model_class is MorseTCN # smoothing would merge the CTC peaks
+        return preds
+    preds = Predictions(device=device)
+    preds.load_model(filename)
+    return preds
@@ -1,18 +1,84 @@
 import queue
+import time
 from PyQt5.QtCore import Qt, QObject, QThread, pyqtSignal
-import predictions, decoder
+import numpy as np
+import decoder, corrector, metrics, tracing, latency, resources
+
+class ModelLoader(QObject):
+    """ Loads the model and the corrector dictionary in a background thread so that the window and audio
+        come up immediately. The first predictions are run on silence to warm up the model (lazy
+        initializations, memory allocation) before it is handed over.
+    """
+    ready = pyqtSignal(object, object, object) # predictions, word corrector or None, [(step, seconds)]
+    failed = pyqtSignal(str)
+
+    def __init__(self, model_file, dict_file=None, correct=False, warmup_samples=100):
+        super().__init__()
+        self.model_file = model_file
+        self.dict_file = dict_file
+        self.correct = correct
+        self.warmup_samples = warmup_samples
+
+    def run(self):
+        resources.pin("inference") # Torch creates its thread pool here: threads inherit the inference CPUs, not the dsp ones of the GUI thread
+        timings = []
+        t = time.perf_counter()
+        def step(name):
+            nonlocal t
+            now = time.perf_counter()
+            timings.append((name, now - t))
+            t = now
+        try:
+            import predictions # imports torch
+            resources.config.apply_torch()
+            step("import torch")
+            preds = predictions.load_predictions(self.model_file)
+            step("load model")
+            preds.new_data(np.zeros(preds.look_back + self.warmup_samples, dtype=np.float32))
+            preds.reset()
+            step("warm up")
+            word_corrector = None
+            if self.correct or self.dict_file:
+                word_corrector = corrector.load_corrector(self.dict_file)
+                step("load dictionary")
+        except Exception as e:
+            self.failed.emit(f"{e.__class__.__name__}: {e}")
+            return
+        self.ready.emit(preds, word_corrector, timings)
+
 
 class PredictionsWorker(QObject):
     finished = pyqtSignal()
     dataReady = pyqtSignal()
-    newChar = pyqtSignal(str)
+    newChar = pyqtSignal(str, float, float) # character, wall clock time at end of keying, delay to emission
+    wordCorrected = pyqtSignal(str, str) # decoded word, corrected word
 
-    def __init__(self, preds, dataq):
+    def __init__(self, preds, dataq, corrector=None, auto_dit=False):
         super().__init__()
         self.preds = preds
         self.dataq = dataq
         self.running = True
-        self.decoder = decoder.MorseDecoderRegen()
+        self.decoder = decoder.MorseDecoderRegen(res_len=1000)
+        self.corrector = corrector
+        self.calibrator = decoder.DitCalibrator(self.decoder.his) if auto_dit else None
+        self.t_predictions = metrics.registry.timer("predictions")
+        self.t_decoder = metrics.registry.timer("decoder")
+        self.dataq_hop = tracing.Hop("dataq")
+        self.ready_hop = tracing.Hop("dataReady")
+        self.char_hop = tracing.Hop("newChar")
+        self.m_chars = metrics.registry.counter("decoded_chars", "Decoded characters including word separators")
+        self.stamps = latency.StampTrack()
+        self.latency = latency.LatencyReport()
+
+    def set_models(self, preds, corrector=None):
+        """ Called once models are loaded and before any data is queued
+        """
+        self.preds = preds
+        self.corrector = corrector
+        alphabet = getattr(preds.model, "alphabet", None)
+        if alphabet: # characters come out of the model: no element decoder nor dit calibration
+            self.decoder = decoder.CTCGreedyDecoder(alphabet, res_len=1000)
+            self.calibrator = None
 
     def set_dit_len(self, dit_len):
         self.decoder.set_dit_len(dit_len)
@@ -22,19 +88,71 @@ class PredictionsWorker(QObject):
 
     def reset_hist(self):
         self.decoder.reset_hist()
+        if self.calibrator: # restart calibration from nominal dit length
+            self.decoder.set_dit_len(8)
 
     def run(self):
+        resources.pin("inference")
         while self.running:
             try:
-                data = self.dataq.get(timeout=1) # give a chance to stop thread
+                item = self.dataq.get(timeout=1) # give a chance to stop thread
             except queue.Empty:
                 continue
-            self.preds.new_data(data)
+            if item is None: # signal lost: next data does not follow previous data
+                with tracing.tracer.span("reset"):
+                    self.dataq_hop.receive()
+                self.preds.reset()
+                self.decoder.reset()
+                self.stamps.reset()
+                if self.corrector:
+                    self.corrector.start_word()
+                continue
+            data, stamp = item
+            self.stamps.add(stamp, len(data))
+            with self.t_predictions:
+                self.dataq_hop.receive()
+                self.preds.new_data(data)
             if self.preds.p_preds_t is not None:
-                self.dataReady.emit()
-                for i in range(self.preds.p_preds_t.shape[1]):
-                    s = self.preds.p_preds_t[:,i]
-                    char, env = self.decoder.new_sample(s)
-                    if char:
-                        self.newChar.emit(self.decoder.char)
+                with tracing.tracer.span("emit dataReady", "hop"):
+                    self.ready_hop.send()
+                    self.dataReady.emit()
+                with self.t_decoder:
+                    for i in range(self.preds.p_preds_t.shape[1]):
+                        s = self.preds.p_preds_t[:,i]
+                        char, env = self.decoder.new_sample(s)
+                        if char:
+                            self.m_chars.inc()
+                            if self.calibrator and self.decoder.char != " ":
+                                self.calibrator.update(self.decoder)
+                            if self.corrector:
+                                self.correct(self.decoder.char)
+                            keyed, delay = self.char_latency()
+                            self.char_hop.send()
+                            self.newChar.emit(self.decoder.char, keyed, delay)
         self.finished.emit()
+
+    def char_latency(self):
+        """ Wall clock time at which keying of the decoded character ended and delay until now
+        """
+        emitted = time.time()
+        stamp, j = self.stamps.find(self.preds.envelope_index(self.decoder.char_index))
+        if stamp is None:
+            return emitted, 0.0
+        keyed = stamp.sample_time(j)
+        self.latency.add(self.decoder.char, stamp.sample_index(j), keyed, stamp.queued, emitted)
+        return keyed, emitted - keyed
+
+    def correct(self, char):
+        """ Feed the corrector with the decoded character. At word separator the correction
+            of the word if any is signaled before the separator itself.
+        """
+        if char == " ":
+            word, corrected = self.corrector.end_word()
+            if corrected != word:
+                self.wordCorrected.emit(word, corrected)
+        else:
+            if hasattr(self.decoder, "candidates"): # CTC model outputs
+                candidates = self.decoder.candidates
+            else:
+                candidates = corrector.char_candidates(self.decoder.char_ecounts, self.decoder.dit_len)
+            self.corrector.add_char(char, candidates)
@@ -0,0 +1,112 @@
+""" Record and replay of raw audio sessions.
+
+    The byte blocks received from the sound card are saved with their arrival time and the device format
+    in a chunked file:
+        - header: magic "MASR" and version
+        - chunks: type (1 byte), arrival time in seconds since start (float64), length (uint32), payload
+            - "F": device format as JSON (rate, channels, bytes_per_frame, sample_type, iq)
+            - "D": audio bytes exactly as read from the device
+
+    A replay source feeds the blocks back either at their original timing or as fast as possible:
+
+        python morseangel.py --record session.masr
+        python morseangel.py --replay session.masr [--replay-fast]
+"""
+import json
+import struct
+import time
+import sources
+
+magic = b"MASR"
+version = 1
+chunk_header = struct.Struct("<cdI")
+
+
+class SessionRecorder:
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename, "wb")
+        self.f.write(magic + struct.pack("<I", version))
+        self.t0 = time.perf_counter()
+        self.nb_bytes = 0
+
+    def write_chunk(self, kind, payload):
+        self.f.write(chunk_header.pack(kind, time.perf_counter() - self.t0, len(payload)))
+        self.f.write(payload)
+
+    def set_format(self, rate, channels, bytes_per_frame, sample_type="float32", iq=False):
+        fmt = dict(rate=rate, channels=channels, bytes_per_frame=bytes_per_frame, sample_type=sample_type, iq=iq)
+        self.write_chunk(b"F", json.dumps(fmt).encode())
+
+    def write(self, data):
+        self.write_chunk(b"D", data)
+        self.nb_bytes += len(data)
+
+    def close(self):
+        self.f.close()
+        print(f"SessionRecorder: {self.nb_bytes} audio bytes recorded to {self.filename}")
+
+
+def read_session(filename):
+    """ Yields (kind, time, payload) with kind "F" (format dict) or "D" (bytes)
+    """
+    with open(filename, "rb") as f:
+        header = f.read(8)
+        if header[:4] != magic:
+            raise ValueError(f"read_session: {filename} is not a recorded session")
+        if struct.unpack("<I", header[4:])[0] > version:
+            raise ValueError(f"read_session: {filename} has an unsupported version")
+        while True:
+            head = f.read(chunk_header.size)
+            if len(head) < chunk_header.size:
+                return
+            kind, t, length = chunk_header.unpack(head)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            if kind == b"F":
+                yield "F", t, json.loads(payload)
+            else:
+                yield "D", t, payload
+
+def session_format(filename):
+    """ First device format of a recorded session
+    """
+    for kind, t, payload in read_session(filename):
+        if kind == "F":
+            return payload
+    raise ValueError(f"session_format: no format in {filename}")
+
+
+class ReplaySource(sources.SampleSource):
+    """ Audio byte blocks of a recorded session at their original timing or as fast as they are consumed.
+        Blocks are raw bytes to go through the same conversion as sound card input. A device format change
+        during the session is queued as the new format dict before the blocks in that format.
+    """
+    raw = True
+
+    def __init__(self, filename, fast=False):
+        self.format = session_format(filename)
+        super().__init__(self.format["rate"], maxsize=4 if fast else 0)
+        self.filename = filename
+        self.fast = fast
+
+    def run(self):
+        t0 = time.perf_counter()
+        nb_blocks = 0
+        format = self.format
+        for kind, t, payload in read_session(self.filename):
+            if not self.running:
+                break
+            if kind == "F":
+                if payload != format:
+                    format = payload
+                    self.put(format)
+                continue
+            if not self.fast:
+                delay = t0 + t - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            self.put(payload)
+            nb_blocks += 1
+        print(f"ReplaySource: end of {self.filename} after {nb_blocks} blocks")
@@ -0,0 +1,107 @@
+""" Thread pool sizes and CPU affinity of the processing threads.
+
+    When several decoders run on the same host, the default thread pools of Torch, OpenMP/BLAS and the
+    scipy FFT each use all cores and oversubscribe them. The configuration sets:
+        - OpenMP and BLAS threads through the environment (before Torch or numpy start their pools)
+          and at run time with threadpoolctl when installed
+        - Torch intra-op and inter-op threads
+        - scipy FFT workers of the DSP stages
+    and optionally pins threads by role to a set of CPUs (Linux):
+        - capture: sample source reading thread
+        - dsp: GUI thread running decimation, STFT and envelope (and threads it creates by default)
+        - inference: predictions worker thread (and Torch threads it creates)
+
+        python morseangel.py --threads 1 --cpu-dsp 0 --cpu-inference 1
+"""
+import os, sys
+import dsp
+
+thread_env_vars = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS", "VECLIB_MAXIMUM_THREADS")
+roles = ("capture", "dsp", "inference")
+
+
+def parse_cpus(spec):
+    """ CPU set from a list like "0-3,6"
+    """
+    cpus = set()
+    for part in spec.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.update(range(int(first), int(last)+1))
+        elif part:
+            cpus.add(int(part))
+    return cpus
+
+
+class ResourceConfig:
+    def __init__(self, threads=None, interop_threads=None, fft_workers=None, cpus=None):
+        """ threads: Torch intra-op, OpenMP and BLAS threads (None keeps the library defaults)
+            interop_threads: Torch inter-op threads
+            fft_workers: scipy FFT workers (None: same as threads)
+            cpus: dict of role to CPU set
+        """
+        self.threads = threads
+        self.interop_threads = interop_threads
+        self.fft_workers = fft_workers if fft_workers is not None else threads
+        self.cpus = cpus if cpus else {}
+
+    def apply(self):
+        """ Call as early as possible: thread pools of libraries already started only follow run time settings
+        """
+        if self.threads:
+            for var in thread_env_vars:
+                os.environ[var] = str(self.threads)
+            try:
+                from threadpoolctl import threadpool_limits
+                threadpool_limits(self.threads)
+            except ImportError:
+                pass
+        if self.fft_workers:
+            dsp.fft_workers = self.fft_workers
+        if "torch" in sys.modules: # otherwise applied by apply_torch once imported
+            self.apply_torch()
+
+    def apply_torch(self):
+        import torch
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        if self.interop_threads:
+            try:
+                torch.set_num_interop_threads(self.interop_threads)
+            except RuntimeError: # can only be set before any parallel work
+                pass
+
+    def pin(self, role):
+        """ Pin the calling thread to the CPUs of role if any. Threads it creates inherit the affinity.
+        """
+        cpus = self.cpus.get(role)
+        if cpus and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus) # 0 is the calling thread on Linux
+
+    def describe(self):
+        threads = self.threads if self.threads else "default"
+        pinned = " ".join(f"{role}:{','.join(map(str, sorted(cpus)))}" for role, cpus in self.cpus.items())
+        return f"threads {threads}" + (f" cpus {pinned}" if pinned else "")
+
+
+config = ResourceConfig()
+
+def pin(role):
+    config.pin(role)
+
+
+def add_arguments(parser):
+    parser.add_argument("--threads", type=int, help="Torch, OpenMP, BLAS and FFT threads (default: libraries defaults)")
+    parser.add_argument("--interop-threads", type=int, help="Torch inter-op threads")
+    parser.add_argument("--fft-workers", type=int, help="scipy FFT workers (default: same as --threads)")
+    for role in roles:
+        parser.add_argument(f"--cpu-{role}", help=f"Pin {role} thread to these CPUs e.g. 0-3,6")
+
+def configure(args):
+    """ Set and apply the module configuration from parsed arguments
+    """
+    global config
+    cpus = {role: parse_cpus(getattr(args, f"cpu_{role}")) for role in roles if getattr(args, f"cpu_{role}", None)}
+    config = ResourceConfig(args.threads, args.interop_threads, args.fft_workers, cpus)
+    config.apply()
+    return config
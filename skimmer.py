@@ -0,0 +1,144 @@
+""" Headless multi channel decoder of a wideband I/Q stream.
+
+    The stream is split into uniform channels by a polyphase FFT channelizer. The power of each channel
+    is decimated to the envelope rate of the model and each active channel (signal above the noise floor)
+    gets its own predictions and decoder:
+
+        python skimmer.py --iq-file band.iq --iq-rate 48000 --channels 256 --wpm 20
+
+    Decoded text is printed per channel frequency.
+"""
+import argparse
+import numpy as np
+import torch
+import decoder, dsp, modelhost, predictions, resources, sources, spots, textserver, transcripts
+
+
+def env_rate(wpm):
+    """ Envelope sample rate giving 7.69 samples per dit like the model training
+    """
+    return 7.69 * wpm / 1.2
+
+
+class ChannelDecoder:
+    """ Predictions and decoder of one channel
+    """
+    def __init__(self, freq, state_dict, text_server=None, spot_extractor=None, wpm=None, transcripts=None):
+        self.freq = freq
+        self.transcripts = transcripts
+        self.text_server = text_server
+        self.spot_extractor = spot_extractor
+        self.wpm = wpm
+        self.snr = None
+        self.predictions = predictions.Predictions(device=torch.device('cpu')) # shared weights are in CPU memory
+        modelhost.load_state(self.predictions.model, state_dict) # weights shared by all channels
+        self.decoder = decoder.MorseDecoderRegen(res_len=1000)
+        self.text = ""
+        self.idle_blocks = 0
+
+    def new_data(self, env):
+        self.predictions.new_data(env)
+        if self.predictions.p_preds_t is not None:
+            for i in range(self.predictions.p_preds_t.shape[1]):
+                char, _ = self.decoder.new_sample(self.predictions.p_preds_t[:,i])
+                if char:
+                    self.text += self.decoder.char
+                    if self.text_server:
+                        self.text_server.publish_char(self.decoder.char, freq=self.freq)
+                    if self.transcripts:
+                        self.transcripts.add_char(f"{self.freq:.0f}", self.decoder.char, freq=self.freq)
+                    if self.spot_extractor:
+                        wpm = self.wpm * 8 / self.decoder.dit_len if self.wpm else None
+                        self.spot_extractor.add_char(id(self), self.decoder.char, self.freq, wpm, self.snr)
+        if " " in self.text: # print whole words
+            words, self.text = self.text.rsplit(" ", 1)
+            if words.strip():
+                print(f"{self.freq:9.1f} Hz: {words.strip()}")
+
+
+class Skimmer:
+    def __init__(self, rate, nb_channels, wpm, state_dict, snr_db=10.0, hang=5, text_server=None, spot_extractor=None, center_freq=0.0, transcripts=None):
+        self.channelizer = dsp.PolyphaseChannelizer(rate, nb_channels)
+        self.envelopes = dsp.EnvelopeDecimator(self.channelizer.channel_rate, env_rate(wpm), nb_channels)
+        self.state_dict = state_dict
+        self.snr_db = snr_db
+        self.hang = hang # blocks without signal before a channel decoder is dropped
+        self.decoders = {}
+        self.text_server = text_server
+        self.spot_extractor = spot_extractor
+        self.center_freq = center_freq # frequency of the I/Q baseband center
+        self.wpm = wpm
+        self.transcripts = transcripts
+
+    def process(self, data):
+        y = self.channelizer.process(data)
+        if len(y) == 0:
+            return
+        power = (y.real**2 + y.imag**2)
+        env = self.envelopes.process(power)
+        active = set(self.channelizer.active_channels(power, self.snr_db))
+        for k in active:
+            if k not in self.decoders:
+                freq = self.center_freq + self.channelizer.freqs[k]
+                self.decoders[k] = ChannelDecoder(freq, self.state_dict, self.text_server, self.spot_extractor, self.wpm, self.transcripts)
+        mean_power = np.mean(power, axis=0)
+        noise_floor = np.median(mean_power)
+        for k in list(self.decoders.keys()):
+            channel_decoder = self.decoders[k]
+            channel_decoder.idle_blocks = 0 if k in active else channel_decoder.idle_blocks + 1
+            channel_decoder.snr = 10*np.log10(mean_power[k] / noise_floor) if noise_floor > 0 else None
+            if channel_decoder.idle_blocks > self.hang:
+                if self.spot_extractor:
+                    self.spot_extractor.drop_channel(id(channel_decoder))
+                if self.transcripts:
+                    self.transcripts.end_channel(f"{channel_decoder.freq:.0f}")
+                del self.decoders[k]
+            elif len(env):
+                channel_decoder.new_data(env[:, k].astype(np.float32))
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Decode all CW signals of a wideband I/Q stream")
+    parser.add_argument("--iq-file", default="-", help="Interleaved I/Q samples file or - for stdin")
+    parser.add_argument("--iq-format", default="float32", choices=list(sources.iq_dtypes.keys()), help="Sample format (default float32)")
+    parser.add_argument("--iq-rate", type=int, default=48000, help="Sample rate (default 48000)")
+    parser.add_argument("--channels", type=int, default=256, help="Number of channels (default 256)")
+    parser.add_argument("--wpm", type=int, default=20, help="Morse code speed (default 20)")
+    parser.add_argument("--snr", type=float, default=10.0, help="Channel SNR in dB over the median of channels to decode it (default 10)")
+    parser.add_argument("--model", default="models/default.model", help="Model weights")
+    parser.add_argument("--center-freq", type=float, default=0.0, help="Frequency in Hz of the I/Q center added to channel frequencies (default 0)")
+    parser.add_argument("--realtime", action="store_true", help="Read file at the pace of the sample rate")
+    resources.add_arguments(parser)
+    textserver.add_arguments(parser)
+    transcripts.add_arguments(parser)
+    spots.add_arguments(parser, optional=False)
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    resources.configure(args)
+    resources.pin("dsp")
+    state_dict = modelhost.attach(modelhost.ensure_flat(args.model))
+    text_server = textserver.from_args(args)
+    store = transcripts.from_args(args)
+    def report_spot(spot):
+        print(spot)
+        if text_server:
+            text_server.publish(spot.as_dict(), str(spot))
+    spot_extractor = spots.from_args(args, report_spot)
+    skimmer = Skimmer(args.iq_rate, args.channels, args.wpm, state_dict, args.snr, text_server=text_server,
+        spot_extractor=spot_extractor, center_freq=args.center_freq, transcripts=store)
+    source = sources.IQFileSource(args.iq_file, args.iq_rate, args.iq_format, realtime=args.realtime, block_time=0.5)
+    source.start()
+    while source.thread.is_alive() or not source.blocks.empty():
+        for block in source.get_blocks():
+            skimmer.process(block)
+        source.thread.join(timeout=0.05)
+    if text_server:
+        text_server.stop()
+    if store:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
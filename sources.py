@@ -0,0 +1,108 @@
+import sys, time
+import queue
+import threading
+import numpy as np
+import resources
+
+iq_dtypes = {
+    'float32': np.float32,
+    'int16': np.int16,
+}
+
+def iq_from_interleaved(samples):
+    """ Interleaved I, Q samples (or left, right of a stereo frame) to complex samples.
+        Integer samples are scaled to [-1, 1)
+    """
+    if samples.dtype == np.int16:
+        samples = samples.astype(np.float32) / 32768.0
+    samples = samples[:len(samples)//2*2].astype(np.float32, copy=False)
+    return samples.view(np.complex64)
+
+
+class SampleSource:
+    """ Base of sample sources read in their own thread. Blocks of samples are queued to be
+        consumed from the GUI thread with get_blocks. Raw sources deliver sound card bytes instead of samples.
+        With maxsize the reading thread waits for blocks to be consumed.
+    """
+    raw = False
+
+    def __init__(self, rate, block_time=0.1, maxsize=0):
+        self.rate = rate
+        self.block_len = max(int(rate*block_time), 1)
+        self.blocks = queue.Queue(maxsize)
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run_thread, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=1)
+
+    def run_thread(self):
+        resources.pin("capture")
+        self.run()
+
+    def run(self):
+        raise NotImplementedError
+
+    def put(self, block):
+        while self.running:
+            try:
+                self.blocks.put(block, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def finished(self):
+        """ True when the thread has ended and all blocks have been consumed
+        """
+        return self.thread is not None and not self.thread.is_alive() and self.blocks.empty()
+
+    def get_blocks(self):
+        """ All blocks received since last call
+        """
+        blocks = []
+        while True:
+            try:
+                blocks.append(self.blocks.get_nowait())
+            except queue.Empty:
+                return blocks
+
+
+class IQFileSource(SampleSource):
+    """ Interleaved I/Q samples (float32 or int16, little endian) from a file or stdin ("-").
+        Files are read at the pace of the sample rate unless realtime is False. Stdin is read as it comes.
+    """
+    def __init__(self, filename, rate, sample_format='float32', realtime=True, block_time=0.1):
+        super().__init__(rate, block_time)
+        self.filename = filename
+        self.dtype = np.dtype(iq_dtypes[sample_format]).newbyteorder('<')
+        self.realtime = realtime and filename != '-'
+
+    def run(self):
+        nbytes = self.block_len * 2 * self.dtype.itemsize
+        f = sys.stdin.buffer if self.filename == '-' else open(self.filename, 'rb')
+        t0 = time.perf_counter()
+        nb_samples = 0
+        try:
+            while self.running:
+                data = f.read(nbytes)
+                if not data:
+                    break
+                data = data[:len(data)//(2*self.dtype.itemsize)*2*self.dtype.itemsize]
+                block = iq_from_interleaved(np.frombuffer(data, dtype=self.dtype).astype(self.dtype.newbyteorder('=')))
+                self.put(block)
+                nb_samples += len(block)
+                if self.realtime:
+                    delay = t0 + nb_samples/self.rate - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+        finally:
+            if f is not sys.stdin.buffer:
+                f.close()
+        print(f"IQFileSource: end of {self.filename} after {nb_samples} samples")
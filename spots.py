@@ -0,0 +1,112 @@
+""" Callsign spots from decoded text.
+
+    A spot is reported when a callsign follows "DE" (e.g. "CQ CQ DE F4EXB") or "TEST" (contest calls).
+    Spots are indexed by (callsign, frequency bucket) and the same station is reported once per time
+    window. Index entries expire with the window so memory stays bounded. The cost per decoded character
+    is a dictionary lookup whatever the number of channels.
+"""
+import collections
+import re
+import time
+
+callsign_re = re.compile(r"^(?:[A-Z0-9]{1,3}/)?(?=[A-Z0-9]*[A-Z])[A-Z0-9]{1,3}[0-9][A-Z0-9]{0,3}[A-Z](?:/[A-Z0-9]{1,4})?$")
+spot_keywords = ("DE", "TEST")
+
+def is_callsign(word):
+    return len(word) >= 3 and callsign_re.match(word) is not None
+
+
+class Spot:
+    __slots__ = ("call", "freq", "wpm", "snr", "time")
+
+    def __init__(self, call, freq, wpm=None, snr=None, t=None):
+        self.call = call
+        self.freq = freq
+        self.wpm = wpm
+        self.snr = snr
+        self.time = t if t is not None else time.time()
+
+    def as_dict(self):
+        return {"type": "spot", "call": self.call, "freq": self.freq, "wpm": self.wpm, "snr": self.snr, "time": round(self.time, 3)}
+
+    def __str__(self):
+        wpm = f"{self.wpm:3.0f} WPM" if self.wpm else "    WPM"
+        snr = f"{self.snr:3.0f} dB" if self.snr is not None else "    dB"
+        return f"DX de MORSEANGEL: {self.freq/1000:10.1f}  {self.call:<10s} {wpm} {snr}  {time.strftime('%H%MZ', time.gmtime(self.time))}"
+
+
+class SpotIndex:
+    """ Last report time of (callsign, frequency bucket). Entries are kept in report order so that
+        expired ones are evicted from the front.
+    """
+    def __init__(self, window=600.0, bucket_hz=100.0):
+        self.window = window
+        self.bucket_hz = bucket_hz
+        self.entries = collections.OrderedDict()
+
+    def evict(self, now):
+        while self.entries:
+            key, t = next(iter(self.entries.items()))
+            if now - t < self.window:
+                break
+            del self.entries[key]
+
+    def report(self, call, freq, now):
+        """ True if the spot is new: not reported within the window in the same or a neighbour bucket
+        """
+        self.evict(now)
+        bucket = int(round(freq / self.bucket_hz))
+        for b in (bucket, bucket-1, bucket+1): # a signal on a bucket edge may move between buckets
+            if (call, b) in self.entries:
+                return False
+        self.entries[(call, bucket)] = now
+        return True
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SpotExtractor:
+    """ Assembles words per channel and reports new spots through callback(spot)
+    """
+    def __init__(self, callback=print, window=600.0, bucket_hz=100.0):
+        self.callback = callback
+        self.index = SpotIndex(window, bucket_hz)
+        self.channels = {} # channel -> [word being decoded, previous word]
+
+    def add_char(self, channel, char, freq, wpm=None, snr=None, t=None):
+        state = self.channels.get(channel)
+        if state is None:
+            state = self.channels[channel] = ["", ""]
+        if char != " ":
+            state[0] += char
+            return None
+        word, previous = state
+        if not word:
+            return None
+        state[0], state[1] = "", word
+        if previous in spot_keywords and is_callsign(word):
+            t = t if t is not None else time.time()
+            if self.index.report(word, freq, t):
+                spot = Spot(word, freq, wpm, snr, t)
+                self.callback(spot)
+                return spot
+        return None
+
+    def drop_channel(self, channel):
+        self.channels.pop(channel, None)
+
+
+def add_arguments(parser, optional=True):
+    """ optional: spots are reported with --spots, else always
+    """
+    if optional:
+        parser.add_argument("--spots", action="store_true", help="Report callsigns following DE or TEST as spots")
+    parser.add_argument("--spot-window", type=float, default=600.0, help="Report the same callsign on the same frequency once per this time in seconds (default 600)")
+
+def from_args(args, callback):
+    """ Extractor reporting spots through callback if spots are enabled else None
+    """
+    if not getattr(args, "spots", True):
+        return None
+    return SpotExtractor(callback, args.spot_window)
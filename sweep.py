@@ -0,0 +1,112 @@
+""" Architecture and hyperparameter sweep reporting the speed/accuracy Pareto front.
+
+    Each configuration of the grid is trained then evaluated in its own process:
+        - inference throughput in prediction steps per second on one core through the application path
+          and the corresponding number of real time channels per core
+        - CER at several SNRs
+
+        python sweep.py --archs MorseLSTM MorseBatchedLSTMStack --hidden 16 32 60 --look-back 150 208 --jobs 4
+
+    Configurations not beaten on both throughput and mean CER by another one form the Pareto front
+    and are marked with a star. --csv saves the table.
+"""
+import argparse, csv, itertools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+import predictions
+import training
+
+steps_per_second = training.Fs / training.decim # real time prediction rate of one channel
+
+
+def make_model(arch, layers, hidden):
+    device = torch.device('cpu')
+    nb_outputs = training.max_ele+2
+    if arch == "MorseLSTM":
+        return predictions.MorseLSTM(device, hidden_layer_size=hidden, output_size=nb_outputs)
+    model = predictions.MorseBatchedLSTMStack(device, nb_lstm_layers=layers, hidden_layer_size=hidden, output_size=nb_outputs, dropout=0.1 if layers > 1 else 0)
+    model.use_minmax = True
+    return model
+
+def grid(args):
+    configs = []
+    for arch, layers, hidden, look_back in itertools.product(args.archs, args.layers, args.hidden, args.look_back):
+        if arch == "MorseLSTM":
+            layers = 1
+        config = (arch, layers, hidden, look_back)
+        if config not in configs:
+            configs.append(config)
+    return configs
+
+def run_config(config, args):
+    """ Train and evaluate one configuration. Runs in a worker process.
+    """
+    arch, layers, hidden, look_back = config
+    torch.set_num_threads(1)
+    torch.manual_seed(args.seed)
+    model = make_model(arch, layers, hidden)
+    batch_model = training.WindowBatchModel(model)
+    loader = torch.utils.data.DataLoader(training.MorseKeyingStream(look_back, seed=args.seed), batch_size=args.batch_size)
+    optimizer = torch.optim.Adam(batch_model.parameters(), lr=args.lr)
+    loss = training.train(batch_model, loader, optimizer, args.steps, log_every=args.steps+1)
+    cers = [training.evaluate_cer(model, look_back, snr) for snr in args.snr]
+    throughput = 1 / training.step_latency(model, look_back)
+    return config, loss, throughput, cers
+
+def pareto_front(results):
+    """ Indexes of results with no other result at least as fast and as accurate and strictly better on one
+    """
+    front = []
+    for i, (_, _, throughput, cers) in enumerate(results):
+        cer = np.mean(cers)
+        dominated = False
+        for j, (_, _, other_throughput, other_cers) in enumerate(results):
+            other_cer = np.mean(other_cers)
+            if j != i and other_throughput >= throughput and other_cer <= cer and (other_throughput > throughput or other_cer < cer):
+                dominated = True
+                break
+        if not dominated:
+            front.append(i)
+    return front
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Sweep model configurations for speed and accuracy")
+    parser.add_argument("--archs", nargs="+", default=["MorseLSTM", "MorseBatchedLSTMStack"], choices=["MorseLSTM", "MorseBatchedLSTMStack"], help="Model classes")
+    parser.add_argument("--layers", type=int, nargs="+", default=[1, 2], help="LSTM layers (MorseBatchedLSTMStack)")
+    parser.add_argument("--hidden", type=int, nargs="+", default=[16, 32, 60], help="Hidden layer sizes")
+    parser.add_argument("--look-back", type=int, nargs="+", default=[training.look_back_len()], help="Look back window lengths")
+    parser.add_argument("--steps", type=int, default=2000, help="Training steps per configuration")
+    parser.add_argument("--batch-size", type=int, default=32, help="Batch size")
+    parser.add_argument("--lr", type=float, default=2e-3, help="Learning rate")
+    parser.add_argument("--snr", type=float, nargs="+", default=[-10, -15, -17, -20], help="Evaluation SNRs in dB")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of weights and data")
+    parser.add_argument("--jobs", type=int, default=2, help="Parallel processes")
+    parser.add_argument("--csv", help="Save results to this CSV file")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    configs = grid(args)
+    print(f"Sweeping {len(configs)} configurations on {args.jobs} processes")
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        results = list(executor.map(run_config, configs, itertools.repeat(args)))
+    front = pareto_front(results)
+    header = ["arch", "layers", "hidden", "look_back", "loss", "steps/s", "ch/core"] + [f"CER {snr:g}dB" for snr in args.snr] + ["mean CER", "pareto"]
+    rows = []
+    for i, (config, loss, throughput, cers) in sorted(enumerate(results), key=lambda x: -x[1][2]):
+        rows.append(list(config) + [f"{loss:.5f}", f"{throughput:.0f}", f"{throughput/steps_per_second:.1f}"] + [f"{c:.3f}" for c in cers] + [f"{np.mean(cers):.3f}", "*" if i in front else ""])
+    widths = [max(len(str(r[k])) for r in rows + [header]) for k in range(len(header))]
+    print()
+    print(" ".join(f"{h:>{w}s}" for h, w in zip(header, widths)))
+    for row in rows:
+        print(" ".join(f"{str(v):>{w}s}" for v, w in zip(row, widths)))
+    if args.csv:
+        with open(args.csv, "w", newline="") as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
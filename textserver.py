@@ -0,0 +1,264 @@
+""" Streaming of decoded text to network clients.
+
+    An asyncio server running in its own thread fans out decoded characters to:
+        - raw TCP clients (telnet style): one line per decoded word with UTC time and frequency
+              14:03:22Z    700.0 F4EXB
+        - WebSocket clients: one JSON message per character
+              {"type": "char", "char": "F", "time": 1700000000.123, "delay": 0.82, "freq": 700.0}
+
+    Each client has a bounded send queue: when a client does not keep up its oldest messages are dropped
+    so that it never slows down the decoder or the other clients. Messages are encoded once for all clients.
+
+        python morseangel.py --text-port 7300 --ws-port 7301
+"""
+import asyncio
+import base64
+import collections
+import hashlib
+import json
+import struct
+import threading
+import time
+import metrics
+
+ws_guid = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+def ws_frame(payload, opcode=0x1):
+    """ Unmasked server to client WebSocket frame
+    """
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+
+class Client:
+    """ Bounded queue of encoded messages and the task writing them to the client
+    """
+    def __init__(self, writer, queue_len, m_dropped):
+        self.writer = writer
+        self.messages = collections.deque(maxlen=queue_len)
+        self.pending = asyncio.Event()
+        self.m_dropped = m_dropped
+        self.closed = False
+
+    def send(self, message):
+        if len(self.messages) == self.messages.maxlen:
+            self.m_dropped.inc() # oldest message is discarded by the deque
+        self.messages.append(message)
+        self.pending.set()
+
+    def close(self):
+        self.closed = True
+        self.pending.set()
+
+    async def write_loop(self):
+        try:
+            while True:
+                await self.pending.wait()
+                self.pending.clear()
+                if self.messages:
+                    data = b"".join(self.messages)
+                    self.messages.clear()
+                    self.writer.write(data)
+                    await self.writer.drain()
+                if self.closed: # pending messages are flushed first
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.closed = True
+            self.writer.close()
+
+
+class TextServer:
+    def __init__(self, host="127.0.0.1", tcp_port=None, ws_port=None, queue_len=1000):
+        self.host = host
+        self.tcp_port = tcp_port
+        self.ws_port = ws_port
+        self.queue_len = queue_len
+        self.tcp_clients = set()
+        self.ws_clients = set()
+        self.words = {} # frequency -> (time of first character, word being decoded)
+        self.loop = None
+        self.thread = None
+        self.started = threading.Event()
+        self.stopping = None
+        self.error = None # error that prevented the server from starting, raised by start
+        self.m_clients = metrics.registry.gauge("text_clients", "Connected text stream clients")
+        self.m_dropped = metrics.registry.counter("text_dropped_messages", "Messages dropped for clients not keeping up")
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="TextServer", daemon=True)
+        self.thread.start()
+        self.started.wait()
+        if self.error:
+            raise self.error
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.started.set() # start does not wait forever when serve failed
+
+    async def serve(self):
+        servers = []
+        try:
+            if self.tcp_port is not None:
+                servers.append(await asyncio.start_server(self.handle_tcp, self.host, self.tcp_port, backlog=1024))
+            if self.ws_port is not None:
+                servers.append(await asyncio.start_server(self.handle_ws, self.host, self.ws_port, backlog=1024))
+        except OSError as e: # port in use, unknown host
+            self.error = e
+            for server in servers:
+                server.close()
+            return
+        self.stopping = asyncio.Event()
+        self.addresses = [server.sockets[0].getsockname() for server in servers]
+        for address in self.addresses:
+            print(f"TextServer: listening on {address}")
+        self.started.set()
+        await self.stopping.wait()
+        for server in servers:
+            server.close()
+        for client in self.tcp_clients | self.ws_clients:
+            client.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        if tasks: # handlers end when their connection is closed
+            await asyncio.wait(tasks, timeout=1)
+
+    def stop(self):
+        if self.stopping and self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self.stopping.set)
+            self.thread.join(timeout=2)
+
+    def update_clients(self):
+        self.m_clients.set(len(self.tcp_clients) + len(self.ws_clients))
+
+    async def handle_tcp(self, reader, writer):
+        client = Client(writer, self.queue_len, self.m_dropped)
+        self.tcp_clients.add(client)
+        self.update_clients()
+        task = asyncio.ensure_future(client.write_loop())
+        try:
+            while not client.closed and await reader.read(1024): # ignore input until disconnected
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            client.close()
+            self.tcp_clients.discard(client)
+            self.update_clients()
+            await task
+
+    async def handle_ws(self, reader, writer):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+        key = None
+        for line in request.split(b"\r\n"):
+            name, _, value = line.partition(b":")
+            if name.strip().lower() == b"sec-websocket-key":
+                key = value.strip()
+        if key is None:
+            writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n")
+            writer.close()
+            return
+        accept = base64.b64encode(hashlib.sha1(key + ws_guid).digest())
+        writer.write(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+        client = Client(writer, self.queue_len, self.m_dropped)
+        self.ws_clients.add(client)
+        self.update_clients()
+        task = asyncio.ensure_future(client.write_loop())
+        try:
+            while not client.closed:
+                opcode, payload = await self.read_ws_frame(reader)
+                if opcode == 0x8: # close
+                    client.send(ws_frame(payload[:2], 0x8))
+                    break
+                if opcode == 0x9: # ping
+                    client.send(ws_frame(payload, 0xA))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            client.close()
+            self.ws_clients.discard(client)
+            self.update_clients()
+            await task
+
+    @staticmethod
+    async def read_ws_frame(reader):
+        b0, b1 = await reader.readexactly(2)
+        length = b1 & 0x7F
+        if length == 126:
+            length, = struct.unpack("!H", await reader.readexactly(2))
+        elif length == 127:
+            length, = struct.unpack("!Q", await reader.readexactly(8))
+        mask = await reader.readexactly(4) if b1 & 0x80 else None
+        payload = await reader.readexactly(length)
+        if mask:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return b0 & 0x0F, payload
+
+    def publish_char(self, char, keyed=None, delay=0.0, freq=0.0):
+        """ Thread safe: called from the decoder thread(s)
+        """
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.on_char, char, keyed if keyed else time.time(), delay, freq)
+
+    def on_char(self, char, keyed, delay, freq):
+        if self.ws_clients:
+            message = ws_frame(json.dumps({"type": "char", "char": char, "time": round(keyed, 3), "delay": round(delay, 3), "freq": freq}).encode())
+            for client in self.ws_clients:
+                client.send(message)
+        key = round(freq, 1)
+        if char == " ":
+            if key in self.words:
+                word_time, word = self.words.pop(key)
+                if self.tcp_clients:
+                    line = f"{time.strftime('%H:%M:%SZ', time.gmtime(word_time))} {freq:8.1f} {word}\r\n".encode()
+                    for client in self.tcp_clients:
+                        client.send(line)
+        else:
+            word_time, word = self.words.get(key, (keyed, ""))
+            self.words[key] = (word_time, word + char)
+
+    def publish(self, event, line=None):
+        """ Thread safe publication of another kind of event: a dict sent as JSON to WebSocket clients
+            and an optional line to TCP clients
+        """
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.on_event, event, line)
+
+    def on_event(self, event, line):
+        if self.ws_clients:
+            message = ws_frame(json.dumps(event).encode())
+            for client in self.ws_clients:
+                client.send(message)
+        if line and self.tcp_clients:
+            data = (line + "\r\n").encode()
+            for client in self.tcp_clients:
+                client.send(data)
+
+
+def add_arguments(parser):
+    parser.add_argument("--text-port", type=int, help="Stream decoded words as text lines to TCP clients on this port")
+    parser.add_argument("--ws-port", type=int, help="Stream decoded characters as JSON to WebSocket clients on this port")
+    parser.add_argument("--serve-host", default="127.0.0.1", help="Address of the text servers (default 127.0.0.1)")
+
+def from_args(args):
+    """ Started server if a port is given else None
+    """
+    if args.text_port is None and args.ws_port is None:
+        return None
+    server = TextServer(args.serve_host, args.text_port, args.ws_port)
+    server.start()
+    return server
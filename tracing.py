@@ -0,0 +1,128 @@
+""" Opt-in recording of processing spans to a Chrome trace-event JSON file.
+
+    The file can be opened in chrome://tracing or https://ui.perfetto.dev to see which thread and stage
+    took the time between audio input and decoded characters:
+
+        python morseangel.py --trace trace.json
+
+    Spans are complete ("X") events with the thread id. Hops between threads (the dataq queue and Qt
+    queued signals) are flow events linking the slice that sends to the slice that receives.
+    When tracing is disabled span() returns a shared no-op context manager.
+"""
+import json
+import threading
+import time
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+null_span = NullSpan()
+
+
+class Span:
+    __slots__ = ("tracer", "name", "cat", "start")
+
+    def __init__(self, tracer, name, cat):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.complete(self.name, self.start, time.perf_counter(), self.cat)
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.filename = None
+        self.events = []
+        self.threads = set()
+        self.t0 = 0.0
+
+    def start(self, filename):
+        self.filename = filename
+        self.events = []
+        self.threads = set()
+        self.t0 = time.perf_counter()
+        self.enabled = True
+
+    def stop(self):
+        """ Stop recording and write the trace file
+        """
+        if not self.enabled:
+            return
+        self.enabled = False
+        with open(self.filename, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+        print(f"Tracer: {len(self.events)} events written to {self.filename}")
+
+    def span(self, name, cat="stage"):
+        if not self.enabled:
+            return null_span
+        return Span(self, name, cat)
+
+    def thread_id(self):
+        tid = threading.get_native_id()
+        if tid not in self.threads:
+            self.threads.add(tid)
+            self.events.append({"name": "thread_name", "ph": "M", "pid": 0, "tid": tid, "args": {"name": threading.current_thread().name}})
+        return tid
+
+    def us(self, t):
+        return (t - self.t0) * 1e6
+
+    def complete(self, name, start, end, cat="stage"):
+        """ Span of the calling thread between perf_counter times start and end
+        """
+        if self.enabled:
+            self.events.append({"name": name, "cat": cat, "ph": "X", "ts": self.us(start), "dur": (end - start)*1e6, "pid": 0, "tid": self.thread_id()})
+
+    def flow_start(self, name, flow_id):
+        """ Start of a hop to another thread, bound to the enclosing span
+        """
+        if self.enabled:
+            self.events.append({"name": name, "cat": "hop", "ph": "s", "id": flow_id, "ts": self.us(time.perf_counter()), "pid": 0, "tid": self.thread_id()})
+
+    def flow_end(self, name, flow_id):
+        """ End of a hop, bound to the enclosing span of the receiving thread
+        """
+        if self.enabled:
+            self.events.append({"name": name, "cat": "hop", "ph": "f", "bp": "e", "id": flow_id, "ts": self.us(time.perf_counter()), "pid": 0, "tid": self.thread_id()})
+
+
+class Hop:
+    """ Numbers messages of a FIFO hop (queue or queued Qt signal) on both sides so that
+        sender and receiver flow events share the same id without changing the messages.
+    """
+    nb_hops = 0
+
+    def __init__(self, name):
+        self.name = name
+        Hop.nb_hops += 1
+        self.base = Hop.nb_hops << 32
+        self.nb_sent = 0
+        self.nb_received = 0
+
+    def send(self):
+        if tracer.enabled:
+            tracer.flow_start(self.name, self.base + self.nb_sent)
+        self.nb_sent += 1
+
+    def receive(self):
+        if tracer.enabled:
+            tracer.flow_end(self.name, self.base + self.nb_received)
+        self.nb_received += 1
+
+
+tracer = Tracer()
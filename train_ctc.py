@@ -0,0 +1,120 @@
+""" Training of a character output model (MorseCTC) with CTC loss and comparison with the element models.
+
+    The MorseTCN trunk outputs log probabilities of the characters of the alphabet plus space and of the
+    CTC blank at each envelope step. It is trained on random keyed text with its transcription, after a
+    short start on the character ends known to MorseGen. Characters come out of a streaming CTC decoder (greedy best path or prefix
+    beam) at a fixed cost per step instead of MorseDecoderRegen thresholds on the 7 element signals.
+    CER at several SNRs and compute time per step of model and decoder are compared with the LSTM:
+
+        python train_ctc.py --channels 48 --layers 7 --align-steps 500 --steps 3000
+
+    Weights are saved to models/ctc.model. They load in the application with:
+
+        python morseangel.py --model models/ctc.model
+"""
+import argparse, time
+import numpy as np
+import torch
+import torch.nn as nn
+import decoder
+import predictions
+import training
+from train_tcn import block_time
+
+
+def train(model, loader, optimizer, steps, aligned=False, log_every=100, max_norm=1.0):
+    """ CTC loss on batches of (signals, labels, signal lengths, label lengths, alignments), or with aligned
+        frame wise loss on the alignments. A causal model trained with CTC from scratch stays on the plateau
+        of blank everywhere for thousands of steps: a character can only be recognized once it has been
+        keyed but the first alignments spread it over all steps. A few hundred aligned steps show where
+        characters are emitted and CTC training then takes over.
+    """
+    loss_function = nn.NLLLoss() if aligned else nn.CTCLoss(blank=0, zero_infinity=True)
+    model.train()
+    t0 = time.time()
+    running_loss = 0.0
+    for step, (X, y, X_lengths, y_lengths, A) in zip(range(1, steps+1), loader):
+        optimizer.zero_grad()
+        logp, _ = model.stream(X)
+        if aligned:
+            loss = loss_function(logp, A)
+        else:
+            loss = loss_function(logp.permute(2, 0, 1), y, X_lengths, y_lengths) # (steps, batch, labels)
+        loss.backward()
+        nn.utils.clip_grad_norm_(model.parameters(), max_norm)
+        optimizer.step()
+        running_loss += loss.item()
+        if step % log_every == 0:
+            print(f"step {step:6d} loss {running_loss/log_every:10.6f} {time.time()-t0:7.1f} s")
+            running_loss = 0.0
+    model.eval()
+
+def decoder_step_time(preds, morse_decoder, signal, block_len=41):
+    """ Mean time in seconds of the decoder per step on the outputs of preds for signal
+    """
+    outputs = []
+    for i in range(0, len(signal), block_len):
+        preds.new_data(signal[i:i+block_len])
+        if preds.p_preds_t is not None:
+            outputs.append(np.asarray(preds.p_preds_t))
+    outputs = np.concatenate(outputs, axis=1)
+    t0 = time.perf_counter()
+    for j in range(outputs.shape[1]):
+        morse_decoder.new_sample(outputs[:,j])
+    return (time.perf_counter() - t0) / outputs.shape[1]
+
+def report(name, model, look_back, make_decoder, snrs):
+    """ Name, parameters, model step time, decoder step time, block time and CER at each SNR
+    """
+    cers = [training.evaluate_cer(model, look_back, snr, morse_decoder=make_decoder()) for snr in snrs]
+    signal = np.random.rand(look_back + 41*50).astype(np.float32)
+    decode = decoder_step_time(training.make_predictions(model, look_back), make_decoder(), signal)
+    return name, sum(p.numel() for p in model.parameters()), training.step_latency(model, look_back), decode, block_time(model, look_back), cers
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Train a MorseCTC and compare it with the LSTM")
+    parser.add_argument("--channels", type=int, default=48, help="Channels of the convolution layers")
+    parser.add_argument("--kernel-size", type=int, default=3, help="Kernel size of the convolutions")
+    parser.add_argument("--layers", type=int, default=7, help="Layers. Dilation doubles at each layer (7 layers of kernel 3: 255 samples)")
+    parser.add_argument("--steps", type=int, default=3000, help="Optimizer steps with CTC loss")
+    parser.add_argument("--batch-size", type=int, default=8, help="Batch size (texts per step)")
+    parser.add_argument("--chars", type=int, default=20, help="Characters per training text")
+    parser.add_argument("--lr", type=float, default=2e-3, help="Learning rate")
+    parser.add_argument("--beam-width", type=int, default=8, help="Beam width of the prefix beam decoder")
+    parser.add_argument("--snr", type=float, nargs="+", default=[-10, -15, -17, -20], help="Evaluation SNRs in dB")
+    parser.add_argument("--train-snr", type=float, nargs=2, default=[-20, -5], help="SNR range in dB of the training data")
+    parser.add_argument("--align-steps", type=int, default=500, help="Optimizer steps with the frame wise loss on MorseGen alignments before CTC")
+    parser.add_argument("--threads", type=int, default=1, help="Torch threads (latency is measured with this setting)")
+    parser.add_argument("--lstm", default="models/default.model", help="LSTM weights to compare with")
+    parser.add_argument("--init", help="Start from these MorseCTC weights")
+    parser.add_argument("--output", default="models/ctc.model", help="Output weights file")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    torch.set_num_threads(args.threads)
+    device = torch.device('cpu')
+    lstm = predictions.Predictions(device=device)
+    lstm.load_model(args.lstm)
+    ctc = predictions.MorseCTC(device, args.channels, args.kernel_size, args.layers)
+    if args.init:
+        ctc.load_state_dict(torch.load(args.init, map_location=device))
+    print(f"MorseCTC receptive field {ctc.receptive_field} samples, {len(ctc.alphabet)} characters, {sum(p.numel() for p in ctc.parameters())} parameters")
+    dataset = training.MorseTextStream(ctc.alphabet, SNR_dB=args.train_snr, nchars=args.chars, nwords=max(args.chars//5, 1))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, collate_fn=training.pad_text_batch)
+    optimizer = torch.optim.Adam(ctc.parameters(), lr=args.lr)
+    train(ctc, loader, optimizer, args.align_steps, aligned=True)
+    train(ctc, loader, optimizer, args.steps)
+    torch.save(ctc.state_dict(), args.output)
+    print(f"Saved {args.output}")
+    results = [report("LSTM regen", lstm.model, lstm.look_back, decoder.MorseDecoderRegen, args.snr),
+               report("CTC greedy", ctc, ctc.receptive_field, lambda: decoder.CTCGreedyDecoder(ctc.alphabet), args.snr),
+               report(f"CTC beam {args.beam_width}", ctc, ctc.receptive_field, lambda: decoder.CTCBeamDecoder(ctc.alphabet, args.beam_width), args.snr)]
+    print()
+    print(f"{'path':12s} {'params':>7s} {'model (us)':>10s} {'decoder (us)':>12s} {'block (ms)':>10s} " + " ".join(f"{f'CER {snr:g}dB':>11s}" for snr in args.snr))
+    for name, nb_params, step, decode, block, cers in results:
+        print(f"{name:12s} {nb_params:7d} {step*1e6:10.1f} {decode*1e6:12.1f} {block*1e3:10.2f} " + " ".join(f"{c:11.3f}" for c in cers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+""" Data parallel training of MorseBatchedLSTMStack models on CPU with torch.distributed (gloo backend).
+
+    Single host with 4 processes:
+        python train_ddp.py --nprocs 4 --output models/ddp.model
+
+    Two hosts with 4 processes each (run on each host with its own --node-rank):
+        python train_ddp.py --nprocs 4 --nnodes 2 --node-rank 0 --master-addr 192.168.0.10 --output models/ddp.model
+
+    Also works when launched by torchrun (RANK, WORLD_SIZE, MASTER_ADDR... set in the environment)
+"""
+import os, argparse
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from predictions import MorseBatchedLSTMStack
+import training
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Distributed data parallel training on CPU")
+    parser.add_argument("--nprocs", type=int, default=2, help="Number of training processes on this host")
+    parser.add_argument("--nnodes", type=int, default=1, help="Number of hosts")
+    parser.add_argument("--node-rank", type=int, default=0, help="Rank of this host")
+    parser.add_argument("--master-addr", default="127.0.0.1", help="Address of the rank 0 host")
+    parser.add_argument("--master-port", default="29500", help="Port of the rank 0 host")
+    parser.add_argument("--threads", type=int, default=1, help="Torch threads per process")
+    parser.add_argument("--layers", type=int, default=2, help="Number of LSTM layers")
+    parser.add_argument("--hidden", type=int, default=60, help="LSTM hidden layer size")
+    parser.add_argument("--dropout", type=float, default=0.1, help="Dropout between LSTM layers")
+    parser.add_argument("--look-back", type=int, default=training.look_back_len(), help="Look back window length")
+    parser.add_argument("--batch-size", type=int, default=32, help="Batch size per process")
+    parser.add_argument("--steps", type=int, default=2000, help="Optimizer steps")
+    parser.add_argument("--lr", type=float, default=1e-3, help="Learning rate")
+    parser.add_argument("--snr", type=float, nargs=2, default=[-20, -17], help="SNR range in dB of the training data")
+    parser.add_argument("--seed", type=int, default=0, help="Base seed of the data stream")
+    parser.add_argument("--init", help="Start from these weights")
+    parser.add_argument("--output", default="models/ddp.model", help="Output weights file")
+    return parser.parse_args()
+
+def worker(local_rank, args):
+    if "RANK" in os.environ: # torchrun
+        rank = int(os.environ["RANK"])
+        world_size = int(os.environ["WORLD_SIZE"])
+    else:
+        os.environ["MASTER_ADDR"] = args.master_addr
+        os.environ["MASTER_PORT"] = args.master_port
+        rank = args.node_rank*args.nprocs + local_rank
+        world_size = args.nnodes*args.nprocs
+    torch.set_num_threads(args.threads)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    device = torch.device('cpu')
+    model = MorseBatchedLSTMStack(device, nb_lstm_layers=args.layers, hidden_layer_size=args.hidden, output_size=training.max_ele+2, dropout=args.dropout)
+    model.use_minmax = True
+    if args.init:
+        model.load_state_dict(torch.load(args.init, map_location=device))
+    # DDP broadcasts rank 0 parameters at construction then all-reduces (averages) gradients at each backward
+    ddp_model = DistributedDataParallel(training.WindowBatchModel(model))
+    stream = training.MorseKeyingStream(args.look_back, SNR_dB=args.snr, shard=rank, nb_shards=world_size, seed=args.seed)
+    loader = torch.utils.data.DataLoader(stream, batch_size=args.batch_size)
+    optimizer = torch.optim.Adam(ddp_model.parameters(), lr=args.lr)
+    loss = training.train(ddp_model, loader, optimizer, args.steps, rank=rank)
+    if rank == 0:
+        torch.save(model.state_dict(), args.output)
+        print(f"final loss: {loss:7.5f} on {world_size} processes saved to {args.output}")
+    dist.destroy_process_group()
+
+def main():
+    args = get_args()
+    if "RANK" in os.environ:
+        worker(int(os.environ.get("LOCAL_RANK", 0)), args)
+    else:
+        mp.spawn(worker, args=(args,), nprocs=args.nprocs)
+
+
+if __name__ == '__main__':
+    main()
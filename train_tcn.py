@@ -0,0 +1,78 @@
+""" Training of a causal dilated temporal convolution network (MorseTCN) and comparison with the LSTM.
+
+    The TCN learns the same 7 outputs (cs, ws, e0..e4) on MorseGen data as the LSTM models. Its inference
+    computes all steps of a block at once with the tail of each layer carried between blocks instead of
+    running the look back window through the recurrence at each step. Both models are compared for CER at
+    several SNRs and compute time per step and per 0.5 s envelope block through the application path:
+
+        python train_tcn.py --channels 32 --layers 7 --steps 3000
+
+    Weights are saved to models/tcn.model. They load in the application with:
+
+        python morseangel.py --model models/tcn.model
+"""
+import argparse, time
+import numpy as np
+import torch
+import predictions
+import training
+
+
+def block_time(model, look_back, block_len=41, nb_blocks=50):
+    """ Mean compute time in seconds of a block of envelope samples (0.5 s at 83.3 samples/s)
+    """
+    model.eval()
+    preds = training.make_predictions(model, look_back)
+    signal = np.random.rand(look_back + block_len*nb_blocks).astype(np.float32)
+    preds.new_data(signal[:look_back]) # warm up
+    t0 = time.perf_counter()
+    for i in range(look_back, len(signal), block_len):
+        preds.new_data(signal[i:i+block_len])
+    return (time.perf_counter() - t0) / nb_blocks
+
+def report(name, model, look_back, snrs):
+    cers = [training.evaluate_cer(model, look_back, snr) for snr in snrs]
+    return name, sum(p.numel() for p in model.parameters()), look_back, training.step_latency(model, look_back), block_time(model, look_back), cers
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Train a MorseTCN and compare it with the LSTM")
+    parser.add_argument("--channels", type=int, default=32, help="Channels of the convolution layers")
+    parser.add_argument("--kernel-size", type=int, default=3, help="Kernel size of the convolutions")
+    parser.add_argument("--layers", type=int, default=7, help="Layers. Dilation doubles at each layer (7 layers of kernel 3: 255 samples)")
+    parser.add_argument("--steps", type=int, default=3000, help="Optimizer steps")
+    parser.add_argument("--batch-size", type=int, default=32, help="Batch size")
+    parser.add_argument("--lr", type=float, default=2e-3, help="Learning rate")
+    parser.add_argument("--snr", type=float, nargs="+", default=[-10, -15, -17, -20], help="Evaluation SNRs in dB")
+    parser.add_argument("--train-snr", type=float, nargs=2, default=[-20, -17], help="SNR range in dB of the training data")
+    parser.add_argument("--threads", type=int, default=1, help="Torch threads (latency is measured with this setting)")
+    parser.add_argument("--lstm", default="models/default.model", help="LSTM weights to compare with")
+    parser.add_argument("--init", help="Start from these TCN weights")
+    parser.add_argument("--output", default="models/tcn.model", help="Output weights file")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    torch.set_num_threads(args.threads)
+    device = torch.device('cpu')
+    lstm = predictions.Predictions(device=device)
+    lstm.load_model(args.lstm)
+    tcn = predictions.MorseTCN(device, args.channels, args.kernel_size, args.layers, training.max_ele+2)
+    tcn.use_minmax = True
+    if args.init:
+        tcn.load_state_dict(torch.load(args.init, map_location=device))
+    print(f"MorseTCN receptive field {tcn.receptive_field} samples, {sum(p.numel() for p in tcn.parameters())} parameters")
+    loader = torch.utils.data.DataLoader(training.MorseKeyingStream(tcn.receptive_field, SNR_dB=args.train_snr), batch_size=args.batch_size)
+    optimizer = torch.optim.Adam(tcn.parameters(), lr=args.lr)
+    training.train(tcn, loader, optimizer, args.steps)
+    torch.save(tcn.state_dict(), args.output)
+    print(f"Saved {args.output}")
+    results = [report("LSTM l2h60", lstm.model, lstm.look_back, args.snr),
+               report(f"TCN c{args.channels}l{args.layers}", tcn, tcn.receptive_field, args.snr)]
+    print()
+    print(f"{'model':14s} {'params':>7s} {'look back':>9s} {'step (us)':>10s} {'block (ms)':>10s} " + " ".join(f"{f'CER {snr:g}dB':>11s}" for snr in args.snr))
+    for name, nb_params, look_back, step, block, cers in results:
+        print(f"{name:14s} {nb_params:7d} {look_back:9d} {step*1e6:10.1f} {block*1e3:10.2f} " + " ".join(f"{c:11.3f}" for c in cers))
+
+
+if __name__ == '__main__':
+    main()
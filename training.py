@@ -0,0 +1,242 @@
+import os, sys, random, time
+import numpy as np
+import torch
+import torch.nn as nn
+import decoder
+from predictions import Predictions, MorseTCN, MorseCTC, TCNPredictions
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'notebooks'))
+import MorseGen
+
+# Same parameters as the notebooks that produced models/default.model (RNN-Morse-chars_single-ord36e96)
+Fs = 8000
+decim = 96
+code_speed = 13
+max_ele = 5
+teststr = "F5SFU DE F4EXB = R TNX RPT ES INFO ALEX = RIG IS FTDX1200 PWR 100W ANT IS YAGI = WX IS SUNNY ES WARM 32C = HW AR F5SFU DE F4EXB KN"
+
+
+def look_back_len(max_elt=max_ele):
+    """ Number of envelope samples to look back: slightly more than the longest character plus a word space
+    """
+    samples_per_dit = MorseGen.Morse.nb_samples_per_dit(Fs, code_speed)
+    return int((samples_per_dit/decim)*(4*max_elt+7)) + 1
+
+def get_new_data(morse_gen, SNR_dB=-23, nchars=132, nwords=27, morse_cwss=None, max_elt=max_ele):
+    """ Envelope, noisy signal and labels (cs, ws, e0..e4 columns) as in the notebooks
+    """
+    if not morse_cwss:
+        morse_cwss = MorseGen.get_morse_eles(nchars=nchars, nwords=nwords, max_elt=max_elt)
+    samples_per_dit = morse_gen.nb_samples_per_dit(Fs, code_speed)
+    label_df = morse_gen.encode_df_decim_ord_morse(morse_cwss, samples_per_dit, decim, max_elt, overlap_elt_sep=True)
+    envelope = label_df['env'].to_numpy()
+    label_df = label_df.drop(columns=['env', 'ele'])
+    SNR_linear = 10.0**(SNR_dB/10.0)
+    SNR_linear *= 256 # Apply original FFT
+    power = np.sum(envelope**2)/len(envelope)
+    noise_power = power/SNR_linear
+    noise = np.sqrt(noise_power)*np.random.normal(0, 1, len(envelope))
+    signal = (envelope + noise)**2
+    signal[signal > 1.0] = 1.0
+    return envelope, signal, label_df.to_numpy(dtype=np.float32)
+
+
+class MorseKeyingStream(torch.utils.data.IterableDataset):
+    """ Endless synthetic stream of (look back window, labels) pairs generated by MorseGen.
+        Each shard (distributed rank and data loader worker) draws from its own random sequence
+        so that shards never see the same data.
+    """
+    def __init__(self, look_back, SNR_dB=(-20, -17), nchars=132, nwords=27, max_elt=max_ele, shard=0, nb_shards=1, seed=0):
+        super().__init__()
+        self.look_back = look_back
+        self.SNR_dB = SNR_dB
+        self.nchars = nchars
+        self.nwords = nwords
+        self.max_elt = max_elt
+        self.shard = shard
+        self.nb_shards = nb_shards
+        self.seed = seed
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        shard = self.shard
+        nb_shards = self.nb_shards
+        if worker_info is not None:
+            shard = shard*worker_info.num_workers + worker_info.id
+            nb_shards *= worker_info.num_workers
+        seed = self.seed*nb_shards + shard
+        random.seed(seed) # MorseGen draws from the global generators
+        np.random.seed(seed)
+        morse_gen = MorseGen.Morse()
+        while True:
+            SNR_dB = np.random.uniform(*self.SNR_dB)
+            _, signal, labels = get_new_data(morse_gen, SNR_dB, self.nchars, self.nwords, max_elt=self.max_elt)
+            X = torch.FloatTensor(signal)
+            y = torch.tensor(labels)
+            for i in range(len(X) - self.look_back):
+                yield X[i:i+self.look_back], y[i+self.look_back]
+
+
+class MorseTextStream(torch.utils.data.IterableDataset):
+    """ Endless synthetic stream of (noisy envelope, text labels, alignment) for CTC training: random text of
+        nchars characters in nwords words keyed by MorseGen and followed by a word space. Labels index alphabet
+        from 1 (0 is the CTC blank), the text ends with a space for the final word space. The alignment has
+        the label of each character at the step its character separator starts (space at word separators)
+        and blank elsewhere. Sharded like MorseKeyingStream.
+    """
+    def __init__(self, alphabet, SNR_dB=(-20, -17), nchars=20, nwords=4, chars="ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789/=", shard=0, nb_shards=1, seed=0):
+        super().__init__()
+        self.alphabet = alphabet
+        self.SNR_dB = SNR_dB
+        self.nchars = nchars
+        self.nwords = nwords
+        self.chars = chars
+        self.shard = shard
+        self.nb_shards = nb_shards
+        self.seed = seed
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        shard = self.shard
+        nb_shards = self.nb_shards
+        if worker_info is not None:
+            shard = shard*worker_info.num_workers + worker_info.id
+            nb_shards *= worker_info.num_workers
+        seed = self.seed*nb_shards + shard
+        random.seed(seed)
+        np.random.seed(seed)
+        morse_gen = MorseGen.Morse()
+        while True:
+            SNR_dB = np.random.uniform(*self.SNR_dB)
+            text = ' '.join(MorseGen.get_morse_str(self.nchars, self.nwords, self.chars).split()) + " "
+            # a last word is keyed so that the text is followed by a word space then cut at its end
+            _, signal, labels = get_new_data(morse_gen, SNR_dB, morse_cwss=morse_gen.cws_to_cwss(text + "E"))
+            cs, ws = labels[:,0] > 0.5, labels[:,1] > 0.5
+            end = np.nonzero(ws[:-1] & ~ws[1:])[0][-1] + 1
+            steps = np.nonzero((cs[1:] & ~cs[:-1]) | (ws[1:] & ~ws[:-1]))[0][:len(text)] + 1
+            y = torch.tensor([self.alphabet.index(c)+1 for c in text])
+            alignment = torch.zeros(end, dtype=torch.long)
+            alignment[steps] = y
+            yield torch.FloatTensor(signal[:end]), y, alignment
+
+def pad_text_batch(batch):
+    """ Collates (signal, labels, alignment) of different lengths: signals (batch, 1, steps) padded with
+        zeros (silence), concatenated labels and the lengths of each as expected by nn.CTCLoss, alignments
+        (batch, steps) padded with blank
+    """
+    signals, labels, alignments = zip(*batch)
+    X = nn.utils.rnn.pad_sequence(signals, batch_first=True).unsqueeze(1)
+    A = nn.utils.rnn.pad_sequence(alignments, batch_first=True)
+    return X, torch.cat(labels), torch.tensor([len(x) for x in signals]), torch.tensor([len(y) for y in labels]), A
+
+
+class WindowBatchModel(nn.Module):
+    """ Runs a batch of look back windows through a model with a zeroed hidden cell for each window.
+        This is what the notebooks do one window at a time with zero_hidden_cell() and batch size 1.
+        The wrapped model is a submodule so its state_dict stays loadable by Predictions.load_model.
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, X):
+        if not hasattr(self.model, 'lstm'): # windows are independent already e.g. MorseTCN
+            return self.model(X)
+        lstm_out, _ = self.model.lstm(X.transpose(0, 1).unsqueeze(-1)) # (look_back, batch, 1)
+        y = self.model.linear(lstm_out[-1])
+        if getattr(self.model, 'use_minmax', False):
+            y = y - y.min(1, keepdim=True)[0]
+            y = y / y.max(1, keepdim=True)[0]
+        return y
+
+
+def train(model, loader, optimizer, steps, loss_function=None, log_every=100, rank=0):
+    """ Train on a stream for a number of optimizer steps. Returns the mean loss of the last logging period.
+    """
+    if loss_function is None:
+        loss_function = nn.MSELoss()
+    model.train()
+    losses = []
+    mean_loss = 0
+    for step, (X, y) in enumerate(loader):
+        if step >= steps:
+            break
+        optimizer.zero_grad()
+        loss = loss_function(model(X), y)
+        loss.backward()
+        optimizer.step()
+        losses.append(loss.item())
+        if (step+1) % log_every == 0:
+            mean_loss = np.mean(losses)
+            losses = []
+            if rank == 0:
+                print(f"step {step+1:6d} loss: {mean_loss:7.5f}")
+    if losses:
+        mean_loss = np.mean(losses)
+    return mean_loss
+
+
+def levenshtein(a, b):
+    prev = list(range(len(b)+1))
+    for i, ca in enumerate(a):
+        cur = [i+1]
+        for j, cb in enumerate(b):
+            cur.append(min(prev[j+1]+1, cur[j]+1, prev[j]+(ca != cb)))
+        prev = cur
+    return prev[-1]
+
+def cer(ref, hyp):
+    """ Character error rate of decoded text against reference text. Runs of spaces count as one.
+    """
+    ref = ' '.join(ref.split())
+    hyp = ' '.join(hyp.split())
+    return levenshtein(ref, hyp) / max(len(ref), 1)
+
+def make_predictions(model, look_back):
+    """ Application inference path of a model: block streaming for MorseTCN, a window per step for LSTMs
+    """
+    if isinstance(model, MorseTCN):
+        preds = TCNPredictions(model, device=torch.device('cpu'))
+        preds.lp = not isinstance(model, MorseCTC)
+        return preds
+    return Predictions(model=model, look_back=look_back, device=torch.device('cpu'))
+
+def decode_signal(preds, signal, block_len=93, morse_decoder=None):
+    """ Run an envelope signal through a Predictions instance and the regenerative decoder (or the given
+        decoder e.g. of CTC outputs) block by block as the application does. Returns decoded text.
+    """
+    if morse_decoder is None:
+        morse_decoder = decoder.MorseDecoderRegen()
+    for i in range(0, len(signal), block_len):
+        preds.new_data(signal[i:i+block_len])
+        if preds.p_preds_t is not None:
+            for j in range(preds.p_preds_t.shape[1]):
+                morse_decoder.new_sample(preds.p_preds_t[:,j])
+    if hasattr(morse_decoder, "flush"):
+        morse_decoder.flush()
+    return morse_decoder.res
+
+def evaluate_cer(model, look_back, SNR_dB, text=teststr, seed=0, morse_decoder=None):
+    """ CER of a model decoding a test text at given SNR through the application inference path
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    morse_gen = MorseGen.Morse()
+    _, signal, _ = get_new_data(morse_gen, SNR_dB, morse_cwss=morse_gen.cws_to_cwss(text))
+    model.eval()
+    preds = make_predictions(model, look_back)
+    return cer(text, decode_signal(preds, signal.astype(np.float32), morse_decoder=morse_decoder))
+
+def step_latency(model, look_back, nb_samples=500, block_len=93):
+    """ Mean time in seconds to produce one prediction step through the application inference path
+    """
+    model.eval()
+    preds = make_predictions(model, look_back)
+    signal = np.random.rand(look_back + 1 + nb_samples).astype(np.float32)
+    preds.new_data(signal[:look_back+1]) # warm up
+    nb_steps = 0
+    t0 = time.perf_counter()
+    for i in range(look_back+1, len(signal), block_len):
+        preds.new_data(signal[i:i+block_len])
+        if preds.p_preds_t is not None:
+            nb_steps += preds.p_preds_t.shape[1]
+    return (time.perf_counter() - t0) / max(nb_steps, 1)
@@ -0,0 +1,189 @@
+""" Persistent store of decoded text in SQLite with full text search.
+
+    Decoded characters are grouped per channel into timestamped segments closed at a pause in decoding,
+    after a maximum duration or when the signal is lost. Completed segments are queued to a writer thread
+    that inserts them in batched transactions so the decoding threads never wait for the disk.
+    The database is in WAL mode so that it can be queried while it is written:
+
+        python transcripts.py transcripts.db F4EXB --last 3600
+"""
+import argparse
+import queue
+import sqlite3
+import threading
+import time
+
+schema = """
+CREATE TABLE IF NOT EXISTS segments (
+    id INTEGER PRIMARY KEY,
+    channel TEXT NOT NULL,
+    freq REAL,
+    start REAL NOT NULL,
+    end REAL NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS segments_start ON segments(start);
+CREATE INDEX IF NOT EXISTS segments_channel_start ON segments(channel, start);
+CREATE VIRTUAL TABLE IF NOT EXISTS segments_fts USING fts5(text, content='segments', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS segments_ai AFTER INSERT ON segments BEGIN
+    INSERT INTO segments_fts(rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS segments_ad AFTER DELETE ON segments BEGIN
+    INSERT INTO segments_fts(segments_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+"""
+
+def connect(filename):
+    connection = sqlite3.connect(filename, timeout=10)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+class Segment:
+    __slots__ = ("channel", "freq", "start", "end", "text")
+
+    def __init__(self, channel, freq, t):
+        self.channel = channel
+        self.freq = freq
+        self.start = t
+        self.end = t
+        self.text = ""
+
+
+class TranscriptStore:
+    """ Segments decoded text per channel and writes segments from a background thread.
+        add_char and end_channel only touch memory and a queue.
+    """
+    def __init__(self, filename, max_gap=10.0, max_duration=60.0, batch_interval=1.0, max_batch=1000):
+        self.filename = filename
+        self.max_gap = max_gap # seconds without character closing a segment
+        self.max_duration = max_duration
+        self.batch_interval = batch_interval
+        self.max_batch = max_batch
+        self.segments = {} # channel -> Segment being decoded
+        self.rows = queue.Queue()
+        self.lock = threading.Lock()
+        connection = connect(filename)
+        connection.executescript(schema)
+        connection.close()
+        self.running = True
+        self.thread = threading.Thread(target=self.write_loop, name="TranscriptStore", daemon=True)
+        self.thread.start()
+
+    def add_char(self, channel, char, t=None, freq=None):
+        t = t if t is not None else time.time()
+        with self.lock:
+            segment = self.segments.get(channel)
+            if segment and (t - segment.end > self.max_gap or t - segment.start > self.max_duration):
+                self.close_segment(channel)
+                segment = None
+            if segment is None:
+                if char == " ":
+                    return
+                segment = self.segments[channel] = Segment(channel, freq, t)
+            segment.text += char
+            segment.end = t
+            if freq is not None:
+                segment.freq = freq
+
+    def end_channel(self, channel):
+        """ Close the segment of a channel e.g. when its signal is lost
+        """
+        with self.lock:
+            self.close_segment(channel)
+
+    def close_segment(self, channel):
+        segment = self.segments.pop(channel, None)
+        if segment and segment.text.strip():
+            self.rows.put((str(segment.channel), segment.freq, segment.start, segment.end, segment.text.strip()))
+
+    def flush_idle(self, now=None):
+        """ Close segments without characters for max_gap
+        """
+        now = now if now is not None else time.time()
+        with self.lock:
+            for channel in [c for c, s in self.segments.items() if now - s.end > self.max_gap]:
+                self.close_segment(channel)
+
+    def write_loop(self):
+        connection = connect(self.filename)
+        while self.running or not self.rows.empty():
+            batch = []
+            deadline = time.monotonic() + self.batch_interval
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.rows.get(timeout=max(deadline - time.monotonic(), 0.001)))
+                except queue.Empty:
+                    break
+            self.flush_idle()
+            if batch:
+                with connection: # one transaction per batch
+                    connection.executemany("INSERT INTO segments(channel, freq, start, end, text) VALUES (?, ?, ?, ?, ?)", batch)
+        connection.close()
+
+    def close(self):
+        with self.lock:
+            for channel in list(self.segments.keys()):
+                self.close_segment(channel)
+        self.running = False
+        self.thread.join()
+
+
+def add_arguments(parser):
+    parser.add_argument("--transcripts", help="Save decoded text to this SQLite database (search with transcripts.py)")
+
+def from_args(args):
+    """ Store if a database is given else None
+    """
+    return TranscriptStore(args.transcripts) if args.transcripts else None
+
+def search(filename, terms, since=None, until=None, channel=None, limit=100):
+    """ Segments matching full text search terms (FTS5 syntax, e.g. a callsign) between since and until,
+        most recent first. Returns a list of (channel, freq, start, end, text).
+    """
+    sql = "SELECT s.channel, s.freq, s.start, s.end, s.text FROM segments_fts JOIN segments s ON s.id = segments_fts.rowid WHERE segments_fts MATCH ?"
+    params = [terms]
+    if since is not None:
+        sql += " AND s.end >= ?"
+        params.append(since)
+    if until is not None:
+        sql += " AND s.start <= ?"
+        params.append(until)
+    if channel is not None:
+        sql += " AND s.channel = ?"
+        params.append(str(channel))
+    sql += " ORDER BY s.start DESC LIMIT ?"
+    params.append(limit)
+    connection = connect(filename)
+    try:
+        return connection.execute(sql, params).fetchall()
+    finally:
+        connection.close()
+
+def find_callsign(filename, call, last=3600.0, limit=100):
+    """ Segments containing a callsign in the last seconds
+    """
+    token = '"' + call.upper().replace('"', '') + '"' # quoted so that / or digits are not FTS5 syntax
+    return search(filename, token, since=time.time() - last, limit=limit)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search decoded transcripts")
+    parser.add_argument("database", help="Transcripts database")
+    parser.add_argument("terms", help="Callsign or FTS5 query with --query")
+    parser.add_argument("--last", type=float, default=3600.0, help="Search the last seconds (default 3600)")
+    parser.add_argument("--query", action="store_true", help="Terms are a full FTS5 query")
+    parser.add_argument("--limit", type=int, default=100, help="Maximum number of results (default 100)")
+    args = parser.parse_args()
+    if args.query:
+        rows = search(args.database, args.terms, since=time.time() - args.last, limit=args.limit)
+    else:
+        rows = find_callsign(args.database, args.terms, args.last, args.limit)
+    for channel, freq, start, end, text in rows:
+        freq = f"{freq:10.1f}" if freq is not None else " "*10
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start))} {channel:>6s} {freq} {text}")
+
+
+if __name__ == '__main__':
+    main()